@@ -1,20 +1,100 @@
-from fastapi import FastAPI, Request
+import asyncio
+import time
+
+from fastapi import FastAPI, Request, Response
 from slack_bolt.adapter.fastapi import SlackRequestHandler
 
+from .lib.activity import activity
+from .lib.aio import run
+from .lib.async_openai_client import close_session
+from .lib.embedding_cache import embedding_cache
+from .lib.idempotency import event_store
+from .lib.jobs import job_queue
+from .lib.metrics import registry
+from .lib.page_cache import page_cache
+from .lib.ratelimit import rate_limits
+from .lib.response_cache import response_cache
+from .lib.singleflight import single_flight
 from .lib.slack import bolt_app
+from .lib.slack.indexer import message_indexer
+from .lib.startup import startup, warmup_enabled
+from .lib.webqa import close_web_session, shutdown_process_pool
 
 app = FastAPI()
 slack_handler = SlackRequestHandler(bolt_app)
 
 
+@app.on_event("startup")
+async def warmup():
+    # uvicorn does not accept requests until the startup hooks have finished, so
+    # warm up in the background and report the progress on /_health meanwhile
+    if warmup_enabled():
+        asyncio.get_running_loop().run_in_executor(None, startup.warm_up)
+    else:
+        startup.mark_ready()
+    if message_indexer.enabled:
+        # Catches up on the messages posted while the service was paused
+        message_indexer.start(bolt_app.client)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, run, close_session())
+    await loop.run_in_executor(None, run, close_web_session())
+    shutdown_process_pool()
+    message_indexer.stop()
+
+
+@app.middleware("http")
+async def record_first_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    startup.record_request(request.url.path, time.perf_counter() - start)
+    return response
+
+
 @app.get("/_health")
-async def health():
+async def health(response: Response):
+    if not startup.ready:
+        response.status_code = 503
+        return {"status": "starting", "steps": dict(startup.steps)}
     return {"status": "ok"}
 
 
+@app.get("/_metrics")
+async def metrics():
+    return {
+        "jobs": job_queue.metrics(),
+        "rate_limits": rate_limits.metrics(),
+        "embedding_cache": embedding_cache.stats.to_dict(),
+        "response_cache": response_cache.stats.to_dict(),
+        "page_cache": page_cache.metrics(),
+        "single_flight": single_flight.stats.to_dict(),
+        "events": event_store.stats.to_dict(),
+        "message_index": message_indexer.metrics(),
+        "startup": startup.metrics(),
+    }
+
+
+@app.get("/_activity")
+async def activity_signal():
+    # Read by the scheduler to pause and resume the service
+    return activity.to_dict()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # Prometheus text format
+    return Response(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.post("/slack/events")
 async def slack_events(request: Request):
-    if request.headers.get("X-Slack-Retry-Num") is not None:
-        return {"status": "retry request ignored"}
+    # Retries are deduplicated by event ID in the Bolt app
+    if "X-Slack-Retry-Num" not in request.headers:
+        activity.record()
     response = await slack_handler.handle(request)
     return response
@@ -0,0 +1,61 @@
+# Request activity published on /_activity for the scheduler.
+# The scheduler pauses the App Runner service after a while without Slack events and
+# learns when to resume it from the counts it reads here. The counts live in the
+# process and start from zero whenever the service is resumed, which the scheduler
+# detects from `started_at`.
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Optional
+
+DEFAULT_WINDOW = 300.0
+
+
+class Activity:
+    def __init__(self, window: float = DEFAULT_WINDOW):
+        self.window = window
+        self.started_at = time.time()
+        self.last_event_at: Optional[float] = None
+        self.events = 0
+        self._recent: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "Activity":
+        return cls(window=float(os.getenv("ACTIVITY_WINDOW", DEFAULT_WINDOW)))
+
+    def record(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.events += 1
+            self.last_event_at = now
+            self._recent.append(now)
+            self._expire(now)
+
+    def rate(self, now: Optional[float] = None) -> float:
+        """Events per minute over the last `window` seconds"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+            count = len(self._recent)
+        # Not a full window yet right after a resume
+        return count * 60 / max(min(self.window, now - self.started_at), 60.0)
+
+    def _expire(self, now: float):
+        while self._recent and self._recent[0] < now - self.window:
+            self._recent.popleft()
+
+    def to_dict(self, now: Optional[float] = None) -> dict[str, Any]:
+        now = time.time() if now is None else now
+        return {
+            "now": now,
+            "started_at": self.started_at,
+            "last_event_at": self.last_event_at,
+            "events": self.events,
+            "requests_per_minute": self.rate(now),
+        }
+
+
+activity = Activity.from_env()
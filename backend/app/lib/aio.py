@@ -0,0 +1,54 @@
+# A process-wide event loop running in a background thread.
+# Sync code (e.g. job workers) submits coroutines here so that every async client
+# shares one loop and therefore one HTTP connection pool.
+
+import asyncio
+import contextvars
+import os
+import threading
+from typing import Any, Coroutine, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class BackgroundLoop:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pid: Optional[int] = None
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        # Threads do not survive fork, so start a new loop in each process
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    thread = threading.Thread(
+                        target=loop.run_forever, name="background-loop", daemon=True
+                    )
+                    thread.start()
+                    self._loop = loop
+                    self._pid = os.getpid()
+        return self._loop
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+        """Run `coro` on the background loop and wait for its result"""
+        # Tasks take the context of the loop thread, not the one of the caller
+        context = contextvars.copy_context()
+        future = asyncio.run_coroutine_threadsafe(
+            _in_context(context, coro), self.get_loop()
+        )
+        return future.result(timeout)
+
+
+async def _in_context(context: contextvars.Context, coro: Coroutine[Any, Any, T]) -> T:
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+background_loop = BackgroundLoop()
+
+
+def run(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    return background_loop.run(coro, timeout)
@@ -0,0 +1,300 @@
+# asyncio counterpart of OpenAIClient.
+# All the requests of a process go through one keep-alive aiohttp connection pool
+# per event loop instead of a new connection (and TLS handshake) per client.
+# As in OpenAIClient, openai is imported on first use.
+
+import asyncio
+import base64
+import io
+import os
+import weakref
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+import aiohttp
+
+from .embedding_cache import embedding_cache
+from .metrics import registry, timed
+from .openai_client import (
+    CODE_EDIT_MODEL,
+    CODE_MODEL,
+    COMPLETION_MODEL,
+    COMPLETION_TEMPERATURE,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_MODEL,
+    MAX_EMBEDDING_BATCH_INPUTS,
+    MAX_EMBEDDING_BATCH_TOKENS,
+    TEXT_EDIT_MODEL,
+    _pack_batches,
+)
+from .ratelimit import rate_limits
+from .tokenizer import count_tokens
+from .util import crop_and_resize_image
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+@dataclass
+class PoolConfig:
+    limit: int = 100
+    limit_per_host: int = 32
+    keepalive_timeout: float = 60.0
+    connect_timeout: float = 10.0
+    request_timeout: float = 120.0
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        default = cls()
+        return cls(
+            limit=int(os.getenv("OPENAI_POOL_LIMIT", default.limit)),
+            limit_per_host=int(
+                os.getenv("OPENAI_POOL_LIMIT_PER_HOST", default.limit_per_host)
+            ),
+            keepalive_timeout=float(
+                os.getenv("OPENAI_KEEPALIVE_TIMEOUT", default.keepalive_timeout)
+            ),
+            connect_timeout=float(
+                os.getenv("OPENAI_CONNECT_TIMEOUT", default.connect_timeout)
+            ),
+            request_timeout=float(
+                os.getenv("OPENAI_REQUEST_TIMEOUT", default.request_timeout)
+            ),
+        )
+
+
+_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_session(config: Optional[PoolConfig] = None) -> aiohttp.ClientSession:
+    """The shared connection pool of the running event loop"""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        config = config or PoolConfig.from_env()
+        connector = aiohttp.TCPConnector(
+            limit=config.limit,
+            limit_per_host=config.limit_per_host,
+            keepalive_timeout=config.keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config.request_timeout, connect=config.connect_timeout
+        )
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class AsyncOpenAIClient:
+    def __init__(self, config: Optional[PoolConfig] = None):
+        import openai
+
+        openai.organization = os.getenv("OPENAI_ORGANIZATION")
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        self.config = config or PoolConfig.from_env()
+
+    @property
+    def _timeout(self) -> tuple[float, float]:
+        return (self.config.connect_timeout, self.config.request_timeout)
+
+    def _use_pool(self):
+        import openai
+
+        # openai reads the session from a context variable on every request
+        openai.aiosession.set(get_session(self.config))
+
+    @timed()
+    async def get_text_completion(
+        self, prompt: str, model: str = COMPLETION_MODEL, max_tokens: int = 3000
+    ) -> str:
+        import openai
+
+        self._use_pool()
+        resp = await rate_limits.call_async(
+            f"openai:{model}",
+            lambda: openai.Completion.acreate(
+                model=model,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=COMPLETION_TEMPERATURE,
+                request_timeout=self._timeout,
+            ),
+        )
+        registry.record_tokens(model, resp.get("usage"))
+        text = resp.choices[0].text
+        return text
+
+    @timed()
+    async def get_text_edit(
+        self, input: str, instruction: str, model: str = TEXT_EDIT_MODEL
+    ) -> str:
+        import openai
+
+        self._use_pool()
+        resp = await rate_limits.call_async(
+            f"openai:{model}",
+            lambda: openai.Edit.acreate(
+                model=model,
+                input=input,
+                instruction=instruction,
+                request_timeout=self._timeout,
+            ),
+        )
+        registry.record_tokens(model, resp.get("usage"))
+        text = resp.choices[0].text
+        return text
+
+    @timed()
+    async def get_text_insertion(
+        self,
+        prompt: str,
+        suffix: str,
+        model: str = COMPLETION_MODEL,
+        max_tokens: int = 3000,
+    ) -> str:
+        import openai
+
+        self._use_pool()
+        resp = await rate_limits.call_async(
+            f"openai:{model}",
+            lambda: openai.Completion.acreate(
+                model=model,
+                prompt=prompt,
+                suffix=suffix,
+                max_tokens=max_tokens,
+                temperature=COMPLETION_TEMPERATURE,
+                request_timeout=self._timeout,
+            ),
+        )
+        registry.record_tokens(model, resp.get("usage"))
+        text = resp.choices[0].text
+        return text
+
+    @timed()
+    async def get_code_completion(self, prompt: str) -> str:
+        return await self.get_text_completion(prompt, model=CODE_MODEL)
+
+    @timed()
+    async def get_code_edit(self, input: str, instruction: str) -> str:
+        return await self.get_text_edit(input, instruction, model=CODE_EDIT_MODEL)
+
+    @timed()
+    async def get_code_insertion(self, prompt: str, suffix: str) -> str:
+        return await self.get_text_insertion(prompt, suffix, model=CODE_MODEL)
+
+    @timed()
+    async def get_image(self, prompt: str) -> list[bytes]:
+        import openai
+
+        self._use_pool()
+        resp = await rate_limits.call_async(
+            "openai:images",
+            lambda: openai.Image.acreate(
+                prompt=prompt,
+                n=3,
+                size="512x512",
+                response_format="b64_json",
+                request_timeout=self._timeout,
+            ),
+        )
+        images = [base64.b64decode(img.b64_json) for img in resp.data]
+        return images
+
+    @timed()
+    async def get_image_variation(self, image: bytes) -> list[bytes]:
+        import openai
+
+        # Only square PNG up to 4MB is accepted by OpenAI
+        resized = io.BytesIO()
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: crop_and_resize_image(
+                io.BytesIO(image), resized, size=(512, 512), format="png"
+            ),
+        )
+        self._use_pool()
+        resp = await rate_limits.call_async(
+            "openai:images",
+            lambda: openai.Image.acreate_variation(
+                image=resized.getvalue(),
+                n=3,
+                size="512x512",
+                response_format="b64_json",
+                request_timeout=self._timeout,
+            ),
+        )
+        images = [base64.b64decode(img.b64_json) for img in resp.data]
+        return images
+
+    @timed()
+    async def get_text_embedding(self, input: str) -> "np.ndarray":
+        import numpy as np
+        import openai
+
+        emb = embedding_cache.get(EMBEDDING_MODEL, input)
+        if emb is None:
+            self._use_pool()
+            resp = await rate_limits.call_async(
+                f"openai:{EMBEDDING_MODEL}",
+                lambda: openai.Embedding.acreate(
+                    input=input,
+                    model=EMBEDDING_MODEL,
+                    request_timeout=self._timeout,
+                ),
+            )
+            registry.record_tokens(EMBEDDING_MODEL, resp.get("usage"))
+            emb = np.array(resp.data[0].embedding, dtype=np.float32)
+            embedding_cache.put(EMBEDDING_MODEL, input, emb)
+        return emb
+
+    @timed()
+    async def get_text_embeddings(
+        self,
+        inputs: list[str],
+        max_batch_inputs: int = MAX_EMBEDDING_BATCH_INPUTS,
+        max_batch_tokens: int = MAX_EMBEDDING_BATCH_TOKENS,
+        max_concurrency: int = EMBEDDING_CONCURRENCY,
+        n_tokens_list: Optional[list[int]] = None,
+    ) -> list["np.ndarray"]:
+        import numpy as np
+        import openai
+
+        cached = embedding_cache.get_many(EMBEDDING_MODEL, inputs)
+        misses = list(dict.fromkeys(t for t, e in zip(inputs, cached) if e is None))
+        if not misses:
+            return cached  # type: ignore
+
+        if n_tokens_list is not None:
+            known = dict(zip(inputs, n_tokens_list))
+            n_tokens_list = [known[t] for t in misses]
+        else:
+            n_tokens_list = [count_tokens(t, EMBEDDING_MODEL) for t in misses]
+        batches = _pack_batches(n_tokens_list, max_batch_inputs, max_batch_tokens)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def embed(batch: list[int]) -> list["np.ndarray"]:
+            async with semaphore:
+                self._use_pool()
+                resp = await rate_limits.call_async(
+                    f"openai:{EMBEDDING_MODEL}",
+                    lambda: openai.Embedding.acreate(
+                        input=[misses[i] for i in batch],
+                        model=EMBEDDING_MODEL,
+                        request_timeout=self._timeout,
+                    ),
+                )
+            registry.record_tokens(EMBEDDING_MODEL, resp.get("usage"))
+            data = sorted(resp.data, key=lambda d: d.index)
+            return [np.array(d.embedding, dtype=np.float32) for d in data]
+
+        results = await asyncio.gather(*[embed(batch) for batch in batches])
+        embs = [emb for batch_embs in results for emb in batch_embs]
+        embedding_cache.put_many(EMBEDDING_MODEL, misses, embs)
+        new = dict(zip(misses, embs))
+        return [new[t] if e is None else e for t, e in zip(inputs, cached)]
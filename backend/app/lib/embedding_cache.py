@@ -0,0 +1,119 @@
+# Content-addressed embedding cache.
+# Embeddings are keyed by (model, sha256 of the text) and kept in a bounded in-memory
+# LRU tier and, optionally, in a SQLite file that survives restarts.
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 10000
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    disk_hits: int = 0
+
+    def to_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self, max_entries: int = DEFAULT_MAX_ENTRIES, path: Optional[str] = None
+    ):
+        self.max_entries = max_entries
+        self.path = path
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, key))"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        max_entries = int(os.getenv("EMBEDDING_CACHE_SIZE", DEFAULT_MAX_ENTRIES))
+        path = os.getenv("EMBEDDING_CACHE_PATH") or None
+        return cls(max_entries=max_entries, path=path)
+
+    def get_many(self, model: str, texts: list[str]) -> list[Optional[np.ndarray]]:
+        keys = [(model, text_key(t)) for t in texts]
+        results: list[Optional[np.ndarray]] = []
+        with self._lock:
+            for key in keys:
+                emb = self._memory.get(key)
+                if emb is not None:
+                    self._memory.move_to_end(key)
+                elif self._db is not None:
+                    row = self._db.execute(
+                        "SELECT vector FROM embeddings WHERE model = ? AND key = ?", key
+                    ).fetchone()
+                    if row is not None:
+                        emb = np.frombuffer(row[0], dtype=np.float32)
+                        self.stats.disk_hits += 1
+                        self._put_memory(key, emb)
+                if emb is None:
+                    self.stats.misses += 1
+                else:
+                    self.stats.hits += 1
+                results.append(emb)
+        return results
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model: str, texts: list[str], embs: list[np.ndarray]):
+        items = [
+            ((model, text_key(t)), np.asarray(e, dtype=np.float32))
+            for t, e in zip(texts, embs)
+        ]
+        with self._lock:
+            for key, emb in items:
+                self._put_memory(key, emb)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, key, vector) "
+                    "VALUES (?, ?, ?)",
+                    [(m, k, e.tobytes()) for (m, k), e in items],
+                )
+                self._db.commit()
+
+    def put(self, model: str, text: str, emb: np.ndarray):
+        self.put_many(model, [text], [emb])
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def _put_memory(self, key: tuple[str, str], emb: np.ndarray):
+        self._memory[key] = emb
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+
+embedding_cache = EmbeddingCache.from_env()
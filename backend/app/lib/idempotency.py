@@ -0,0 +1,252 @@
+# Deduplication of Slack events by `event_id`.
+# Slack retries an event that was not acknowledged within 3 seconds, and every uvicorn
+# worker or instance that receives it would otherwise answer it again. An event is
+# claimed as `in_progress` for EVENT_STORE_LEASE seconds when it arrives and marked
+# `done` for EVENT_STORE_TTL seconds once its job has finished, so a retry is only
+# accepted if the first delivery failed before it was claimed, was released after an
+# error, or its lease expired because the worker died.
+# The backend is selected by EVENT_STORE_URL:
+#   memory://            in-process, i.e. per uvicorn worker (the default)
+#   sqlite:///path/to/db SQLite file shared by the workers of an instance
+#   redis://host:port/0  Redis-compatible server shared by the instances (requires
+#                        the `redis` package)
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Optional, Protocol
+
+from loguru import logger
+
+IN_PROGRESS = "in_progress"
+DONE = "done"
+# Longer than the queue wait and the processing of a job
+DEFAULT_LEASE = 120.0
+# Longer than Slack's retries, the last of which comes about 5 minutes later
+DEFAULT_TTL = 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class Backend(Protocol):
+    def claim(self, key: str, ttl: float) -> bool:
+        """Mark `key` as in progress unless it is already claimed or done"""
+        ...
+
+    def finish(self, key: str, ttl: float):
+        ...
+
+    def release(self, key: str):
+        """Forget `key` if it is still in progress"""
+        ...
+
+    def state(self, key: str) -> Optional[str]:
+        ...
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items: dict[str, tuple[str, float]] = {}
+
+    def claim(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] >= now:
+                return False
+            self._items[key] = (IN_PROGRESS, now + ttl)
+            if len(self._items) > self.max_entries:
+                self._purge(now)
+            return True
+
+    def finish(self, key: str, ttl: float):
+        with self._lock:
+            self._items[key] = (DONE, time.time() + ttl)
+
+    def release(self, key: str):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] == IN_PROGRESS:
+                del self._items[key]
+
+    def state(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._items.get(key)
+        if item is None or item[1] < time.time():
+            return None
+        return item[0]
+
+    def _purge(self, now: float):
+        self._items = {k: v for k, v in self._items.items() if v[1] >= now}
+        # Still too many live events: forget the ones expiring first
+        excess = len(self._items) - self.max_entries
+        if excess > 0:
+            for key in sorted(self._items, key=lambda k: self._items[k][1])[:excess]:
+                del self._items[key]
+
+
+class SQLiteBackend:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        # Wait for the write lock of the other workers instead of failing
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "key TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def claim(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # A single statement, so the claim is atomic across processes
+            cursor = self._db.execute(
+                "INSERT INTO events VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE "
+                "SET state = excluded.state, expires_at = excluded.expires_at "
+                "WHERE events.expires_at < ?",
+                (key, IN_PROGRESS, now + ttl, now),
+            )
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def finish(self, key: str, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO events VALUES (?, ?, ?)", (key, DONE, now + ttl)
+            )
+            self._db.execute("DELETE FROM events WHERE expires_at < ?", (now,))
+            self._db.commit()
+
+    def release(self, key: str):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM events WHERE key = ? AND state = ?", (key, IN_PROGRESS)
+            )
+            self._db.commit()
+
+    def state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM events WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+
+class RedisBackend:
+    # Delete the key only if nobody else has finished it in the meantime
+    RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) end return 0"
+    )
+
+    def __init__(self, url: str, prefix: str = "openai-bot:event:"):
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._release = self._redis.register_script(self.RELEASE_SCRIPT)
+
+    def claim(self, key: str, ttl: float) -> bool:
+        return bool(
+            self._redis.set(self.prefix + key, IN_PROGRESS, nx=True, ex=math.ceil(ttl))
+        )
+
+    def finish(self, key: str, ttl: float):
+        self._redis.set(self.prefix + key, DONE, ex=math.ceil(ttl))
+
+    def release(self, key: str):
+        self._release(keys=[self.prefix + key], args=[IN_PROGRESS])
+
+    def state(self, key: str) -> Optional[str]:
+        value = self._redis.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+
+def create_backend(url: str) -> Backend:
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url.removeprefix("sqlite:///"))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unknown event store backend: {url}")
+
+
+@dataclass
+class EventStoreStats:
+    accepted: int = 0
+    # Retries of events that had not been claimed yet
+    retries_accepted: int = 0
+    duplicates: int = 0
+    released: int = 0
+    errors: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class EventStore:
+    def __init__(
+        self, backend: Backend, lease: float = DEFAULT_LEASE, ttl: float = DEFAULT_TTL
+    ):
+        self.backend = backend
+        self.lease = lease
+        self.ttl = ttl
+        self.stats = EventStoreStats()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "EventStore":
+        return cls(
+            create_backend(os.getenv("EVENT_STORE_URL", "memory://")),
+            lease=float(os.getenv("EVENT_STORE_LEASE", DEFAULT_LEASE)),
+            ttl=float(os.getenv("EVENT_STORE_TTL", DEFAULT_TTL)),
+        )
+
+    def begin(self, event_id: str, retry: bool = False) -> bool:
+        """Claim `event_id`, returning False if it is a duplicate"""
+        try:
+            claimed = self.backend.claim(event_id, self.lease)
+        except Exception:
+            # Answering twice is better than not answering
+            logger.exception(f"Failed to claim an event: {event_id=}")
+            self._count("errors")
+            return True
+        if not claimed:
+            self._count("duplicates")
+        elif retry:
+            self._count("retries_accepted")
+        else:
+            self._count("accepted")
+        return claimed
+
+    def complete(self, event_id: str):
+        try:
+            self.backend.finish(event_id, self.ttl)
+        except Exception:
+            logger.exception(f"Failed to complete an event: {event_id=}")
+            self._count("errors")
+
+    def release(self, event_id: str):
+        """Let a retry of `event_id` be processed, e.g. after an error"""
+        try:
+            self.backend.release(event_id)
+        except Exception:
+            logger.exception(f"Failed to release an event: {event_id=}")
+            self._count("errors")
+        else:
+            self._count("released")
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+
+event_store = EventStore.from_env()
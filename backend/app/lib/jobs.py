@@ -0,0 +1,165 @@
+# In-process job queue served by a pool of worker threads.
+# Slack requires an acknowledgement within 3 seconds, so listeners only enqueue jobs
+# and the slow OpenAI calls run here after the HTTP response has been returned.
+
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from loguru import logger
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_QUEUE = 100
+WAIT_TIME_WINDOW = 100
+
+
+class QueueFull(Exception):
+    def __init__(self, message=""):
+        super().__init__(message)
+
+
+@dataclass
+class Job:
+    command: str
+    fn: Callable[..., Any]
+    args: tuple
+    kwargs: dict
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+def parse_limits(spec: str) -> dict[str, int]:
+    """Parse per-command concurrency limits such as `image=2,webqa=2`"""
+    limits = {}
+    for item in spec.split(","):
+        if item.strip():
+            command, limit = item.split("=")
+            limits[command.strip()] = int(limit)
+    return limits
+
+
+class JobQueue:
+    def __init__(
+        self,
+        workers: int = DEFAULT_WORKERS,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        limits: Optional[dict[str, int]] = None,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.limits = limits or {}
+        self._cond = threading.Condition()
+        self._pending: deque[Job] = deque()
+        self._running: dict[str, int] = {}
+        self._threads: list[threading.Thread] = []
+        self._pid: Optional[int] = None
+        self._stopped = False
+        self._wait_times: deque[float] = deque(maxlen=WAIT_TIME_WINDOW)
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    @classmethod
+    def from_env(cls) -> "JobQueue":
+        return cls(
+            workers=int(os.getenv("JOB_WORKERS", DEFAULT_WORKERS)),
+            max_queue=int(os.getenv("JOB_MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+            limits=parse_limits(os.getenv("JOB_LIMITS", "image=2,webqa=2")),
+        )
+
+    def submit(self, command: str, fn: Callable[..., Any], *args, **kwargs):
+        """Enqueue `fn(*args, **kwargs)`, raising `QueueFull` under backpressure"""
+        self._ensure_started()
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                self._rejected += 1
+                raise QueueFull(f"{len(self._pending)} jobs are waiting")
+            self._pending.append(Job(command, fn, args, kwargs))
+            self._cond.notify()
+
+    def metrics(self) -> dict[str, Any]:
+        with self._cond:
+            wait_times = list(self._wait_times)
+            return {
+                "workers": self.workers,
+                "queue_depth": len(self._pending),
+                "running": {k: v for k, v in self._running.items() if v},
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "wait_time_avg": sum(wait_times) / len(wait_times) if wait_times else 0,
+                "wait_time_max": max(wait_times, default=0),
+            }
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all the submitted jobs have finished"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or any(self._running.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so (re)start them in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._stopped = False
+            self._threads = [
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def _next_job(self) -> Optional[Job]:
+        with self._cond:
+            while not self._stopped:
+                for job in self._pending:
+                    running = self._running.get(job.command, 0)
+                    if running < self.limits.get(job.command, self.workers):
+                        self._pending.remove(job)
+                        self._running[job.command] = running + 1
+                        self._wait_times.append(time.monotonic() - job.enqueued_at)
+                        return job
+                self._cond.wait()
+            return None
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except Exception:
+                logger.exception(f"Job failed: {job.command=}")
+                failed = True
+            else:
+                failed = False
+            with self._cond:
+                self._running[job.command] -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+                self._cond.notify_all()
+
+
+job_queue = JobQueue.from_env()
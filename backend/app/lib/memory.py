@@ -0,0 +1,175 @@
+# Token-budgeted conversation memory for chat threads.
+# The newest turns are kept verbatim up to a token budget. Older turns are folded
+# into a running summary, which is cached per thread and only extended with the turns
+# that have fallen out of the window since the last summary.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Sequence
+
+from loguru import logger
+
+from .openai_client import COMPLETION_MODEL, OpenAIClient
+from .tokenizer import count_tokens
+
+DEFAULT_MAX_TOKENS = 1500
+SUMMARY_MAX_TOKENS = 256
+DEFAULT_MAX_THREADS = 256
+ASSISTANT = "Assistant"
+HUMAN = "人間"
+
+SUMMARY_PROMPT = (
+    "以下は人間とAssistantの会話の要約と、その続きです。"
+    "続きの内容を反映して、要約を日本語で簡潔に書き直してください。"
+    "誰が何を言ったかは区別してください。\n\n"
+    "要約:\n{summary}\n\n"
+    "続き:\n{lines}\n\n"
+    "新しい要約:"
+)
+
+Turn = tuple[str, str]
+# Channel and thread_ts
+ThreadKey = tuple[str, str]
+Summarizer = Callable[[str, str], str]
+
+
+def summarize_turns(summary: str, lines: str) -> str:
+    openai = OpenAIClient()
+    prompt = SUMMARY_PROMPT.format(summary=summary or "なし", lines=lines)
+    return openai.get_text_completion(prompt, max_tokens=SUMMARY_MAX_TOKENS).strip()
+
+
+def turn_key(turn: Turn) -> str:
+    return hashlib.sha256("\0".join(turn).encode("utf-8")).hexdigest()
+
+
+def speaker_names(
+    messages: Sequence[Turn], user: str, bot_user: Optional[str]
+) -> dict[str, str]:
+    """Name the speakers in the prompt, telling several human users apart"""
+    if bot_user is None:
+        # Without our own ID, everyone but the current user is assumed to be us
+        return {usr: HUMAN if usr == user else ASSISTANT for usr, _ in messages}
+    humans = list(dict.fromkeys(usr for usr, _ in messages if usr != bot_user))
+    names = {bot_user: ASSISTANT}
+    if len(humans) == 1:
+        names[humans[0]] = HUMAN
+    else:
+        for i, usr in enumerate(humans):
+            names[usr] = f"{HUMAN}{chr(ord('A') + i)}"
+    return names
+
+
+@dataclass
+class Summary:
+    text: str
+    # Position and key of the last turn folded into `text`
+    until: int
+    until_key: str
+
+    def find(self, messages: Sequence[Turn]) -> Optional[int]:
+        """Position of the first turn not covered by the summary"""
+        # Usually the same position, unless older messages have been dropped
+        for i in [self.until, *reversed(range(min(self.until, len(messages))))]:
+            if i < len(messages) and turn_key(messages[i]) == self.until_key:
+                return i + 1
+        return None
+
+
+class ConversationMemory:
+    def __init__(
+        self,
+        max_tokens: int = DEFAULT_MAX_TOKENS,
+        model: str = COMPLETION_MODEL,
+        summarize: Summarizer = summarize_turns,
+        max_threads: int = DEFAULT_MAX_THREADS,
+    ):
+        self.max_tokens = max_tokens
+        self.model = model
+        self.summarize = summarize
+        self.max_threads = max_threads
+        self.summary_calls = 0
+        self._lock = threading.Lock()
+        self._summaries: OrderedDict[ThreadKey, Summary] = OrderedDict()
+
+    def format_thread(
+        self,
+        thread: ThreadKey,
+        messages: Sequence[Turn],
+        user: str,
+        bot_user: Optional[str] = None,
+    ) -> str:
+        """The `thread` as a prompt of at most `max_tokens`, ending with our turn"""
+        if not messages:
+            return f"{ASSISTANT}: "
+        names = speaker_names(messages, user, bot_user)
+        lines = [f"{names[usr]}: {msg}" for usr, msg in messages]
+        n_tokens = [count_tokens(line, self.model) for line in lines]
+
+        with self._lock:
+            summary = self._summaries.get(thread)
+            if summary is not None:
+                self._summaries.move_to_end(thread)
+        start = 0
+        if summary is not None:
+            start = summary.find(messages)
+            if start is None:
+                summary, start = None, 0
+
+        summary_tokens = count_tokens(summary.text, self.model) if summary else 0
+        if summary_tokens + sum(n_tokens[start:]) > self.max_tokens:
+            # Fold enough turns to get back to half of the budget, so that the
+            # summary is not rewritten on every reply
+            budget = self.max_tokens // 2 - SUMMARY_MAX_TOKENS
+            end = len(lines) - 1
+            kept = n_tokens[end]
+            while end > start and kept + n_tokens[end - 1] <= budget:
+                end -= 1
+                kept += n_tokens[end]
+            summary = self._extend(
+                thread, summary, lines[start:end], end - 1, messages[end - 1]
+            )
+            start = end
+
+        # The newest turn is kept even if it alone exceeds the budget
+        summary_tokens = count_tokens(summary.text, self.model) if summary else 0
+        total = summary_tokens + sum(n_tokens[start:])
+        while start < len(lines) - 1 and total > self.max_tokens:
+            total -= n_tokens[start]
+            start += 1
+        body = lines[start:]
+        header = [f"これまでの会話の要約: {summary.text}", ""] if summary else []
+        return "\n".join(header + body + [f"{ASSISTANT}: "])
+
+    def clear(self):
+        with self._lock:
+            self._summaries.clear()
+
+    def _extend(
+        self,
+        thread: ThreadKey,
+        summary: Optional[Summary],
+        lines: list[str],
+        until: int,
+        last: Turn,
+    ) -> Optional[Summary]:
+        if not lines:
+            return summary
+        try:
+            text = self.summarize(summary.text if summary else "", "\n".join(lines))
+        except Exception:
+            logger.exception(f"Failed to summarise the thread: {thread=}")
+            return summary
+        self.summary_calls += 1
+        summary = Summary(text=text, until=until, until_key=turn_key(last))
+        with self._lock:
+            self._summaries[thread] = summary
+            self._summaries.move_to_end(thread)
+            while len(self._summaries) > self.max_threads:
+                self._summaries.popitem(last=False)
+        return summary
+
+
+conversation_memory = ConversationMemory()
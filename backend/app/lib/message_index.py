@@ -0,0 +1,415 @@
+# Persistent vector index of Slack messages for slacksearch.
+# Embeddings are appended to a memory-mapped float32 matrix (vectors.f32) and the
+# timestamp, channel, inverted list and liveness of each row to a memory-mapped table
+# (rows.bin), while the texts are kept in SQLite (messages.db). Once `min_train` rows
+# have been added, they are clustered by spherical k-means into about sqrt(n) inverted
+# lists (IVF), and a query only scans the `nprobe` lists whose centroids are closest to
+# it. The lists are trained again whenever the index has grown RETRAIN_FACTOR times.
+# Edited messages are added again and deleted ones only marked dead, so the files never
+# shrink. An index must be written by one process only, i.e. a single uvicorn worker.
+
+import math
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Collection, Optional, Sequence
+
+import numpy as np
+
+from .metrics import timed
+from .retrieval import normalize
+
+ROW_DTYPE = np.dtype(
+    [("ts", "<f8"), ("channel", "<i4"), ("list", "<i4"), ("alive", "u1")]
+)
+UNASSIGNED = -1
+INITIAL_CAPACITY = 1024
+DEFAULT_NPROBE = 16
+DEFAULT_MIN_TRAIN = 10000
+# Filters matching fewer rows than this are searched exactly
+DEFAULT_EXACT_LIMIT = 20000
+RETRAIN_FACTOR = 4
+MAX_LISTS = 4096
+# k-means is trained on a sample of this many rows per list
+TRAIN_SAMPLE_PER_LIST = 32
+TRAIN_ITERATIONS = 10
+# Rows scored at once, to bound the memory of the scores
+ASSIGN_CHUNK = 16384
+
+
+@dataclass
+class IndexedMessage:
+    channel: str
+    ts: str
+    user: str
+    text: str
+
+
+@dataclass
+class SearchResult:
+    channel: str
+    ts: str
+    user: str
+    text: str
+    score: float
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """The closest centroid of each of the L2-normalised `vectors`"""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        chunk = np.asarray(vectors[start : start + ASSIGN_CHUNK], dtype=np.float32)
+        labels[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(
+    vectors: np.ndarray, k: int, iterations: int = TRAIN_ITERATIONS, seed: int = 0
+) -> np.ndarray:
+    """`k` L2-normalised centroids of the L2-normalised `vectors`"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.add.reduceat(vectors[order], starts, axis=0)
+        centroids[nonempty] = normalize(sums)
+        # Restart empty clusters from random vectors
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty))]
+    return centroids
+
+
+class MessageIndex:
+    def __init__(
+        self,
+        path: str,
+        nprobe: int = DEFAULT_NPROBE,
+        min_train: int = DEFAULT_MIN_TRAIN,
+        exact_limit: int = DEFAULT_EXACT_LIMIT,
+    ):
+        self.path = path
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.exact_limit = exact_limit
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(path, "messages.db"), check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages (row INTEGER PRIMARY KEY, "
+            "channel TEXT NOT NULL, ts TEXT NOT NULL, user TEXT, text TEXT NOT NULL, "
+            "UNIQUE (channel, ts))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS channels "
+            "(code INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, name TEXT)"
+        )
+        self._db.commit()
+
+        meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        self.dim: int = meta.get("dim", 0)
+        # Rows beyond the committed count were written by an interrupted `add`
+        self.n_rows: int = meta.get("rows", 0)
+        self.n_trained: int = meta.get("trained", 0)
+        self.channel_codes: dict[str, int] = {}
+        self.channel_names: dict[str, str] = {}
+        for code, id, name in self._db.execute("SELECT code, id, name FROM channels"):
+            self.channel_codes[id] = code
+            if name:
+                self.channel_names[id] = name
+
+        self.capacity = 0
+        self._vectors = np.empty((0, self.dim), dtype=np.float32)
+        self._rows = np.empty(0, dtype=ROW_DTYPE)
+        if self.dim:
+            self._map(max(self.n_rows, INITIAL_CAPACITY))
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: list[np.ndarray] = []
+        centroids_path = os.path.join(path, "centroids.npy")
+        if self.n_trained and os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self._lists = self._build_lists()
+
+    def __len__(self) -> int:
+        """Number of live messages"""
+        with self._lock:
+            return int(self._rows["alive"][: self.n_rows].sum())
+
+    @property
+    def nlist(self) -> int:
+        return 0 if self.centroids is None else len(self.centroids)
+
+    def _map(self, capacity: int):
+        """Memory-map the files with room for `capacity` rows"""
+        for name, itemsize in (
+            ("vectors.f32", self.dim * 4),
+            ("rows.bin", ROW_DTYPE.itemsize),
+        ):
+            file = os.path.join(self.path, name)
+            with open(file, "ab") as f:
+                if f.tell() < capacity * itemsize:
+                    f.truncate(capacity * itemsize)
+        self._vectors = np.memmap(
+            os.path.join(self.path, "vectors.f32"),
+            dtype=np.float32,
+            mode="r+",
+            shape=(capacity, self.dim),
+        )
+        self._rows = np.memmap(
+            os.path.join(self.path, "rows.bin"),
+            dtype=ROW_DTYPE,
+            mode="r+",
+            shape=(capacity,),
+        )
+        self.capacity = capacity
+
+    def _reserve(self, n: int):
+        if self.n_rows + n > self.capacity:
+            self._flush()
+            self._map(max(self.capacity * 2, self.n_rows + n))
+
+    def _flush(self):
+        if self.capacity:
+            self._vectors.flush()
+            self._rows.flush()
+
+    def _build_lists(self) -> list[np.ndarray]:
+        """Rows of each inverted list in ascending order"""
+        labels = np.asarray(self._rows["list"][: self.n_rows])
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(self.nlist + 1))
+        return [order[bounds[i] : bounds[i + 1]] for i in range(self.nlist)]
+
+    def _channel_code(self, channel: str) -> int:
+        code = self.channel_codes.get(channel)
+        if code is None:
+            cursor = self._db.execute(
+                "INSERT INTO channels (id) VALUES (?)", (channel,)
+            )
+            code = self.channel_codes[channel] = int(cursor.lastrowid)
+        return code
+
+    def set_channel_name(self, channel: str, name: str):
+        with self._lock:
+            if self.channel_names.get(channel) == name:
+                return
+            self._channel_code(channel)
+            self._db.execute(
+                "UPDATE channels SET name = ? WHERE id = ?", (name, channel)
+            )
+            self._db.commit()
+            self.channel_names[channel] = name
+
+    def channel_id(self, name: str) -> Optional[str]:
+        for id, channel_name in self.channel_names.items():
+            if channel_name == name:
+                return id
+        return None
+
+    def latest_ts(self) -> dict[str, str]:
+        """The timestamp of the latest message indexed in each channel"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT channel, MAX(CAST(ts AS REAL)), ts FROM messages "
+                "GROUP BY channel"
+            ).fetchall()
+        return {channel: ts for channel, _, ts in rows}
+
+    def _kill(self, keys: Sequence[tuple[str, str]]):
+        for channel, ts in keys:
+            row = self._db.execute(
+                "SELECT row FROM messages WHERE channel = ? AND ts = ?", (channel, ts)
+            ).fetchone()
+            if row is not None:
+                self._rows["alive"][row[0]] = 0
+                self._db.execute("DELETE FROM messages WHERE row = ?", row)
+
+    @timed("message_index.add")
+    def add(self, messages: Sequence[IndexedMessage], embeddings: np.ndarray):
+        """Add `messages`, replacing the ones already indexed with the same ts"""
+        # The last version of a message edited several times in a batch wins
+        latest = {(m.channel, m.ts): i for i, m in enumerate(messages)}
+        keep = sorted(latest.values())
+        messages = [messages[i] for i in keep]
+        if not messages:
+            return
+        embs = normalize(np.asarray(embeddings)[keep])
+        with self._lock:
+            if not self.dim:
+                self.dim = embs.shape[1]
+                self._db.execute("INSERT INTO meta VALUES ('dim', ?)", (self.dim,))
+                self._map(INITIAL_CAPACITY)
+            self._kill(list(latest))
+            self._reserve(len(messages))
+            start, end = self.n_rows, self.n_rows + len(messages)
+            labels = (
+                np.full(len(messages), UNASSIGNED, dtype=np.int32)
+                if self.centroids is None
+                else assign(embs, self.centroids)
+            )
+            self._vectors[start:end] = embs
+            rows = self._rows[start:end]
+            rows["ts"] = [float(m.ts) for m in messages]
+            rows["channel"] = [self._channel_code(m.channel) for m in messages]
+            rows["list"] = labels
+            rows["alive"] = 1
+            # The rows are on disk before they are counted
+            self._flush()
+            self._db.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                [
+                    (start + i, m.channel, m.ts, m.user, m.text)
+                    for i, m in enumerate(messages)
+                ],
+            )
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rows', ?)", (end,))
+            self._db.commit()
+            self.n_rows = end
+            if self.centroids is not None:
+                for label in np.unique(labels):
+                    new = start + np.flatnonzero(labels == label)
+                    self._lists[label] = np.concatenate([self._lists[label], new])
+
+    def delete(self, channel: str, ts: str) -> bool:
+        with self._lock:
+            found = self._db.execute(
+                "SELECT 1 FROM messages WHERE channel = ? AND ts = ?", (channel, ts)
+            ).fetchone()
+            if found is None:
+                return False
+            self._kill([(channel, ts)])
+            self._flush()
+            self._db.commit()
+            return True
+
+    def needs_training(self) -> bool:
+        if self.centroids is None:
+            return len(self) >= self.min_train
+        return self.n_rows >= self.n_trained * RETRAIN_FACTOR
+
+    @timed("message_index.train")
+    def train(self, seed: int = 0):
+        """Cluster the rows into inverted lists"""
+        with self._lock:
+            n_rows = self.n_rows
+            vectors = self._vectors
+            alive = np.flatnonzero(self._rows["alive"][:n_rows])
+        if not len(alive):
+            return
+        # The rows are only appended, so they can be read without the lock
+        nlist = max(1, min(int(math.sqrt(len(alive))), MAX_LISTS))
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(alive), nlist * TRAIN_SAMPLE_PER_LIST)
+        sample = np.sort(rng.choice(alive, sample_size, replace=False))
+        centroids = spherical_kmeans(np.asarray(vectors[sample]), nlist, seed=seed)
+        labels = assign(vectors[:n_rows], centroids)
+        with self._lock:
+            labels = np.concatenate(
+                [labels, assign(self._vectors[n_rows : self.n_rows], centroids)]
+            )
+            self._rows["list"][: self.n_rows] = labels
+            self._flush()
+            tmp = os.path.join(self.path, "centroids.tmp.npy")
+            np.save(tmp, centroids)
+            os.replace(tmp, os.path.join(self.path, "centroids.npy"))
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('trained', ?)", (self.n_rows,)
+            )
+            self._db.commit()
+            self.n_trained = self.n_rows
+            self.centroids = centroids
+            self._lists = self._build_lists()
+
+    def _filter(
+        self,
+        rows: np.ndarray,
+        channels: Optional[Collection[str]],
+        oldest: Optional[float],
+        latest: Optional[float],
+    ) -> np.ndarray:
+        mask = rows["alive"] == 1
+        if channels is not None:
+            codes = [self.channel_codes[c] for c in channels if c in self.channel_codes]
+            mask &= np.isin(rows["channel"], codes)
+        if oldest is not None:
+            mask &= rows["ts"] >= oldest
+        if latest is not None:
+            mask &= rows["ts"] <= latest
+        return mask
+
+    def _probe(self, query: np.ndarray, k: int, **filters) -> np.ndarray:
+        """Candidate rows from the lists closest to `query`"""
+        assert self.centroids is not None
+        order = np.argsort(-(self.centroids @ query))
+        nprobe = min(self.nprobe, self.nlist)
+        while True:
+            candidates = np.concatenate([self._lists[i] for i in order[:nprobe]])
+            candidates = candidates[self._filter(self._rows[candidates], **filters)]
+            # Probe more lists when the filters leave too few candidates
+            if len(candidates) >= k or nprobe >= self.nlist:
+                return candidates
+            nprobe = min(nprobe * 2, self.nlist)
+
+    @timed("message_index.search")
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        channels: Optional[Collection[str]] = None,
+        oldest: Optional[float] = None,
+        latest: Optional[float] = None,
+    ) -> list[SearchResult]:
+        """The `k` messages most similar to `query`, optionally in `channels` and
+        between the timestamps `oldest` and `latest`"""
+        query = normalize(query)
+        filters = dict(channels=channels, oldest=oldest, latest=latest)
+        with self._lock:
+            if not self.n_rows or k <= 0:
+                return []
+            candidates = None
+            if self.centroids is None or any(v is not None for v in filters.values()):
+                # A selective filter is faster to search exactly than through lists
+                mask = self._filter(self._rows[: self.n_rows], **filters)
+                if self.centroids is None or mask.sum() <= self.exact_limit:
+                    candidates = np.flatnonzero(mask)
+            if candidates is None:
+                candidates = self._probe(query, k, **filters)
+            if not len(candidates):
+                return []
+            scores = self._vectors[candidates] @ query
+            if k < len(candidates):
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(candidates))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            rows = [int(candidates[i]) for i in top]
+            placeholders = ",".join("?" * len(rows))
+            found = {
+                row: (channel, ts, user, text)
+                for row, channel, ts, user, text in self._db.execute(
+                    "SELECT row, channel, ts, user, text FROM messages "
+                    f"WHERE row IN ({placeholders})",
+                    rows,
+                )
+            }
+        return [
+            SearchResult(*found[row], score=float(scores[i]))
+            for row, i in zip(rows, top)
+            if row in found
+        ]
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
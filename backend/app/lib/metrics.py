@@ -0,0 +1,271 @@
+# Instrumentation of the hot paths, exposed in the Prometheus text format on /metrics.
+# Commands, services, OpenAI client methods and Slack Web API calls are timed as
+# spans of the histogram `openai_bot_span_seconds`, labelled with the span and the
+# command of the job, and the token usage of OpenAI is counted per command and
+# model. With METRICS_ENABLED=0 a span is a shared no-op context manager and a timed
+# function costs one attribute lookup per call.
+
+import bisect
+import contextvars
+import functools
+import inspect
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Iterator, Mapping, Optional, Sequence, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Seconds; webqa and image generation take tens of seconds
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+current_command: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_command", default=""
+)
+
+
+@contextmanager
+def command_label(command: str) -> Iterator[None]:
+    """Label the spans and the token usage in the block with `command`"""
+    token = current_command.set(command)
+    try:
+        yield
+    finally:
+        current_command.reset(token)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return f"{{{pairs}}}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(tuple(labels[n] for n in self.labelnames), 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the count of each bucket (not cumulative, the last one
+        # is +Inf), the sum and the count
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[n] for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][i] += 1
+            entry[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(tuple(labels[n] for n in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((k, (list(c), s[0])) for k, (c, s) in self._values.items())
+        names = (*self.labelnames, "le")
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                labels = _format_labels(names, (*key, _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Registry:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.spans = Histogram(
+            "openai_bot_span_seconds",
+            "Latency of commands, services, OpenAI and Slack API calls",
+            ("span", "command"),
+        )
+        self.errors = Counter(
+            "openai_bot_span_errors_total",
+            "Spans that raised an exception",
+            ("span", "command"),
+        )
+        self.tokens = Counter(
+            "openai_bot_openai_tokens_total",
+            "Tokens used by the OpenAI API",
+            ("command", "model", "type"),
+        )
+
+    @classmethod
+    def from_env(cls) -> "Registry":
+        return cls(enabled=os.getenv("METRICS_ENABLED", "1") not in ("0", "false"))
+
+    @property
+    def collectors(self) -> list[Any]:
+        return [self.spans, self.errors, self.tokens]
+
+    def observe(self, span: str, seconds: float, error: bool = False):
+        command = current_command.get()
+        self.spans.observe(seconds, span=span, command=command)
+        if error:
+            self.errors.inc(span=span, command=command)
+
+    def record_tokens(self, model: str, usage: Optional[Mapping[str, Any]]):
+        if not self.enabled or not usage:
+            return
+        command = current_command.get()
+        for type in ("prompt", "completion"):
+            n_tokens = usage.get(f"{type}_tokens")
+            if n_tokens:
+                self.tokens.inc(n_tokens, command=command, model=model, type=type)
+
+    def render(self) -> str:
+        lines = [line for c in self.collectors for line in c.render()]
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for collector in self.collectors:
+            collector.clear()
+
+
+class Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        registry.observe(self.name, elapsed, error=exc_type is not None)
+
+
+_NULL_SPAN = nullcontext()
+
+
+def span(name: str):
+    """Time the block as the span `name`"""
+    if not registry.enabled:
+        return _NULL_SPAN
+    return Span(name)
+
+
+def timed(name: Optional[str] = None) -> Callable[[F], F]:
+    """Time each call of the decorated function, by default as its qualified name
+
+    Coroutine functions are timed until they return and generator functions until
+    they are exhausted.
+    """
+
+    def decorator(fn: F) -> F:
+        span_name = name or fn.__qualname__
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not registry.enabled:
+                    return await fn(*args, **kwargs)
+                with Span(span_name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper  # type: ignore
+
+        if inspect.isgeneratorfunction(fn):
+
+            @functools.wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                if not registry.enabled:
+                    return (yield from fn(*args, **kwargs))
+                with Span(span_name):
+                    return (yield from fn(*args, **kwargs))
+
+            return generator_wrapper  # type: ignore
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return fn(*args, **kwargs)
+            with Span(span_name):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+registry = Registry.from_env()
@@ -1,148 +1,331 @@
+# Sync OpenAI client.
+# openai takes about half a second to import, so it is imported on first use (or
+# by the startup warm-up) rather than when the app is loaded. numpy is not
+# deferred: the embedding cache and the indexes load it with the app anyway.
+
 import base64
+import io
 import os
-import tempfile
-
-import numpy as np
-import openai
-import spacy
-import tiktoken
-from openai.embeddings_utils import distances_from_embeddings
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterator, NamedTuple, Optional
 
+from .embedding_cache import embedding_cache, text_key
+from .metrics import registry, timed
+from .ratelimit import rate_limits
+from .retrieval import EmbeddingIndex, index_cache
+from .segmenter import split_sentences
+from .tokenizer import count_tokens
 from .util import crop_and_resize_image
 
+if TYPE_CHECKING:
+    import numpy as np
+
+COMPLETION_MODEL = "text-davinci-003"
+TEXT_EDIT_MODEL = "text-davinci-edit-001"
+CODE_MODEL = "code-davinci-002"
+CODE_EDIT_MODEL = "code-davinci-edit-001"
+COMPLETION_TEMPERATURE = 0.9
+EMBEDDING_MODEL = "text-embedding-ada-002"
 MAX_EMBEDDING_TOKENS = 8191
 MAX_COMPLETION_TOKENS = 4097
+# Limits of a single embedding request
+MAX_EMBEDDING_BATCH_INPUTS = 2048
+MAX_EMBEDDING_BATCH_TOKENS = 8191 * 8
+EMBEDDING_CONCURRENCY = 4
+
+
+class Chunk(NamedTuple):
+    text: str
+    # Sum of the token counts of the sentences in the chunk
+    n_tokens: int
 
 
 class OpenAIClient:
     def __init__(self):
+        import openai
+
         openai.organization = os.getenv("OPENAI_ORGANIZATION")
         openai.api_key = os.getenv("OPENAI_API_KEY")
 
+    @timed()
     def get_text_completion(
-        self, prompt: str, model: str = "text-davinci-003", max_tokens: int = 3000
+        self, prompt: str, model: str = COMPLETION_MODEL, max_tokens: int = 3000
     ) -> str:
-        resp = openai.Completion.create(
-            model=model, prompt=prompt, max_tokens=max_tokens, temperature=0.9
+        import openai
+
+        resp = rate_limits.call(
+            f"openai:{model}",
+            lambda: openai.Completion.create(
+                model=model,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=COMPLETION_TEMPERATURE,
+            ),
         )
+        registry.record_tokens(model, resp.get("usage"))
         text = resp.choices[0].text
         return text
 
+    @timed()
+    def stream_text_completion(
+        self,
+        prompt: str,
+        model: str = COMPLETION_MODEL,
+        max_tokens: int = 3000,
+        temperature: float = COMPLETION_TEMPERATURE,
+    ) -> Iterator[str]:
+        import openai
+
+        resp = rate_limits.call(
+            f"openai:{model}",
+            lambda: openai.Completion.create(
+                model=model,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+            ),
+        )
+        # Streamed completions have no usage, and every event is one token
+        n_events = 0
+        for chunk in resp:
+            n_events += 1
+            text = chunk.choices[0].text
+            if text:
+                yield text
+        if registry.enabled:
+            usage = {
+                "prompt_tokens": count_tokens(prompt, model),
+                "completion_tokens": n_events,
+            }
+            registry.record_tokens(model, usage)
+
+    @timed()
     def get_text_edit(
-        self, input: str, instruction: str, model: str = "text-davinci-edit-001"
+        self, input: str, instruction: str, model: str = TEXT_EDIT_MODEL
     ) -> str:
-        resp = openai.Edit.create(
-            model=model,
-            input=input,
-            instruction=instruction,
+        import openai
+
+        resp = rate_limits.call(
+            f"openai:{model}",
+            lambda: openai.Edit.create(
+                model=model,
+                input=input,
+                instruction=instruction,
+            ),
         )
+        registry.record_tokens(model, resp.get("usage"))
         text = resp.choices[0].text
         return text
 
+    @timed()
     def get_text_insertion(
         self,
         prompt: str,
         suffix: str,
-        model: str = "text-davinci-003",
+        model: str = COMPLETION_MODEL,
         max_tokens: int = 3000,
     ) -> str:
-        resp = openai.Completion.create(
-            model=model,
-            prompt=prompt,
-            suffix=suffix,
-            max_tokens=max_tokens,
-            temperature=0.9,
+        import openai
+
+        resp = rate_limits.call(
+            f"openai:{model}",
+            lambda: openai.Completion.create(
+                model=model,
+                prompt=prompt,
+                suffix=suffix,
+                max_tokens=max_tokens,
+                temperature=COMPLETION_TEMPERATURE,
+            ),
         )
+        registry.record_tokens(model, resp.get("usage"))
         text = resp.choices[0].text
         return text
 
+    @timed()
     def get_code_completion(self, prompt: str) -> str:
-        return self.get_text_completion(prompt, model="code-davinci-002")
+        return self.get_text_completion(prompt, model=CODE_MODEL)
 
+    @timed()
     def get_code_edit(self, input: str, instruction: str) -> str:
-        return self.get_text_edit(input, instruction, model="code-davinci-edit-001")
+        return self.get_text_edit(input, instruction, model=CODE_EDIT_MODEL)
 
+    @timed()
     def get_code_insertion(self, prompt: str, suffix: str) -> str:
-        return self.get_text_insertion(prompt, suffix, model="code-davinci-002")
+        return self.get_text_insertion(prompt, suffix, model=CODE_MODEL)
 
+    @timed()
     def get_image(self, prompt: str) -> list[bytes]:
-        resp = openai.Image.create(
-            prompt=prompt, n=3, size="512x512", response_format="b64_json"
+        import openai
+
+        resp = rate_limits.call(
+            "openai:images",
+            lambda: openai.Image.create(
+                prompt=prompt, n=3, size="512x512", response_format="b64_json"
+            ),
         )
         images = [base64.b64decode(img.b64_json) for img in resp.data]
         return images
 
-    def get_image_variation(self, image_file: str) -> list[bytes]:
+    @timed()
+    def get_image_variation(self, image: bytes) -> list[bytes]:
+        import openai
+
         # Only square PNG up to 4MB is accepted by OpenAI
-        _, resized_file = tempfile.mkstemp(suffix=".png")
-        crop_and_resize_image(image_file, resized_file, size=(512, 512), format="png")
-        resp = openai.Image.create_variation(
-            image=open(resized_file, "rb"),
-            n=3,
-            size="512x512",
-            response_format="b64_json",
+        resized = io.BytesIO()
+        crop_and_resize_image(io.BytesIO(image), resized, size=(512, 512), format="png")
+        resp = rate_limits.call(
+            "openai:images",
+            lambda: openai.Image.create_variation(
+                image=resized.getvalue(),
+                n=3,
+                size="512x512",
+                response_format="b64_json",
+            ),
         )
-        os.remove(resized_file)
         images = [base64.b64decode(img.b64_json) for img in resp.data]
         return images
 
-    def get_text_embedding(self, input: str) -> np.ndarray:
-        resp = openai.Embedding.create(input=input, model="text-embedding-ada-002")
-        emb = np.array(resp.data[0].embedding)
+    @timed()
+    def get_text_embedding(self, input: str) -> "np.ndarray":
+        import numpy as np
+        import openai
+
+        emb = embedding_cache.get(EMBEDDING_MODEL, input)
+        if emb is None:
+            resp = rate_limits.call(
+                f"openai:{EMBEDDING_MODEL}",
+                lambda: openai.Embedding.create(input=input, model=EMBEDDING_MODEL),
+            )
+            registry.record_tokens(EMBEDDING_MODEL, resp.get("usage"))
+            emb = np.array(resp.data[0].embedding, dtype=np.float32)
+            embedding_cache.put(EMBEDDING_MODEL, input, emb)
         return emb
 
+    @timed()
+    def get_text_embeddings(
+        self,
+        inputs: list[str],
+        max_batch_inputs: int = MAX_EMBEDDING_BATCH_INPUTS,
+        max_batch_tokens: int = MAX_EMBEDDING_BATCH_TOKENS,
+        max_workers: int = EMBEDDING_CONCURRENCY,
+        n_tokens_list: Optional[list[int]] = None,
+    ) -> list["np.ndarray"]:
+        import numpy as np
+        import openai
+
+        cached = embedding_cache.get_many(EMBEDDING_MODEL, inputs)
+        misses = list(dict.fromkeys(t for t, e in zip(inputs, cached) if e is None))
+        if not misses:
+            return cached  # type: ignore
+
+        if n_tokens_list is not None:
+            known = dict(zip(inputs, n_tokens_list))
+            n_tokens_list = [known[t] for t in misses]
+        else:
+            n_tokens_list = [count_tokens(t, EMBEDDING_MODEL) for t in misses]
+        batches = _pack_batches(n_tokens_list, max_batch_inputs, max_batch_tokens)
+
+        def embed(batch: list[int]) -> list["np.ndarray"]:
+            resp = rate_limits.call(
+                f"openai:{EMBEDDING_MODEL}",
+                lambda: openai.Embedding.create(
+                    input=[misses[i] for i in batch], model=EMBEDDING_MODEL
+                ),
+            )
+            registry.record_tokens(EMBEDDING_MODEL, resp.get("usage"))
+            data = sorted(resp.data, key=lambda d: d.index)
+            return [np.array(d.embedding, dtype=np.float32) for d in data]
+
+        if len(batches) <= 1:
+            results = [embed(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(embed, batches))
+        embs = [emb for batch_embs in results for emb in batch_embs]
+        embedding_cache.put_many(EMBEDDING_MODEL, misses, embs)
+        new = dict(zip(misses, embs))
+        return [new[t] if e is None else e for t, e in zip(inputs, cached)]
+
+    @timed()
     def answer_question_on_text(self, text: str, question: str, max_ctx_len=1800):
-        tokenizer = tiktoken.encoding_for_model("text-davinci-003")
         context = self._create_context(question, text, max_ctx_len=max_ctx_len)
-        prompt = (
-            "以下の文脈に基づいて質問に回答してください。"
-            "もしこの文脈からは質問への回答が不明な場合、「わかりません」と回答してください。"
-            f"\n\n文脈：{context}\n\n---\n\n質問：{question}\n回答："
-        )
-        max_tokens = MAX_COMPLETION_TOKENS - len(tokenizer.encode(prompt))
+        prompt = answer_prompt(context, question)
+        max_tokens = MAX_COMPLETION_TOKENS - count_tokens(prompt, COMPLETION_MODEL)
         answer = self.get_text_completion(prompt, max_tokens=max_tokens)
         return answer
 
     def _create_context(self, question: str, text: str, max_ctx_len: int = 1800) -> str:
-        tokenizer = tiktoken.encoding_for_model("text-embedding-ada-002")
         q_emb = self.get_text_embedding(question)
-        text_list = self._split_text(text)
-        n_tokens_list = [len(tokenizer.encode(t)) for t in text_list]
-        t_emb_list = [self.get_text_embedding(t) for t in text_list]
-        distances = distances_from_embeddings(
-            q_emb, t_emb_list, distance_metric="cosine"
+        index = index_cache.get_or_build(
+            f"{EMBEDDING_MODEL}:{text_key(text)}", lambda: self._build_index(text)
         )
-        text_and_dist_list = [
-            (t, n, d) for t, n, d in zip(text_list, n_tokens_list, distances)
-        ]
-        returns = []
-        cur_ctx_len = 0
-        for text, n_tokens, dist in sorted(text_and_dist_list, key=lambda x: x[2]):
-            cur_ctx_len += n_tokens + 4
-            if cur_ctx_len > max_ctx_len:
-                break
-            returns.append(text)
-        return "\n\n###\n\n".join(returns)
-
-    def _split_text(self, text: str, max_tokens: int = 500) -> list[str]:
-        max_tokens = min(max_tokens, MAX_EMBEDDING_TOKENS)
-        tokenizer = tiktoken.encoding_for_model("text-embedding-ada-002")
-        nlp = spacy.load("ja_ginza")
-        sentences = [str(sent) for sent in nlp(text).sents]
-        n_tokens_list = [len(tokenizer.encode(sentence)) for sentence in sentences]
-        chunks = []
-        n_tokens_so_far = 0
-        chunk: list[str] = []
-        for sentence, n_tokens in zip(sentences, n_tokens_list):
-            if n_tokens_so_far + n_tokens > max_tokens:
-                joined = "".join(chunk).strip()
-                if joined:
-                    chunks.append(joined)
-                chunk = []
-                n_tokens_so_far = 0
-            if n_tokens > max_tokens:
-                # TODO: better handling of long sentences
-                continue
-            chunk.append(sentence)
-            n_tokens_so_far += n_tokens
-        return chunks
+        return "\n\n###\n\n".join(index.select(q_emb, max_ctx_len))
+
+    def _build_index(self, text: str) -> EmbeddingIndex:
+        chunks = self._split_text(text)
+        text_list = [c.text for c in chunks]
+        n_tokens_list = [c.n_tokens for c in chunks]
+        t_emb_list = self.get_text_embeddings(text_list, n_tokens_list=n_tokens_list)
+        return EmbeddingIndex(text_list, n_tokens_list, t_emb_list)
+
+    def _split_text(self, text: str, max_tokens: int = 500) -> list[Chunk]:
+        return split_text(text, max_tokens)
+
+
+def answer_prompt(context: str, question: str) -> str:
+    return (
+        "以下の文脈に基づいて質問に回答してください。"
+        "もしこの文脈からは質問への回答が不明な場合、「わかりません」と回答してください。"
+        f"\n\n文脈：{context}\n\n---\n\n質問：{question}\n回答："
+    )
+
+
+def split_text(text: str, max_tokens: int = 500) -> list[Chunk]:
+    """Pack the sentences of `text` into chunks of at most `max_tokens`"""
+    max_tokens = min(max_tokens, MAX_EMBEDDING_TOKENS)
+    sentences = split_sentences(text)
+    n_tokens_list = [count_tokens(s, EMBEDDING_MODEL) for s in sentences]
+    chunks = []
+    n_tokens_so_far = 0
+    chunk: list[str] = []
+
+    def flush():
+        joined = "".join(chunk).strip()
+        if joined:
+            chunks.append(Chunk(joined, n_tokens_so_far))
+
+    for sentence, n_tokens in zip(sentences, n_tokens_list):
+        if n_tokens_so_far + n_tokens > max_tokens:
+            flush()
+            chunk = []
+            n_tokens_so_far = 0
+        if n_tokens > max_tokens:
+            # TODO: better handling of long sentences
+            continue
+        chunk.append(sentence)
+        n_tokens_so_far += n_tokens
+    flush()
+    return chunks
+
+
+def _pack_batches(
+    n_tokens_list: list[int], max_batch_inputs: int, max_batch_tokens: int
+) -> list[list[int]]:
+    """Greedily pack consecutive input indices into batches within the limits"""
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    n_tokens_so_far = 0
+    for i, n_tokens in enumerate(n_tokens_list):
+        if batch and (
+            len(batch) >= max_batch_inputs
+            or n_tokens_so_far + n_tokens > max_batch_tokens
+        ):
+            batches.append(batch)
+            batch = []
+            n_tokens_so_far = 0
+        batch.append(i)
+        n_tokens_so_far += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
@@ -0,0 +1,157 @@
+# Cache of the pages fetched by webqa.
+# The raw HTML is kept with its extracted text and validators. Within
+# PAGE_CACHE_FRESH_FOR seconds a page is used as is, and after that it is
+# revalidated with a conditional GET (If-None-Match / If-Modified-Since). A 304 keeps
+# the text, and therefore the index of its chunk embeddings, so that a follow-up
+# question on the same page costs one embedding and one completion call.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_FRESH_FOR = 60.0
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+@dataclass
+class FetchedPage:
+    status: int
+    html: bytes = b""
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+@dataclass
+class CachedPage:
+    html: bytes
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # Set once the page has been extracted
+    text: Optional[str] = None
+    validated_at: float = field(default_factory=time.time)
+    stored_at: float = field(default_factory=time.time)
+
+    @property
+    def size(self) -> int:
+        # Japanese text is mostly 3 bytes a character in UTF-8
+        return len(self.html) + len(self.text or "") * 3
+
+    def conditional_headers(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+@dataclass
+class PageCacheStats:
+    # Served without a request
+    hits: int = 0
+    # Answered with 304 Not Modified
+    revalidated: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def to_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+Fetch = Callable[[str, dict[str, str]], Awaitable[FetchedPage]]
+
+
+class PageCache:
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        fresh_for: float = DEFAULT_FRESH_FOR,
+        max_age: float = DEFAULT_MAX_AGE,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.max_age = max_age
+        self.stats = PageCacheStats()
+        self._lock = threading.Lock()
+        self._pages: OrderedDict[str, CachedPage] = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "PageCache":
+        return cls(
+            max_entries=int(os.getenv("PAGE_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+            max_bytes=int(os.getenv("PAGE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            fresh_for=float(os.getenv("PAGE_CACHE_FRESH_FOR", DEFAULT_FRESH_FOR)),
+            max_age=float(os.getenv("PAGE_CACHE_MAX_AGE", DEFAULT_MAX_AGE)),
+        )
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        with self._lock:
+            page = self._pages.get(url)
+            if page is None:
+                return None
+            if page.stored_at + self.max_age < time.time():
+                del self._pages[url]
+                return None
+            self._pages.move_to_end(url)
+            return page
+
+    def put(self, url: str, page: CachedPage):
+        with self._lock:
+            self._pages[url] = page
+            self._pages.move_to_end(url)
+            self._evict()
+
+    def set_text(self, page: CachedPage, text: Optional[str]):
+        with self._lock:
+            page.text = text
+            self._evict()
+
+    async def fetch(self, url: str, fetch: Fetch) -> CachedPage:
+        """The page at `url`, fetched with `fetch` unless the cached one is fresh"""
+        cached = self.get(url)
+        if cached is not None and time.time() - cached.validated_at < self.fresh_for:
+            with self._lock:
+                self.stats.hits += 1
+            return cached
+
+        headers = cached.conditional_headers() if cached is not None else {}
+        resp = await fetch(url, headers)
+        if resp.status == 304 and cached is not None:
+            with self._lock:
+                cached.validated_at = time.time()
+                self.stats.revalidated += 1
+            return cached
+
+        with self._lock:
+            self.stats.misses += 1
+        page = CachedPage(resp.html, resp.etag, resp.last_modified)
+        self.put(url, page)
+        return page
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            size = sum(page.size for page in self._pages.values())
+            return {**self.stats.to_dict(), "pages": len(self._pages), "bytes": size}
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def _evict(self):
+        size = sum(page.size for page in self._pages.values())
+        while self._pages and (
+            len(self._pages) > self.max_entries or size > self.max_bytes
+        ):
+            _, page = self._pages.popitem(last=False)
+            size -= page.size
+            self.stats.evictions += 1
+
+
+page_cache = PageCache.from_env()
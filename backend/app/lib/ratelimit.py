@@ -0,0 +1,424 @@
+# Client-side rate limiting and retries for OpenAI and Slack API calls.
+# Each model or Slack method gets a token bucket whose waiters are served by priority,
+# so that interactive chat replies go before bulk summarisation. A 429 pauses the
+# whole bucket for `Retry-After` (or the `x-ratelimit-reset-*` headers) instead of
+# letting every caller find out by itself, and retries back off with full jitter
+# within a retry budget, so that an outage is not multiplied by the retries.
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Iterator, Mapping, Optional, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+
+current_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "current_priority", default=PRIORITY_DEFAULT
+)
+
+# Requests per minute. OpenAI limits depend on the account, so override them with
+# RATE_LIMITS, e.g. `openai:text-davinci-003=3000,slack:chat.update=50`
+DEFAULT_RATE_LIMITS = {
+    "openai:default": 3000.0,
+    "openai:images": 50.0,
+    "slack:default": 50.0,  # Tier 3
+    "slack:chat.postMessage": 60.0,  # per channel
+    "slack:chat.update": 50.0,
+    "slack:conversations.replies": 50.0,
+    "slack:search.messages": 20.0,  # Tier 2
+    "slack:files.getUploadURLExternal": 100.0,  # Tier 4
+    "slack:files.completeUploadExternal": 100.0,
+}
+# Seconds worth of requests that can be sent at once
+DEFAULT_BURST = 2.0
+
+
+@contextmanager
+def priority(level: int) -> Iterator[None]:
+    """Run the API calls in the block with the priority `level`"""
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RateLimiter:
+    """Token bucket whose waiters are served in the order of their priority"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._waiters: list[tuple[int, int]] = []
+        # Futures that async waiters wait on, by their entry in `_waiters`
+        self._wakeups: dict[
+            tuple[int, int], tuple[asyncio.AbstractEventLoop, asyncio.Future]
+        ] = {}
+        self._seq = itertools.count()
+
+    def acquire(self, priority: int = PRIORITY_DEFAULT, cost: float = 1.0) -> float:
+        """Wait for `cost` tokens and return how long it took"""
+        start = time.monotonic()
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    timeout = self._take(entry, cost)
+                    if timeout == 0:
+                        return time.monotonic() - start
+                    self._cond.wait(timeout)
+            except BaseException:
+                self._remove(entry)
+                raise
+
+    def try_acquire(self, cost: float = 1.0) -> bool:
+        """Take `cost` tokens if nobody is waiting and they are available now"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            if self._waiters or now < self._paused_until or self._level < cost:
+                return False
+            self._level -= cost
+            return True
+
+    async def acquire_async(
+        self, priority: int = PRIORITY_DEFAULT, cost: float = 1.0
+    ) -> float:
+        """`acquire` waiting on the event loop rather than on a thread"""
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                with self._cond:
+                    timeout = self._take(entry, cost)
+                    if timeout == 0:
+                        return time.monotonic() - start
+                    wakeup = loop.create_future()
+                    self._wakeups[entry] = (loop, wakeup)
+                await asyncio.wait({wakeup}, timeout=timeout)
+                with self._cond:
+                    self._wakeups.pop(entry, None)
+        except BaseException:
+            with self._cond:
+                self._wakeups.pop(entry, None)
+                self._remove(entry)
+            raise
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds`, e.g. after a 429"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._level = 0.0
+            self._notify()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _take(self, entry: tuple[int, int], cost: float) -> Optional[float]:
+        """Take `cost` tokens for `entry` and return 0, or how long to wait before
+        trying again, None meaning until notified. Called with the lock held."""
+        now = time.monotonic()
+        self._refill(now)
+        if self._waiters[0] != entry:
+            return None
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._level < cost:
+            return (cost - self._level) / self.rate
+        heapq.heappop(self._waiters)
+        self._level -= cost
+        self._notify()
+        return 0
+
+    def _remove(self, entry: tuple[int, int]):
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            self._notify()
+
+    def _notify(self):
+        """Let the waiter at the head of the queue check the bucket again"""
+        self._cond.notify_all()
+        if self._waiters and self._waiters[0] in self._wakeups:
+            loop, wakeup = self._wakeups.pop(self._waiters[0])
+            try:
+                loop.call_soon_threadsafe(_wake, wakeup)
+            except RuntimeError:
+                # The loop was closed and its waiter is gone with it
+                pass
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            elapsed = now - max(self._updated, self._paused_until)
+            if elapsed > 0:
+                self._level = min(self.capacity, self._level + elapsed * self.rate)
+            self._updated = now
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RetryBudget:
+    """Allow retries for at most `ratio` of the calls, plus a small reserve"""
+
+    def __init__(self, ratio: float = 0.2, reserve: float = 20.0):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+@dataclass
+class RateLimitStats:
+    calls: int = 0
+    throttled: int = 0
+    throttled_seconds: float = 0.0
+    rate_limited: int = 0
+    retries: int = 0
+    budget_exhausted: int = 0
+    failures: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+def parse_limits(spec: str) -> dict[str, float]:
+    """Parse `key=requests per minute` pairs separated by commas"""
+    limits = {}
+    for item in spec.split(","):
+        if item.strip():
+            key, limit = item.rsplit("=", 1)
+            limits[key.strip()] = float(limit)
+    return limits
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse `Retry-After` seconds or `x-ratelimit-reset-*` values such as `6m0s`"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    match = re.fullmatch(
+        r"(?:(\d+)h)?(?:(\d+)m(?!s))?(?:([\d.]+)s)?(?:(\d+)ms)?", value
+    )
+    if not match or not any(match.groups()):
+        return None
+    h, m, s, ms = match.groups()
+    return int(h or 0) * 3600 + int(m or 0) * 60 + float(s or 0) + int(ms or 0) / 1000
+
+
+def retry_after(headers: Optional[Mapping[str, Any]]) -> Optional[float]:
+    """Seconds to wait according to the headers of a rate limited response"""
+    if not headers:
+        return None
+    lower = {k.lower(): v for k, v in headers.items()}
+    if "retry-after" in lower:
+        value = lower["retry-after"]
+        # slack_sdk passes the header values as lists
+        return parse_duration(value[0] if isinstance(value, list) else str(value))
+    resets = []
+    for kind in ("requests", "tokens"):
+        remaining = lower.get(f"x-ratelimit-remaining-{kind}")
+        reset = lower.get(f"x-ratelimit-reset-{kind}")
+        if remaining is not None and reset is not None and int(remaining) == 0:
+            resets.append(parse_duration(str(reset)))
+    return max((r for r in resets if r is not None), default=None)
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Full jitter exponential backoff"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def is_retryable(e: Exception) -> bool:
+    import openai
+
+    if isinstance(e, openai.error.RateLimitError):
+        # Not a rate limit but the end of the credit
+        return getattr(e, "code", None) != "insufficient_quota"
+    if isinstance(
+        e,
+        (
+            openai.error.ServiceUnavailableError,
+            openai.error.APIConnectionError,
+            openai.error.Timeout,
+            openai.error.TryAgain,
+        ),
+    ):
+        return True
+    if isinstance(e, openai.error.APIError):
+        return (e.http_status or 0) >= 500
+    return False
+
+
+class RateLimits:
+    def __init__(
+        self,
+        limits: Optional[dict[str, float]] = None,
+        burst: float = DEFAULT_BURST,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        budget: Optional[RetryBudget] = None,
+    ):
+        self.limits = {**DEFAULT_RATE_LIMITS, **(limits or {})}
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.stats = RateLimitStats()
+        self._lock = threading.Lock()
+        self._limiters: dict[str, RateLimiter] = {}
+
+    @classmethod
+    def from_env(cls) -> "RateLimits":
+        return cls(
+            limits=parse_limits(os.getenv("RATE_LIMITS", "")),
+            max_attempts=int(os.getenv("RATE_LIMIT_MAX_ATTEMPTS", 4)),
+        )
+
+    def limiter(self, key: str) -> RateLimiter:
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(key)
+                if limiter is None:
+                    rate = self._per_minute(key) / 60
+                    limiter = RateLimiter(rate, max(1.0, rate * self.burst))
+                    self._limiters[key] = limiter
+        return limiter
+
+    def _per_minute(self, key: str) -> float:
+        # `slack:chat.postMessage:C123` falls back to `slack:chat.postMessage`, then
+        # to `slack:default`
+        parts = key.split(":")
+        for i in range(len(parts), 1, -1):
+            prefix = ":".join(parts[:i])
+            if prefix in self.limits:
+                return self.limits[prefix]
+        return self.limits.get(f"{parts[0]}:default", 60.0)
+
+    def acquire(self, key: str) -> float:
+        waited = self.limiter(key).acquire(current_priority.get())
+        self._record_wait(waited)
+        return waited
+
+    def backoff_after(self, key: str, attempt: int, e: Exception) -> Optional[float]:
+        """Seconds to wait before retrying after `e`, or None to give up"""
+        delay = retry_after(getattr(e, "headers", None))
+        if getattr(e, "http_status", None) == 429:
+            self.record_rate_limited()
+        if delay is not None:
+            # Everyone else using the same bucket would be rejected as well
+            self.limiter(key).pause(delay)
+        if attempt + 1 >= self.max_attempts or not self.allow_retry():
+            return None
+        return max(delay or 0.0, backoff(attempt, self.base_delay, self.max_delay))
+
+    def allow_retry(self) -> bool:
+        """Take a retry from the budget"""
+        allowed = self.budget.withdraw()
+        with self._lock:
+            if allowed:
+                self.stats.retries += 1
+            else:
+                self.stats.budget_exhausted += 1
+        return allowed
+
+    def record_rate_limited(self):
+        with self._lock:
+            self.stats.rate_limited += 1
+
+    def call(self, key: str, fn: Callable[[], T]) -> T:
+        """Call `fn` within the rate limit of `key`, retrying transient errors"""
+        self._record_call()
+        for attempt in itertools.count():
+            self.acquire(key)
+            try:
+                return fn()
+            except Exception as e:
+                delay = self.backoff_after(key, attempt, e) if is_retryable(e) else None
+                if delay is None:
+                    self._record_failure()
+                    raise
+                logger.warning(f"Retrying in {delay:.2f}s: {key=}, {attempt=}, {e=}")
+                time.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def call_async(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        self._record_call()
+        for attempt in itertools.count():
+            limiter = self.limiter(key)
+            self._record_wait(await limiter.acquire_async(current_priority.get()))
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self.backoff_after(key, attempt, e) if is_retryable(e) else None
+                if delay is None:
+                    self._record_failure()
+                    raise
+                logger.warning(f"Retrying in {delay:.2f}s: {key=}, {attempt=}, {e=}")
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    def metrics(self) -> dict[str, Any]:
+        return {
+            **self.stats.to_dict(),
+            "waiting": {k: v.waiting for k, v in self._limiters.items() if v.waiting},
+        }
+
+    def _record_call(self):
+        self.budget.deposit()
+        with self._lock:
+            self.stats.calls += 1
+
+    def _record_wait(self, waited: float):
+        if waited > 0.001:
+            with self._lock:
+                self.stats.throttled += 1
+                self.stats.throttled_seconds += waited
+
+    def _record_failure(self):
+        with self._lock:
+            self.stats.failures += 1
+
+
+rate_limits = RateLimits.from_env()
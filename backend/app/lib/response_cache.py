@@ -0,0 +1,229 @@
+# Opt-in cache of OpenAI responses for deterministic commands.
+# The backend is selected by RESPONSE_CACHE_URL:
+#   memory://            in-process LRU
+#   sqlite:///path/to/db local SQLite file
+#   redis://host:port/0  Redis-compatible server (requires the `redis` package)
+# The cache is disabled when RESPONSE_CACHE_URL is empty.
+
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Optional, Protocol
+
+from loguru import logger
+
+from .tokenizer import count_tokens
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+# USD per 1K tokens of text-davinci-003 and friends
+PRICE_PER_1K_TOKENS = 0.02
+
+
+class Backend(Protocol):
+    def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    def set(self, key: str, value: bytes, ttl: float):
+        ...
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float):
+        with self._lock:
+            self._items[key] = (time.time() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+class SQLiteBackend:
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires_at >= ?",
+                (key, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._db.commit()
+            return row[0]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now),
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key NOT IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+
+class RedisBackend:
+    def __init__(self, url: str, prefix: str = "openai-bot:response:"):
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._redis.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        # Size is bounded by the server's maxmemory policy
+        self._redis.set(self.prefix + key, value, ex=math.ceil(ttl))
+
+
+def create_backend(url: str, max_entries: int = DEFAULT_MAX_ENTRIES) -> Backend:
+    if url.startswith("memory://"):
+        return MemoryBackend(max_entries)
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url.removeprefix("sqlite:///"), max_entries)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unknown response cache backend: {url}")
+
+
+@dataclass
+class ResponseCacheStats:
+    hits: int = 0
+    misses: int = 0
+    errors: int = 0
+    saved_tokens: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def saved_dollars(self) -> float:
+        return self.saved_tokens / 1000 * PRICE_PER_1K_TOKENS
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "hit_ratio": self.hit_ratio,
+            "saved_dollars": self.saved_dollars,
+        }
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n")
+    return "\n".join(line.rstrip() for line in text.strip().splitlines())
+
+
+def make_key(function: str, model: str, args: tuple, temperature: float) -> str:
+    payload = [function, model, [normalize(a) for a in args], temperature]
+    return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, backend: Optional[Backend], ttl: float = DEFAULT_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = ResponseCacheStats()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        url = os.getenv("RESPONSE_CACHE_URL", "")
+        max_entries = int(os.getenv("RESPONSE_CACHE_SIZE", DEFAULT_MAX_ENTRIES))
+        ttl = float(os.getenv("RESPONSE_CACHE_TTL", DEFAULT_TTL))
+        backend = create_backend(url, max_entries) if url else None
+        return cls(backend, ttl=ttl)
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def get_or_call(
+        self,
+        function: str,
+        model: str,
+        args: tuple,
+        temperature: float,
+        call: Callable[[], str],
+        nocache: bool = False,
+    ) -> str:
+        """Return the cached response of `function(*args)` or call and cache it"""
+        if self.backend is None or nocache:
+            return call()
+
+        key = make_key(function, model, args, temperature)
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            logger.exception(f"Failed to read the response cache: {function=}")
+            value = None
+            with self._lock:
+                self.stats.errors += 1
+        if value is not None:
+            reply = value.decode()
+            saved = sum(count_tokens(a, model) for a in args)
+            saved += count_tokens(reply, model)
+            with self._lock:
+                self.stats.hits += 1
+                self.stats.saved_tokens += saved
+            logger.info(f"Response cache hit: {function=}, {saved=} tokens")
+            return reply
+
+        with self._lock:
+            self.stats.misses += 1
+        reply = call()
+        try:
+            self.backend.set(key, reply.encode(), self.ttl)
+        except Exception:
+            logger.exception(f"Failed to write the response cache: {function=}")
+            with self._lock:
+                self.stats.errors += 1
+        return reply
+
+
+response_cache = ResponseCache.from_env()
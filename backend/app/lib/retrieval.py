@@ -0,0 +1,129 @@
+# Vectorised nearest-neighbour retrieval over the chunks of a document.
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+CONTEXT_SEPARATOR_TOKENS = 4
+
+
+def normalize(embs: np.ndarray) -> np.ndarray:
+    embs = np.ascontiguousarray(embs, dtype=np.float32)
+    norms = np.linalg.norm(embs, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embs / norms
+
+
+class EmbeddingIndex:
+    """Chunks of a document and their L2-normalised embeddings in one float32 matrix
+
+    The index does not depend on the question, so it can be reused for every
+    question asked on the same document.
+    """
+
+    def __init__(
+        self,
+        texts: Sequence[str],
+        n_tokens: Sequence[int],
+        embeddings: Sequence[np.ndarray],
+    ):
+        self.texts = list(texts)
+        self.n_tokens = np.asarray(n_tokens, dtype=np.int64)
+        if len(self.texts):
+            self.matrix = normalize(np.stack(embeddings))
+        else:
+            self.matrix = np.empty((0, 0), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @classmethod
+    def concat(cls, indices: Sequence["EmbeddingIndex"]) -> "EmbeddingIndex":
+        """One index over the chunks of several documents"""
+        indices = [index for index in indices if len(index)]
+        if len(indices) == 1:
+            return indices[0]
+        return cls(
+            [text for index in indices for text in index.texts],
+            [n for index in indices for n in index.n_tokens],
+            [emb for index in indices for emb in index.matrix],
+        )
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        """Cosine similarity between `query` and every chunk"""
+        return self.matrix @ normalize(query)
+
+    def top_k(self, query: np.ndarray, k: int) -> np.ndarray:
+        """Indices of the `k` most similar chunks in descending order of similarity"""
+        n = len(self)
+        k = min(k, n)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        scores = self.scores(query)
+        if k < n:
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(n)
+        order = np.argsort(-scores[candidates], kind="stable")
+        return candidates[order]
+
+    def select(self, query: np.ndarray, max_tokens: int) -> list[str]:
+        """The most similar chunks that fit into `max_tokens`
+
+        Chunks are taken in descending order of similarity until the next one
+        does not fit.
+        """
+        if len(self) == 0:
+            return []
+        # No more chunks than this can fit into the budget
+        min_tokens = int(self.n_tokens.min()) + CONTEXT_SEPARATOR_TOKENS
+        k = max_tokens // max(min_tokens, 1) + 1
+        selected = []
+        cur_tokens = 0
+        for i in self.top_k(query, k):
+            cur_tokens += int(self.n_tokens[i]) + CONTEXT_SEPARATOR_TOKENS
+            if cur_tokens > max_tokens:
+                break
+            selected.append(self.texts[i])
+        return selected
+
+
+class IndexCache:
+    """A bounded LRU of document indices"""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._indices: OrderedDict[str, EmbeddingIndex] = OrderedDict()
+
+    def get(self, key: str) -> Optional[EmbeddingIndex]:
+        with self._lock:
+            index = self._indices.get(key)
+            if index is not None:
+                self._indices.move_to_end(key)
+            return index
+
+    def put(self, key: str, index: EmbeddingIndex):
+        with self._lock:
+            self._indices[key] = index
+            self._indices.move_to_end(key)
+            while len(self._indices) > self.max_entries:
+                self._indices.popitem(last=False)
+
+    def get_or_build(
+        self, key: str, build: Callable[[], EmbeddingIndex]
+    ) -> EmbeddingIndex:
+        index = self.get(key)
+        if index is None:
+            index = build()
+            self.put(key, index)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._indices.clear()
+
+
+index_cache = IndexCache()
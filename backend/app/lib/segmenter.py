@@ -0,0 +1,86 @@
+# Process-wide sentence segmenter.
+# Loading GiNZA takes seconds and hundreds of MB, so it is loaded at most once per
+# process and shared by all requests.
+
+import re
+import threading
+from typing import Any, Callable, Optional
+
+from loguru import logger
+
+GINZA_MODEL = "ja_ginza"
+# Sentence boundaries of GiNZA come from the dependency parser, so only the
+# tokenizer, tok2vec and parser are kept.
+GINZA_EXCLUDE = [
+    "attribute_ruler",
+    "ner",
+    "morphologizer",
+    "compound_splitter",
+    "bunsetu_recognizer",
+]
+
+_SENTENCE_END = re.compile(r"(?<=[。．！？!?])(?![。．！？!?」』）)])|(?<=\n)")
+
+Segmenter = Callable[[str], list[str]]
+
+
+def split_sentences_by_rule(text: str) -> list[str]:
+    """Lightweight rule-based Japanese sentence splitter"""
+    return [s for s in _SENTENCE_END.split(text) if s.strip()]
+
+
+class SegmenterRegistry:
+    def __init__(self, model: str = GINZA_MODEL):
+        self.model = model
+        self._lock = threading.Lock()
+        self._nlp_lock = threading.Lock()
+        self._nlp: Optional[Any] = None
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> Segmenter:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._nlp = self._load()
+                    self._loaded = True
+        if self._nlp is None:
+            return split_sentences_by_rule
+        return self._split_with_nlp
+
+    def warmup(self):
+        self.get()("ウォームアップ。")
+
+    def reset(self):
+        with self._lock:
+            self._nlp = None
+            self._loaded = False
+
+    def _load(self) -> Optional[Any]:
+        try:
+            import spacy
+
+            nlp = spacy.load(self.model, exclude=GINZA_EXCLUDE)
+        except Exception:
+            logger.exception(
+                f"Failed to load {self.model}, falling back to rule-based splitter"
+            )
+            return None
+        logger.info(f"Loaded {self.model}: {nlp.pipe_names}")
+        return nlp
+
+    def _split_with_nlp(self, text: str) -> list[str]:
+        # spaCy pipelines are not guaranteed to be thread-safe
+        with self._nlp_lock:
+            doc = self._nlp(text)  # type: ignore
+            return [str(sent) for sent in doc.sents]
+
+
+registry = SegmenterRegistry()
+
+
+def split_sentences(text: str) -> list[str]:
+    return registry.get()(text)
@@ -1,24 +1,43 @@
 # Services are responsible for generating the reply message and additional content (e.g. images).
 # They must be easily testable and shoud not depend on Slack SDK.
+# langchain and trafilatura are imported on first use to keep the cold start short.
 
-import json
-import tempfile
-from typing import Optional, Sequence
+from typing import Iterator, Optional, Sequence
 
-import langchain
-import trafilatura
-from langchain import LLMChain, PromptTemplate
 from loguru import logger
 
-from .openai_client import OpenAIClient
+from .aio import run
+from .async_openai_client import AsyncOpenAIClient
+from .memory import ThreadKey, conversation_memory
+from .metrics import timed
+from .openai_client import (
+    CODE_EDIT_MODEL,
+    CODE_MODEL,
+    COMPLETION_MODEL,
+    COMPLETION_TEMPERATURE,
+    TEXT_EDIT_MODEL,
+    OpenAIClient,
+)
+from .response_cache import response_cache
+from .singleflight import request_key, single_flight
+from .summarizer import MapReduceSummarizer, dedup
+from .webqa import WebQAPipeline
 
 CHAT_PREFIX = """AssistantはOpenAIによって訓練された巨大言語モデル（LLM）です。
 Assistantは様々なタスクを補助できるように設計されています。簡単な質問に答えることはもちろん、色々な話題について深い解説や議論ができます。巨大言語モデルであるAssistantは、受け取った入力に対して人間のような文章を生成することができるので、自然な会話をしたり、目下の話題に沿った一貫性のある反応を返したりすることが可能です。
 つまり、Assistantは様々なタスクの助けになる強力な道具であり、幅広い話題に対して価値ある洞察や情報を提供できます。具体的な質問に答えてほしいときであれ、単に特定の話題について雑談したいときであれ、Assistantはあなたの助けになるために待っています！"""
 # Assistantはつねに学習と改善をし続けており、できることも増え続けています。大量の文章を理解して処理することができますし、その知識を使って色々な質問に対して正確で役立つ回答ができます。さらに、Assistantは入力に対して自分自身で文章を生成することができるので、議論に参加したり、幅広い話題について述べたり説明したりできます。
+CHAT_MAX_TOKENS = 256
+# The edit APIs are called without temperature, i.e. with the API default
+EDIT_TEMPERATURE = 1.0
+CHAT_TEMPERATURE = 0.7
 
 
+@timed()
 def generate_initial_chat(input: str) -> str:
+    import langchain
+    from langchain import LLMChain, PromptTemplate
+
     prompt = PromptTemplate(
         input_variables=["thread"],
         template=f"{CHAT_PREFIX}\n\n" + "{thread}",
@@ -33,20 +52,22 @@ def generate_initial_chat(input: str) -> str:
     return reply
 
 
-def generate_next_chat(messages: list[tuple[str, str]], user: str) -> str:
+@timed()
+def generate_next_chat(
+    thread_key: ThreadKey,
+    messages: list[tuple[str, str]],
+    user: str,
+    bot_user: Optional[str] = None,
+) -> str:
+    import langchain
+    from langchain import LLMChain, PromptTemplate
+
     prompt = PromptTemplate(
         input_variables=["thread"],
         template=f"{CHAT_PREFIX}\n\n" + "{thread}",
     )
     chain = LLMChain(llm=langchain.OpenAI(), prompt=prompt)
-    replies = []
-    for usr, msg in messages[-3:]:  # short memory
-        if usr == user:
-            replies.append(f"人間: {msg}")
-        else:
-            # TODO: usr can be another human user
-            replies.append(f"Assistant: {msg}")
-    thread = "\n".join(replies + ["Assistant: "])
+    thread = conversation_memory.format_thread(thread_key, messages, user, bot_user)
     try:
         reply = chain.run(thread)
     except Exception as e:
@@ -55,11 +76,47 @@ def generate_next_chat(messages: list[tuple[str, str]], user: str) -> str:
     return reply
 
 
-def generate_text_completion(prompt: str) -> str:
+def stream_initial_chat(input: str) -> Iterator[str]:
+    thread = f"人間: {input}\nAssistant: "
+    return _stream_chat(thread)
+
+
+def stream_next_chat(
+    thread_key: ThreadKey,
+    messages: list[tuple[str, str]],
+    user: str,
+    bot_user: Optional[str] = None,
+) -> Iterator[str]:
+    thread = conversation_memory.format_thread(thread_key, messages, user, bot_user)
+    return _stream_chat(thread)
+
+
+@timed("stream_chat")
+def _stream_chat(thread: str) -> Iterator[str]:
     openai = OpenAIClient()
-    reply = ""
+    prompt = f"{CHAT_PREFIX}\n\n{thread}"
     try:
-        completion = openai.get_text_completion(prompt)
+        # Same parameters as langchain.OpenAI() used by the non-streaming chat
+        yield from openai.stream_text_completion(
+            prompt, max_tokens=CHAT_MAX_TOKENS, temperature=CHAT_TEMPERATURE
+        )
+    except Exception as e:
+        logger.exception(f"Failed to stream the text completion: {prompt=}")
+        yield f"\nごめんなさい、文章が書けませんでした！\n```{type(e).__qualname__}: {e}```"
+
+
+@timed()
+def generate_text_completion(prompt: str, nocache: bool = False) -> str:
+    openai = AsyncOpenAIClient()
+    try:
+        completion = response_cache.get_or_call(
+            "generate_text_completion",
+            COMPLETION_MODEL,
+            (prompt,),
+            COMPLETION_TEMPERATURE,
+            lambda: run(openai.get_text_completion(prompt)),
+            nocache=nocache,
+        )
     except Exception as e:
         logger.exception(f"Failed to get the text completion: {prompt=}")
         reply = f"ごめんなさい、文章が書けませんでした！\n```{type(e).__qualname__}: {e}```"
@@ -68,10 +125,18 @@ def generate_text_completion(prompt: str) -> str:
     return reply
 
 
-def generate_text_edit(input: str, instruction: str) -> str:
-    openai = OpenAIClient()
+@timed()
+def generate_text_edit(input: str, instruction: str, nocache: bool = False) -> str:
+    openai = AsyncOpenAIClient()
     try:
-        edit = openai.get_text_edit(input, instruction)
+        edit = response_cache.get_or_call(
+            "generate_text_edit",
+            TEXT_EDIT_MODEL,
+            (input, instruction),
+            EDIT_TEMPERATURE,
+            lambda: run(openai.get_text_edit(input, instruction)),
+            nocache=nocache,
+        )
     except Exception as e:
         logger.exception(f"Failed to get the text edit: {input=}, {instruction=}'")
         reply = f"ごめんなさい、文章を編集できませんでした！\n```{type(e).__qualname__}: {e}```"
@@ -80,10 +145,18 @@ def generate_text_edit(input: str, instruction: str) -> str:
     return reply
 
 
-def generate_text_insertion(prompt: str, suffix: str) -> str:
-    openai = OpenAIClient()
+@timed()
+def generate_text_insertion(prompt: str, suffix: str, nocache: bool = False) -> str:
+    openai = AsyncOpenAIClient()
     try:
-        insertion = openai.get_text_insertion(prompt, suffix)
+        insertion = response_cache.get_or_call(
+            "generate_text_insertion",
+            COMPLETION_MODEL,
+            (prompt, suffix),
+            COMPLETION_TEMPERATURE,
+            lambda: run(openai.get_text_insertion(prompt, suffix)),
+            nocache=nocache,
+        )
     except Exception as e:
         logger.exception(f"Failed to get the text insertion: {prompt=}, {suffix=}")
         reply = f"ごめんなさい、文章を挿入できませんでした！\n```{type(e).__qualname__}: {e}```"
@@ -92,10 +165,18 @@ def generate_text_insertion(prompt: str, suffix: str) -> str:
     return reply
 
 
-def generate_code_completion(prompt: str) -> str:
-    openai = OpenAIClient()
+@timed()
+def generate_code_completion(prompt: str, nocache: bool = False) -> str:
+    openai = AsyncOpenAIClient()
     try:
-        completion = openai.get_code_completion(prompt)
+        completion = response_cache.get_or_call(
+            "generate_code_completion",
+            CODE_MODEL,
+            (prompt,),
+            COMPLETION_TEMPERATURE,
+            lambda: run(openai.get_code_completion(prompt)),
+            nocache=nocache,
+        )
     except Exception as e:
         logger.exception(f"Failed to get the code completion: {prompt=}")
         reply = f"ごめんなさい、コードが書けませんでした！\n```{type(e).__qualname__}: {e}```"
@@ -104,10 +185,18 @@ def generate_code_completion(prompt: str) -> str:
     return reply
 
 
-def generate_code_edit(input: str, instruction: str) -> str:
-    openai = OpenAIClient()
+@timed()
+def generate_code_edit(input: str, instruction: str, nocache: bool = False) -> str:
+    openai = AsyncOpenAIClient()
     try:
-        edit = openai.get_code_edit(input, instruction)
+        edit = response_cache.get_or_call(
+            "generate_code_edit",
+            CODE_EDIT_MODEL,
+            (input, instruction),
+            EDIT_TEMPERATURE,
+            lambda: run(openai.get_code_edit(input, instruction)),
+            nocache=nocache,
+        )
     except Exception as e:
         logger.exception(f"Failed to get the code edit: {input=}, {instruction=}")
         reply = f"ごめんなさい、コードを編集できませんでした！\n```{type(e).__qualname__}: {e}```"
@@ -116,10 +205,18 @@ def generate_code_edit(input: str, instruction: str) -> str:
     return reply
 
 
-def generate_code_insertion(prompt: str, suffix: str) -> str:
-    openai = OpenAIClient()
+@timed()
+def generate_code_insertion(prompt: str, suffix: str, nocache: bool = False) -> str:
+    openai = AsyncOpenAIClient()
     try:
-        insertion = openai.get_code_insertion(prompt, suffix)
+        insertion = response_cache.get_or_call(
+            "generate_code_insertion",
+            CODE_MODEL,
+            (prompt, suffix),
+            COMPLETION_TEMPERATURE,
+            lambda: run(openai.get_code_insertion(prompt, suffix)),
+            nocache=nocache,
+        )
     except Exception as e:
         logger.exception(f"Failed to get the code insertion: {prompt=}, {suffix=}")
         reply = f"ごめんなさい、コードを挿入できませんでした！\n```{type(e).__qualname__}: {e}```"
@@ -128,60 +225,74 @@ def generate_code_insertion(prompt: str, suffix: str) -> str:
     return reply
 
 
-def generate_image(prompt: str) -> tuple[str, Optional[list[str]]]:
-    openai = OpenAIClient()
+@timed()
+def generate_image(prompt: str) -> tuple[str, Optional[list[bytes]]]:
+    openai = AsyncOpenAIClient()
     try:
-        images = openai.get_image(prompt)
+        images = single_flight.do(
+            request_key("generate_image", prompt),
+            lambda: run(openai.get_image(prompt)),
+        )
     except Exception as e:
         logger.exception(f"Failed to get the image: {prompt=}")
         reply = f"ごめんなさい、画像を生成できませんでした！\n```{type(e).__qualname__}: {e}```"
         return reply, None
 
     reply = "画像ができたよ！"
-    image_files = []
-    for image in images:
-        _, image_file = tempfile.mkstemp(suffix=".png")
-        with open(image_file, "wb") as f:
-            f.write(image)
-        image_files.append(image_file)
-    return reply, image_files
+    return reply, images
 
 
-def generate_image_variation(image_file: str) -> tuple[str, Optional[list[str]]]:
-    openai = OpenAIClient()
+@timed()
+def generate_image_variation(image: bytes) -> tuple[str, Optional[list[bytes]]]:
+    openai = AsyncOpenAIClient()
     try:
-        images = openai.get_image_variation(image_file)
+        images = run(openai.get_image_variation(image))
     except Exception as e:
-        logger.exception(f"Failed to get the image variation: {image_file=}")
+        logger.exception(f"Failed to get the image variation: {len(image)=}")
         reply = f"ごめんなさい、画像を生成できませんでした！\n```{type(e).__qualname__}: {e}```"
         return reply, None
 
     reply = "画像ができたよ！"
-    image_files = []
-    for image in images:
-        _, image_file = tempfile.mkstemp(suffix=".png")
-        with open(image_file, "wb") as f:
-            f.write(image)
-        image_files.append(image_file)
-    return reply, image_files
-
-
-def summarize_slack_messages(messages: Sequence[dict]) -> str:
-    # TODO: implement it
-    reply = "```\n" + json.dumps(messages, indent=2, ensure_ascii=False) + "\n```"
+    return reply, images
+
+
+@timed()
+def summarize_slack_messages(messages: Sequence[dict], query: str = "") -> str:
+    # The same text is often posted to several channels
+    messages = dedup(list(messages), key=lambda m: m["text"])
+    if not messages:
+        return "該当するメッセージが見つかりませんでした！"
+    texts = [f"<@{m['user']}> (#{m['channel_name']}): {m['text']}" for m in messages]
+    summarizer = MapReduceSummarizer()
+    try:
+        result = run(summarizer.summarize(texts, query))
+    except Exception as e:
+        logger.exception(f"Failed to summarize the messages: {query=}")
+        reply = f"ごめんなさい、要約できませんでした！\n```{type(e).__qualname__}: {e}```"
+    else:
+        n_summarized = result.n_texts - result.n_dropped
+        reply = f"{n_summarized}件のメッセージの要約です！\n{result.summary}"
     return reply
 
 
-def answer_question_on_website(url: str, question: str) -> str:
-    openai = OpenAIClient()
+@timed()
+def answer_question_on_website(urls: Sequence[str], question: str) -> str:
+    pipeline = WebQAPipeline()
     try:
-        html = trafilatura.fetch_url(url)
-        text = trafilatura.extract(html)
-        if text:
-            reply = openai.answer_question_on_text(text, question)
-        else:
-            reply = f"`{url}`のリンク先の内容が読み取れませんでした！"
+        # A link that was just shared is often asked about by several users at once
+        answer, result = single_flight.do(
+            request_key("answer_question_on_website", *urls, question),
+            lambda: run(pipeline.answer(urls, question)),
+        )
     except Exception as e:
-        logger.exception(f"Failed to answer the question: {url=}, {text=}")
+        logger.exception(f"Failed to answer the question: {urls=}, {question=}")
         reply = f"ごめんなさい、質問に回答できません！\n```{type(e).__qualname__}: {e}```"
+        return reply
+
+    unread = " ".join(f"`{url}`" for url in urls if url in result.failed)
+    if answer is None:
+        return f"{unread}のリンク先の内容が読み取れませんでした！"
+    reply = answer
+    if unread:
+        reply += f"\n（{unread}のリンク先の内容は読み取れませんでした）"
     return reply
@@ -0,0 +1,129 @@
+# Coalescing of identical in-flight requests.
+# When the same prompt is sent by several users at once, or a message is edited while
+# its first reply is still being generated, only the first caller calls the API and
+# the others wait for its result. Results are kept for a short while afterwards, so
+# that a request arriving just after the first one has finished is served as well.
+# Unlike the response cache this is always enabled, since it never returns a result
+# older than SINGLE_FLIGHT_TTL.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Optional, TypeVar
+
+from loguru import logger
+
+from .response_cache import normalize
+
+T = TypeVar("T")
+
+DEFAULT_TTL = 30.0
+DEFAULT_MAX_ENTRIES = 64
+
+
+@dataclass
+class SingleFlightStats:
+    # Upstream calls made by the first caller
+    calls: int = 0
+    # Callers that waited for an in-flight call
+    coalesced: int = 0
+    # Callers served by a recently finished call
+    hits: int = 0
+    errors: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+def request_key(function: str, *args: str) -> str:
+    payload = [function, [normalize(a) for a in args]]
+    return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+
+class SingleFlight:
+    def __init__(
+        self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = SingleFlightStats()
+        self._lock = threading.Lock()
+        self._calls: dict[str, _Call] = {}
+        self._results: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    @classmethod
+    def from_env(cls) -> "SingleFlight":
+        return cls(
+            ttl=float(os.getenv("SINGLE_FLIGHT_TTL", DEFAULT_TTL)),
+            max_entries=int(os.getenv("SINGLE_FLIGHT_SIZE", DEFAULT_MAX_ENTRIES)),
+        )
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        """Call `fn` unless a call with the same key is in flight or just finished"""
+        with self._lock:
+            self._purge()
+            item = self._results.get(key)
+            if item is not None:
+                self.stats.hits += 1
+                return item[1]
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.stats.calls += 1
+                leader = True
+            else:
+                self.stats.coalesced += 1
+                leader = False
+
+        if not leader:
+            logger.info(f"Waiting for the same request in flight: {key=}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            # Errors are shared with the waiters but not kept, so the next request
+            # tries again
+            call.error = e
+            with self._lock:
+                self.stats.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self._purge()
+                if call.error is None and self.ttl > 0:
+                    self._results[key] = (time.monotonic() + self.ttl, call.result)
+                    self._results.move_to_end(key)
+                    while len(self._results) > self.max_entries:
+                        self._results.popitem(last=False)
+            call.done.set()
+        return call.result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def _purge(self):
+        # Results are kept in the order they expire, so that images are not held
+        # in memory for longer than `ttl`
+        now = time.monotonic()
+        while self._results and next(iter(self._results.values()))[0] < now:
+            self._results.popitem(last=False)
+
+
+single_flight = SingleFlight.from_env()
@@ -1,8 +1,20 @@
 import os
+from typing import Callable, Optional
 
-from slack_bolt import App
+from loguru import logger
+from slack_bolt import App, BoltResponse
+from slack_bolt.context.say import Say
+from slack_sdk import WebClient
 
+from ..idempotency import event_store
+from ..jobs import QueueFull, job_queue
+from ..metrics import command_label
+from ..ratelimit import PRIORITY_BULK, PRIORITY_DEFAULT, PRIORITY_INTERACTIVE, priority
 from .command import (
+    SLACKSEARCH_MAX_RESULTS,
+    Args,
+    Command,
+    Options,
     ParseError,
     command_chat,
     command_chat_next,
@@ -19,18 +31,98 @@ from .command import (
     command_webqa,
     parse,
 )
+from .indexer import message_indexer
 from .matcher import match_file_share, match_message_replied
+from .ratelimit import RateLimitedWebClient
 
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 SLACK_USER_TOKEN = os.environ.get("SLACK_USER_TOKEN")
 SLACK_SIGNING_SECRET = os.environ.get("SLACK_SIGNING_SECRET")
+SLACK_API_URL = os.environ.get("SLACK_API_URL", WebClient.BASE_URL)
 
 bolt_app = App(
-    token=SLACK_BOT_TOKEN,
+    client=RateLimitedWebClient(token=SLACK_BOT_TOKEN, base_url=SLACK_API_URL),
     signing_secret=SLACK_SIGNING_SECRET,
     process_before_response=True,
 )
 
+# Interactive replies go before bulk jobs when they wait for the same rate limit
+COMMAND_PRIORITIES = {
+    "chat": PRIORITY_INTERACTIVE,
+    "slacksearch": PRIORITY_BULK,
+    "webqa": PRIORITY_BULK,
+}
+
+
+@bolt_app.middleware
+def use_rate_limited_client(context, next):
+    # Bolt creates a plain WebClient per request, which `say` uses
+    context["client"] = RateLimitedWebClient.from_client(context.client)
+    next()
+
+
+@bolt_app.middleware
+def deduplicate_events(body, request, context, next):
+    # Runs after the signature verification, so event IDs cannot be forged
+    event_id = body.get("event_id")
+    if event_id is None:
+        next()
+        return
+    retry_num = request.headers.get("x-slack-retry-num", [None])[0]
+    if not event_store.begin(event_id, retry=retry_num is not None):
+        logger.info(f"Duplicate event ignored: {event_id=}, {retry_num=}")
+        return BoltResponse(status=200, body="")
+    context["event_id"] = event_id
+    next()
+
+
+@bolt_app.middleware
+def index_channel_messages(body, next):
+    # Listeners only see the messages they match, so every one is indexed here
+    if message_indexer.enabled and body.get("type") == "event_callback":
+        message_indexer.submit(body["event"])
+    next()
+
+
+@bolt_app.error
+def release_failed_event(error, body):
+    logger.exception(f"Failed to handle an event: {error=}")
+    # Slack retries the event since the response is 500
+    if body.get("event_id") is not None:
+        event_store.release(body["event_id"])
+
+
+BUSY_REPLY = "いま混み合っているので、少し待ってからもう一度話しかけてね！"
+
+
+def enqueue(
+    command: str,
+    say: Say,
+    user: str,
+    fn: Callable[..., None],
+    *args,
+    event_id: Optional[str] = None,
+):
+    level = COMMAND_PRIORITIES.get(command, PRIORITY_DEFAULT)
+    try:
+        job_queue.submit(command, run_job, command, level, event_id, fn, *args)
+    except QueueFull:
+        logger.warning(f"Job queue is full: {command=}")
+        say(f"<@{user}> {BUSY_REPLY}")
+        if event_id is not None:
+            event_store.complete(event_id)
+
+
+def run_job(
+    command: str, level: int, event_id: Optional[str], fn: Callable[..., None], *args
+):
+    try:
+        with priority(level), command_label(command):
+            fn(*args)
+    finally:
+        if event_id is not None:
+            event_store.complete(event_id)
+
 
 @bolt_app.event("app_mention")
 def reply_mention(event, context, say):
@@ -40,12 +132,39 @@ def reply_mention(event, context, say):
     msg = event["text"]
 
     try:
-        command, args = parse(msg)
+        command, args, options = parse(msg)
     except ParseError as e:
         reply = f"入力したコマンドと文章がおかしいよ！\n```{type(e).__qualname__}: {e}```"
         say(f"<@{user}> {reply}")
         return
 
+    enqueue(
+        command,
+        say,
+        user,
+        run_command,
+        command,
+        args,
+        options,
+        ts,
+        channel,
+        user,
+        say,
+        event_id=context.get("event_id"),
+    )
+
+
+def run_command(
+    command: Command,
+    args: Args,
+    options: Options,
+    ts: str,
+    channel: str,
+    user: str,
+    say: Say,
+):
+    nocache = options.nocache
+
     if command == "help":
         command_help(say=say)
         return
@@ -55,27 +174,35 @@ def reply_mention(event, context, say):
         return
 
     if command == "text":
-        command_text(prompt=args[0], user=user, say=say)
+        command_text(prompt=args[0], user=user, say=say, nocache=nocache)
         return
 
     if command == "textedit":
-        command_textedit(input=args[0], instruction=args[1], user=user, say=say)
+        command_textedit(
+            input=args[0], instruction=args[1], user=user, say=say, nocache=nocache
+        )
         return
 
     if command == "textinsert":
-        command_textinsert(prompt=args[0], suffix=args[1], user=user, say=say)
+        command_textinsert(
+            prompt=args[0], suffix=args[1], user=user, say=say, nocache=nocache
+        )
         return
 
     if command == "code":
-        command_code(prompt=args[0], user=user, say=say)
+        command_code(prompt=args[0], user=user, say=say, nocache=nocache)
         return
 
     if command == "codeedit":
-        command_codeedit(input=args[0], instruction=args[1], user=user, say=say)
+        command_codeedit(
+            input=args[0], instruction=args[1], user=user, say=say, nocache=nocache
+        )
         return
 
     if command == "codeinsert":
-        command_codeinsert(prompt=args[0], suffix=args[1], user=user, say=say)
+        command_codeinsert(
+            prompt=args[0], suffix=args[1], user=user, say=say, nocache=nocache
+        )
         return
 
     if command == "image":
@@ -87,7 +214,7 @@ def reply_mention(event, context, say):
     if command == "slacksearch":
         command_slacksearch(
             query=args[0],
-            count=10,
+            count=SLACKSEARCH_MAX_RESULTS,
             client=bolt_app.client,
             user=user,
             channel=channel,
@@ -97,7 +224,7 @@ def reply_mention(event, context, say):
         return
 
     if command == "webqa":
-        command_webqa(url=args[0], question=args[1], user=user, say=say)
+        command_webqa(urls=args[:-1], question=args[-1], user=user, say=say)
         return
 
     # must be unreachable
@@ -106,25 +233,43 @@ def reply_mention(event, context, say):
 
 
 @bolt_app.event("message", matchers=[match_message_replied])
-def reply_chat(event, say):
+def reply_chat(event, say, context):
     user = event["user"]
     channel = event["channel"]
     ts = event.get("ts")
     thread_ts = event.get("thread_ts")
     if ts and thread_ts and ts != thread_ts:
-        command_chat_next(
-            client=bolt_app.client,
-            user=user,
-            channel=channel,
-            thread_ts=thread_ts,
-            say=say,
+        enqueue(
+            "chat",
+            say,
+            user,
+            command_chat_next,
+            bolt_app.client,
+            user,
+            channel,
+            thread_ts,
+            say,
+            context.bot_user_id,
+            event_id=context.get("event_id"),
         )
 
 
 @bolt_app.event("message", matchers=[match_file_share])
-def reply_image(event, say):
+def reply_image(event, say, context):
     user = event["user"]
     channel = event["channel"]
     file_urls = [f["url_private"] for f in event["files"]]
     file_types = [f["filetype"] for f in event["files"]]
-    command_image_variation(file_urls, file_types, bolt_app.client, user, channel, say)
+    enqueue(
+        "image",
+        say,
+        user,
+        command_image_variation,
+        file_urls,
+        file_types,
+        bolt_app.client,
+        user,
+        channel,
+        say,
+        event_id=context.get("event_id"),
+    )
@@ -1,15 +1,17 @@
 # Commands are responsible for communication with Slack.
 # Do not write business logic here.
 
-import os
+import contextvars
 import re
-import tempfile
-from typing import Literal, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Literal, Optional, Sequence
 
 from loguru import logger
 from slack_bolt.context.say import Say
 from slack_sdk import WebClient
 
+from ..metrics import timed
 from ..service import (
     answer_question_on_website,
     generate_code_completion,
@@ -22,9 +24,14 @@ from ..service import (
     generate_text_completion,
     generate_text_edit,
     generate_text_insertion,
+    stream_initial_chat,
+    stream_next_chat,
     summarize_slack_messages,
 )
-from ..util import download_file
+from ..util import DownloadTooLarge, download_file
+from .history import Message, thread_history
+from .indexer import message_indexer
+from .stream import StreamingReply, streaming_enabled
 
 COMMANDS = (
     "help",
@@ -55,13 +62,30 @@ Command = Literal[
 ]
 Args = Sequence[str]
 
+IMAGE_VARIATION_CONCURRENCY = 3
+# search.messages returns at most 100 matches per page
+SEARCH_PAGE_SIZE = 100
+SLACKSEARCH_MAX_RESULTS = 300
+# The nearest messages are returned however far they are, so take fewer of them
+SLACKSEARCH_INDEX_RESULTS = 100
+WEBQA_MAX_URLS = 5
+# Commands whose replies go through the response cache
+CACHED_COMMANDS = ("text", "textedit", "textinsert", "code", "codeedit", "codeinsert")
+
+
+@dataclass
+class Options:
+    # Bypass the response cache, e.g. `@bot text nocache ...`
+    nocache: bool = False
+
 
 class ParseError(Exception):
     def __init__(self, message=""):
         super().__init__(message)
 
 
-def parse(text: str) -> tuple[Command, Args]:
+@timed()
+def parse(text: str) -> tuple[Command, Args, Options]:
     # Strip the leading mention string
     match_mention = re.match(r"<@[0-9a-zA-Z]+>(.+)$", text.lstrip(), re.DOTALL)
     if not match_mention:
@@ -81,6 +105,13 @@ def parse(text: str) -> tuple[Command, Args]:
             command = match_command.group(1)
             text = match_command.group(2).lstrip()
 
+    # Flag parsing
+    options = Options()
+    match_nocache = re.match(r"nocache\s+(.+)", text, re.DOTALL)
+    if match_nocache and command in CACHED_COMMANDS:
+        options.nocache = True
+        text = match_nocache.group(1).lstrip()
+
     # Subcommand parsing
     if command in ("codeedit", "textedit"):
         match_subcommand = re.match(
@@ -97,16 +128,19 @@ def parse(text: str) -> tuple[Command, Args]:
             raise ParseError(f"{command=}, {text=}")
         args = match_subcommand.groups()
     elif command in ("webqa",):
-        match_subcommand = re.match(r"<?(https?://\S+?)>?\s+?(.*)", text, re.DOTALL)
+        # One or more URLs followed by the question
+        match_subcommand = re.match(r"((?:<?https?://\S+?>?\s+)+)(.*)", text, re.DOTALL)
         if not match_subcommand:
             raise ParseError(f"{command=}, {text=}")
-        args = match_subcommand.groups()
+        urls = re.findall(r"<?(https?://[^\s|>]+)[^\s>]*>?", match_subcommand.group(1))
+        args = [*urls, match_subcommand.group(2)]
     else:
         args = [text]
 
-    return command, args
+    return command, args, options
 
 
+@timed()
 def command_help(say: Say):
     say(
         "コマンド一覧\n"
@@ -126,68 +160,103 @@ def command_help(say: Say):
     )
 
 
+@timed()
 def command_chat(input: str, thread_ts: str, say: Say):
+    if streaming_enabled("chat"):
+        StreamingReply(say, thread_ts=thread_ts).stream(stream_initial_chat(input))
+        return
     reply = generate_initial_chat(input)
     say(f"{reply}", thread_ts=thread_ts)
 
 
+@timed()
 def command_chat_next(
-    client: WebClient, user: str, channel: str, thread_ts: str, say: Say
+    client: WebClient,
+    user: str,
+    channel: str,
+    thread_ts: str,
+    say: Say,
+    bot_user: Optional[str] = None,
 ):
-    resp = client.conversations_replies(channel=channel, ts=thread_ts)
-    messages = resp.get("messages")
+    messages = thread_history.get(client, channel, thread_ts)
     if messages:
-        # TODO: pagination handling
+        thread = [(m.user, m.text) for m in messages]
+        if streaming_enabled("chat"):
+            streaming = StreamingReply(say, thread_ts=thread_ts)
+            replies = stream_next_chat(
+                (channel, thread_ts), thread, user=user, bot_user=bot_user
+            )
+            streaming.stream(replies)
+            if streaming.ts:
+                thread_history.put(
+                    channel,
+                    thread_ts,
+                    Message(streaming.ts, streaming.user or "", streaming.text.strip()),
+                )
+            return
         reply = generate_next_chat(
-            [(m["user"], m["text"]) for m in messages], user=user
+            (channel, thread_ts), thread, user=user, bot_user=bot_user
+        )
+        resp = say(f"{reply}", thread_ts=thread_ts)
+        thread_history.put(
+            channel, thread_ts, Message(resp["ts"], resp["message"]["user"], reply)
         )
-        say(f"{reply}", thread_ts=thread_ts)
 
 
-def command_text(prompt: str, user: str, say: Say):
-    reply = generate_text_completion(prompt)
+@timed()
+def command_text(prompt: str, user: str, say: Say, nocache: bool = False):
+    reply = generate_text_completion(prompt, nocache=nocache)
     say(f"<@{user}>{reply}")
 
 
-def command_textedit(input: str, instruction: str, user: str, say: Say):
-    reply = generate_text_edit(input, instruction)
+@timed()
+def command_textedit(
+    input: str, instruction: str, user: str, say: Say, nocache: bool = False
+):
+    reply = generate_text_edit(input, instruction, nocache=nocache)
     say(f"<@{user}>{reply}")
 
 
-def command_textinsert(prompt: str, suffix: str, user: str, say: Say):
-    reply = generate_text_insertion(prompt, suffix)
+@timed()
+def command_textinsert(
+    prompt: str, suffix: str, user: str, say: Say, nocache: bool = False
+):
+    reply = generate_text_insertion(prompt, suffix, nocache=nocache)
     say(f"<@{user}>{reply}")
 
 
-def command_code(prompt: str, user: str, say: Say):
-    reply = generate_code_completion(prompt)
+@timed()
+def command_code(prompt: str, user: str, say: Say, nocache: bool = False):
+    reply = generate_code_completion(prompt, nocache=nocache)
     say(f"<@{user}>\n{reply}")
 
 
-def command_codeedit(input: str, instruction: str, user: str, say: Say):
-    reply = generate_code_edit(input, instruction)
+@timed()
+def command_codeedit(
+    input: str, instruction: str, user: str, say: Say, nocache: bool = False
+):
+    reply = generate_code_edit(input, instruction, nocache=nocache)
     say(f"<@{user}>\n{reply}")
 
 
-def command_codeinsert(prompt: str, suffix: str, user: str, say: Say):
-    reply = generate_code_insertion(prompt, suffix)
+@timed()
+def command_codeinsert(
+    prompt: str, suffix: str, user: str, say: Say, nocache: bool = False
+):
+    reply = generate_code_insertion(prompt, suffix, nocache=nocache)
     say(f"<@{user}>\n{reply}")
 
 
+@timed()
 def command_image(prompt: str, client: WebClient, user: str, channel: str, say: Say):
-    reply, image_files = generate_image(prompt)
-    if image_files:
-        client.files_upload_v2(
-            file_uploads=[{"file": file} for file in image_files],
-            channel=channel,
-            initial_comment=f"<@{user}> {reply}",
-        )
-        for file in image_files:
-            os.remove(file)
+    reply, images = generate_image(prompt)
+    if images:
+        upload_images(client, images, channel, f"<@{user}> {reply}")
     else:
         say(f"<@{user}> {reply}")
 
 
+@timed()
 def command_image_variation(
     file_urls: list[str],
     file_types: list[str],
@@ -196,30 +265,52 @@ def command_image_variation(
     channel: str,
     say: Say,
 ):
-    for file_url, file_type in zip(file_urls, file_types):
-        _, input_file = tempfile.mkstemp(suffix=f".{file_type}")
+    def vary(file_url: str):
         try:
-            download_file(file_url, input_file, client.token)
-        except:
+            image = download_file(file_url, client.token)
+        except DownloadTooLarge:
+            logger.warning(f"Image is too large: {file_url=}")
+            say(f"{file_url} の画像が大きすぎるので編集できないよ！")
+            return
+        except Exception:
             logger.exception(f"Failed to retrieve an image: {file_url=}")
-            say("{file_url} の画像が取得できないので編集できないよ！")
-            continue
+            say(f"{file_url} の画像が取得できないので編集できないよ！")
+            return
 
-        reply, output_files = generate_image_variation(input_file)
-        os.remove(input_file)
+        reply, images = generate_image_variation(image)
 
-        if output_files:
-            client.files_upload_v2(
-                file_uploads=[{"file": file} for file in output_files],
-                channel=channel,
-                initial_comment=f"<@{user}> {reply}",
-            )
-            for file in output_files:
-                os.remove(file)
+        if images:
+            upload_images(client, images, channel, f"<@{user}> {reply}")
         else:
             say(f"<@{user}> {reply}")
 
+    if len(file_urls) == 1:
+        vary(file_urls[0])
+        return
+    # Keep the priority and the metrics label of the job in the threads
+    contexts = [contextvars.copy_context() for _ in file_urls]
+    with ThreadPoolExecutor(max_workers=IMAGE_VARIATION_CONCURRENCY) as executor:
+        list(executor.map(lambda c, url: c.run(vary, url), contexts, file_urls))
+
+
+@timed("slack.files_upload_v2")
+def upload_images(client: WebClient, images: list[bytes], channel: str, comment: str):
+    # Uploads go to a URL returned by files.getUploadURLExternal, outside api_call
+    client.files_upload_v2(
+        file_uploads=to_file_uploads(images),
+        channel=channel,
+        initial_comment=comment,
+    )
+
 
+def to_file_uploads(images: list[bytes]) -> list[dict]:
+    return [
+        {"content": image, "filename": f"image{i + 1}.png"}
+        for i, image in enumerate(images)
+    ]
+
+
+@timed()
 def command_slacksearch(
     query: str,
     count: int,
@@ -229,26 +320,55 @@ def command_slacksearch(
     say: Say,
     user_token: str,
 ):
-    resp = client.search_messages(
-        query=query,
-        count=count,
-        token=user_token,
-    )
-    messages = [
-        {
-            "channel": m["channel"]["id"],
-            "channel_name": m["channel"]["name"],
-            "user": m["user"],
-            "text": m["text"],
-            "url": m["permalink"],
-        }
-        for m in resp["messages"]["matches"]
-        if m["channel"]["is_private"] is False
-    ]
-    reply = summarize_slack_messages(messages)
+    index = message_indexer.index
+    if index is not None and len(index):
+        messages = message_indexer.search(query, min(count, SLACKSEARCH_INDEX_RESULTS))
+    else:
+        matches = search_messages(client, query, count, user_token)
+        messages = [
+            {
+                "channel": m["channel"]["id"],
+                "channel_name": m["channel"]["name"],
+                "user": m["user"],
+                "text": m["text"],
+                "url": m["permalink"],
+            }
+            for m in matches
+            if m["channel"]["is_private"] is False
+        ]
+    reply = summarize_slack_messages(messages, query=query)
     say(f"<@{user}> {reply}")
 
 
-def command_webqa(url: str, question: str, user: str, say: Say):
-    reply = answer_question_on_website(url, question)
+def search_messages(
+    client: WebClient, query: str, count: int, user_token: str
+) -> list[dict]:
+    """Up to `count` search results, following the pagination"""
+    matches: list[dict] = []
+    seen = set()
+    page = 1
+    while len(matches) < count:
+        resp = client.search_messages(
+            query=query,
+            count=min(count, SEARCH_PAGE_SIZE),
+            page=page,
+            token=user_token,
+        )
+        for m in resp["messages"]["matches"]:
+            if m["permalink"] not in seen:
+                seen.add(m["permalink"])
+                matches.append(m)
+        paging = resp["messages"].get("paging") or {}
+        if page >= paging.get("pages", 1):
+            break
+        page += 1
+    return matches[:count]
+
+
+@timed()
+def command_webqa(urls: Sequence[str], question: str, user: str, say: Say):
+    if len(urls) > WEBQA_MAX_URLS:
+        say(f"<@{user}> 最初の{WEBQA_MAX_URLS}件のリンク先だけを読みます！")
+        urls = urls[:WEBQA_MAX_URLS]
+    reply = answer_question_on_website(urls, question)
     say(f"<@{user}> {reply}")
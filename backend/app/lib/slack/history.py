@@ -0,0 +1,187 @@
+# Incrementally fetched thread history.
+# The messages of recently active threads are kept in a bounded in-memory LRU and,
+# optionally, in a SQLite file, so that each reply only fetches the messages posted
+# after the last fetch (`oldest` cursor of conversations.replies).
+# Edits and deletions of past messages are not tracked, except for our own replies
+# which are written back with `put`.
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import astuple, dataclass, field
+from typing import Optional
+
+from slack_sdk import WebClient
+
+DEFAULT_MAX_THREADS = 256
+DEFAULT_MAX_MESSAGES = 1000
+PAGE_SIZE = 200
+
+ThreadKey = tuple[str, str]
+
+
+@dataclass
+class Message:
+    ts: str
+    user: str
+    text: str
+
+
+@dataclass
+class Thread:
+    # ts of the newest message returned by conversations.replies
+    cursor: Optional[str] = None
+    messages: list[Message] = field(default_factory=list)
+
+    def merge(self, messages: list[Message], max_messages: int):
+        by_ts = {m.ts: m for m in self.messages}
+        by_ts.update((m.ts, m) for m in messages)
+        merged = sorted(by_ts.values(), key=lambda m: float(m.ts))
+        # The parent message is kept even if the thread is truncated
+        if len(merged) > max_messages:
+            merged = merged[:1] + merged[-(max_messages - 1) :]
+        self.messages = merged
+
+
+class ThreadHistory:
+    def __init__(
+        self,
+        max_threads: int = DEFAULT_MAX_THREADS,
+        max_messages: int = DEFAULT_MAX_MESSAGES,
+        path: Optional[str] = None,
+    ):
+        self.max_threads = max_threads
+        self.max_messages = max_messages
+        self.path = path
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        # Fetches of the same thread must not interleave
+        self._thread_locks: dict[ThreadKey, threading.Lock] = {}
+        self._memory: OrderedDict[ThreadKey, Thread] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS threads ("
+                "channel TEXT NOT NULL, thread_ts TEXT NOT NULL, cursor TEXT, "
+                "PRIMARY KEY (channel, thread_ts))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "channel TEXT NOT NULL, thread_ts TEXT NOT NULL, ts TEXT NOT NULL, "
+                "user TEXT NOT NULL, text TEXT NOT NULL, "
+                "PRIMARY KEY (channel, thread_ts, ts))"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls) -> "ThreadHistory":
+        return cls(
+            max_threads=int(os.getenv("THREAD_HISTORY_SIZE", DEFAULT_MAX_THREADS)),
+            path=os.getenv("THREAD_HISTORY_PATH") or None,
+        )
+
+    def get(self, client: WebClient, channel: str, thread_ts: str) -> list[Message]:
+        """All the messages of the thread, fetching only the new ones"""
+        key = (channel, thread_ts)
+        with self._lock:
+            thread_lock = self._thread_locks.setdefault(key, threading.Lock())
+        with thread_lock:
+            thread = self._load(key)
+            new = self._fetch(client, channel, thread_ts, thread.cursor)
+            with self._lock:
+                if new:
+                    thread.merge(new, self.max_messages)
+                    thread.cursor = max(new, key=lambda m: float(m.ts)).ts
+                    self._save(key, thread, new)
+                self._memory[key] = thread
+                self._memory.move_to_end(key)
+                while len(self._memory) > self.max_threads:
+                    evicted, _ = self._memory.popitem(last=False)
+                    self._thread_locks.pop(evicted, None)
+                return list(thread.messages)
+
+    def put(self, channel: str, thread_ts: str, message: Message):
+        """Insert or replace a message we have posted or edited ourselves"""
+        key = (channel, thread_ts)
+        with self._lock:
+            thread = self._memory.get(key)
+            if thread is not None:
+                # The cursor is left alone: messages posted by others while we were
+                # replying are older than `message` but have not been fetched yet
+                thread.merge([message], self.max_messages)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                    (channel, thread_ts, *astuple(message)),
+                )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._thread_locks.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM threads")
+                self._db.execute("DELETE FROM messages")
+                self._db.commit()
+
+    def _fetch(
+        self, client: WebClient, channel: str, thread_ts: str, oldest: Optional[str]
+    ) -> list[Message]:
+        messages = []
+        cursor = None
+        while True:
+            kwargs = {"channel": channel, "ts": thread_ts, "limit": PAGE_SIZE}
+            if oldest is not None:
+                kwargs["oldest"] = oldest
+            if cursor:
+                kwargs["cursor"] = cursor
+            resp = client.conversations_replies(**kwargs)
+            self.api_calls += 1
+            for m in resp.get("messages") or []:
+                # The parent message is always returned, even if older than `oldest`
+                if oldest is None or float(m["ts"]) > float(oldest):
+                    user = m.get("user") or m.get("bot_id") or ""
+                    messages.append(Message(m["ts"], user, m.get("text", "")))
+            cursor = (resp.get("response_metadata") or {}).get("next_cursor")
+            if not cursor:
+                return messages
+
+    def _load(self, key: ThreadKey) -> Thread:
+        with self._lock:
+            thread = self._memory.get(key)
+            if thread is not None:
+                return thread
+            if self._db is None:
+                return Thread()
+            row = self._db.execute(
+                "SELECT cursor FROM threads WHERE channel = ? AND thread_ts = ?", key
+            ).fetchone()
+            if row is None:
+                return Thread()
+            rows = self._db.execute(
+                "SELECT ts, user, text FROM messages "
+                "WHERE channel = ? AND thread_ts = ? ORDER BY CAST(ts AS REAL)",
+                key,
+            ).fetchall()
+            thread = Thread(cursor=row[0])
+            thread.merge([Message(*row) for row in rows], self.max_messages)
+            return thread
+
+    def _save(self, key: ThreadKey, thread: Thread, new: list[Message]):
+        if self._db is None:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO threads VALUES (?, ?, ?)", (*key, thread.cursor)
+        )
+        self._db.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+            [(*key, *astuple(m)) for m in new],
+        )
+        self._db.commit()
+
+
+thread_history = ThreadHistory.from_env()
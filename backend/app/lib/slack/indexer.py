@@ -0,0 +1,371 @@
+# Background indexing of channel messages for slacksearch.
+# A Bolt middleware hands every `message.channels` event to `MessageIndexer.submit`,
+# and one thread embeds the queued messages in batches and adds them to the message
+# index, replacing edited messages and dropping deleted ones. When the thread starts,
+# e.g. after App Runner has resumed the service, it first catches up with
+# conversations.history on the messages posted in each channel since the latest one
+# indexed (thread replies are only indexed from events).
+# Disabled unless MESSAGE_INDEX_PATH is set, in which case slacksearch searches the
+# index instead of calling search.messages. The path must be on durable storage, e.g.
+# an EFS volume: the local storage of App Runner is wiped whenever the service is
+# paused, and an empty index is backfilled with MESSAGE_INDEX_BACKFILL_DAYS of
+# history, embedding all of it again.
+
+import datetime
+import os
+import queue
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+from slack_sdk import WebClient
+
+from ..message_index import DEFAULT_NPROBE, IndexedMessage, MessageIndex
+from ..metrics import timed
+from ..openai_client import OpenAIClient
+from ..ratelimit import PRIORITY_BULK, priority
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_FLUSH_INTERVAL = 2.0
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_BACKFILL_DAYS = 30
+PAGE_SIZE = 200
+# Characters, well within the token limit of the embedding model
+MAX_TEXT_LENGTH = 4000
+# Subtypes of messages written by users
+INDEXED_SUBTYPES = (None, "thread_broadcast", "file_share", "me_message")
+# Dates in queries are in the time zone of most of our users
+QUERY_TIMEZONE = datetime.timezone(datetime.timedelta(hours=9))
+
+CHANNEL_FILTER = re.compile(r"\bin:\s*(?:<#(\w+)(?:\|[^>]*)?>|#?(\S+))")
+DATE_FILTER = re.compile(r"\b(after|before|on):\s*(\d{4}-\d{2}-\d{2})")
+
+
+@dataclass
+class Change:
+    channel: str
+    ts: str
+    # None if the message was deleted
+    message: Optional[IndexedMessage]
+
+
+def to_message(channel: str, m: dict) -> Optional[IndexedMessage]:
+    if m.get("subtype") not in INDEXED_SUBTYPES or m.get("bot_id"):
+        return None
+    text = (m.get("text") or "").strip()
+    if not text:
+        return None
+    return IndexedMessage(channel, m["ts"], m.get("user", ""), text[:MAX_TEXT_LENGTH])
+
+
+def parse_event(event: dict) -> Optional[Change]:
+    """The change of a public channel made by a `message` event"""
+    if event.get("type") != "message" or event.get("channel_type") != "channel":
+        return None
+    channel = event["channel"]
+    subtype = event.get("subtype")
+    if subtype == "message_deleted":
+        return Change(channel, event["deleted_ts"], None)
+    if subtype == "message_changed":
+        ts = event["message"]["ts"]
+        # Edited into something we do not index, e.g. an empty text
+        return Change(channel, ts, to_message(channel, event["message"]))
+    message = to_message(channel, event)
+    return Change(channel, message.ts, message) if message else None
+
+
+@dataclass
+class SearchQuery:
+    text: str
+    channels: Optional[list[str]] = None
+    oldest: Optional[float] = None
+    latest: Optional[float] = None
+
+
+def parse_query(
+    query: str, channel_id: Callable[[str], Optional[str]] = lambda name: None
+) -> SearchQuery:
+    """Split Slack's `in:#channel`, `after:`, `before:` and `on:` modifiers off a query
+
+    Like Slack, `after:` and `before:` exclude the given date.
+    """
+    channels = []
+    for id, name in CHANNEL_FILTER.findall(query):
+        channels.append(id or channel_id(name) or name)
+    oldest = latest = None
+    for modifier, date in DATE_FILTER.findall(query):
+        day = datetime.datetime.fromisoformat(date).replace(tzinfo=QUERY_TIMEZONE)
+        start = day.timestamp()
+        end = (day + datetime.timedelta(days=1)).timestamp()
+        if modifier == "after":
+            oldest = max(oldest or end, end)
+        elif modifier == "before":
+            latest = min(latest or start, start)
+        else:
+            oldest, latest = start, end
+    text = DATE_FILTER.sub("", CHANNEL_FILTER.sub("", query))
+    return SearchQuery(" ".join(text.split()), channels or None, oldest, latest)
+
+
+@dataclass
+class IndexerStats:
+    queued: int = 0
+    indexed: int = 0
+    deleted: int = 0
+    backfilled: int = 0
+    # Changes dropped because the queue was full
+    dropped: int = 0
+    batches: int = 0
+    errors: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+def embed_texts(texts: list[str]) -> list[np.ndarray]:
+    return OpenAIClient().get_text_embeddings(texts)
+
+
+class MessageIndexer:
+    def __init__(
+        self,
+        index: Optional[MessageIndex],
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        backfill_days: float = DEFAULT_BACKFILL_DAYS,
+        embed: Callable[[list[str]], Sequence[np.ndarray]] = embed_texts,
+    ):
+        self.index = index
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backfill_days = backfill_days
+        self.embed = embed
+        self.stats = IndexerStats()
+        self._queue: queue.Queue[Change] = queue.Queue(max_queue)
+        self._client: Optional[WebClient] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "MessageIndexer":
+        path = os.getenv("MESSAGE_INDEX_PATH")
+        index = None
+        if path:
+            nprobe = int(os.getenv("MESSAGE_INDEX_NPROBE", DEFAULT_NPROBE))
+            index = MessageIndex(path, nprobe=nprobe)
+        return cls(
+            index,
+            backfill_days=float(
+                os.getenv("MESSAGE_INDEX_BACKFILL_DAYS", DEFAULT_BACKFILL_DAYS)
+            ),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.index is not None
+
+    def start(self, client: Optional[WebClient] = None):
+        """Start indexing, catching up on the channel history with `client`"""
+        self._client = client
+        self._ensure_started()
+
+    def submit(self, event: dict):
+        change = parse_event(event)
+        if change is None or self.index is None:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(change)
+        except queue.Full:
+            self._count("dropped")
+        else:
+            self._count("queued")
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the queued changes have been indexed"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pid = None
+
+    def metrics(self) -> dict[str, Any]:
+        if self.index is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "messages": len(self.index),
+            "lists": self.index.nlist,
+            "queue_depth": self._queue.qsize(),
+            **self.stats.to_dict(),
+        }
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so (re)start the thread in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="message-indexer", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        if self._client is not None:
+            try:
+                self.backfill(self._client)
+            except Exception:
+                logger.exception("Failed to backfill the message index")
+                self._count("errors")
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._apply(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _next_batch(self) -> list[Change]:
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _apply(self, changes: Sequence[Change]):
+        assert self.index is not None
+        # The last change of each message wins
+        latest = {(c.channel, c.ts): c for c in changes}
+        try:
+            for change in latest.values():
+                if change.message is None and self.index.delete(
+                    change.channel, change.ts
+                ):
+                    self._count("deleted")
+            messages = [c.message for c in latest.values() if c.message is not None]
+            if messages:
+                with priority(PRIORITY_BULK):
+                    embeddings = self.embed([m.text for m in messages])
+                self.index.add(messages, np.stack(embeddings))
+                self._count("indexed", len(messages))
+            if self.index.needs_training():
+                self.index.train()
+        except Exception:
+            logger.exception(f"Failed to index messages: {len(changes)=}")
+            self._count("errors")
+        self._count("batches")
+
+    @timed("message_index.backfill")
+    def backfill(self, client: WebClient):
+        """Index the messages posted since the latest one indexed in each channel"""
+        assert self.index is not None
+        latest = self.index.latest_ts()
+        default_oldest = time.time() - self.backfill_days * 24 * 60 * 60
+        if not latest:
+            logger.warning(
+                f"Message index is empty, backfilling {self.backfill_days} days of "
+                "history: MESSAGE_INDEX_PATH should be on durable storage"
+            )
+        for channel in self._member_channels(client):
+            if self._stopped.is_set():
+                return
+            self.index.set_channel_name(channel["id"], channel["name"])
+            oldest = latest.get(channel["id"], f"{default_oldest:.6f}")
+            batch: list[Change] = []
+            for m in self._history(client, channel["id"], oldest):
+                message = to_message(channel["id"], m)
+                if message is not None:
+                    batch.append(Change(message.channel, message.ts, message))
+                if len(batch) >= self.batch_size:
+                    self._apply(batch)
+                    self._count("backfilled", len(batch))
+                    batch = []
+            if batch:
+                self._apply(batch)
+                self._count("backfilled", len(batch))
+
+    def _member_channels(self, client: WebClient) -> list[dict]:
+        channels = []
+        cursor = None
+        while True:
+            resp = client.conversations_list(
+                types="public_channel",
+                exclude_archived=True,
+                limit=PAGE_SIZE,
+                cursor=cursor,
+            )
+            channels += [c for c in resp["channels"] if c.get("is_member")]
+            cursor = (resp.get("response_metadata") or {}).get("next_cursor")
+            if not cursor:
+                return channels
+
+    def _history(self, client: WebClient, channel: str, oldest: str) -> list[dict]:
+        messages = []
+        cursor = None
+        while True:
+            resp = client.conversations_history(
+                channel=channel, oldest=oldest, limit=PAGE_SIZE, cursor=cursor
+            )
+            messages += resp.get("messages") or []
+            cursor = (resp.get("response_metadata") or {}).get("next_cursor")
+            if not cursor:
+                return messages
+
+    @timed("message_index.query")
+    def search(self, query: str, k: int) -> list[dict[str, Any]]:
+        """The `k` messages most similar to `query`, in the shape of search.messages"""
+        assert self.index is not None
+        parsed = parse_query(query, self.index.channel_id)
+        (embedding,) = self.embed([parsed.text or query])
+        results = self.index.search(
+            np.asarray(embedding),
+            k,
+            channels=parsed.channels,
+            oldest=parsed.oldest,
+            latest=parsed.latest,
+        )
+        return [
+            {
+                "channel": r.channel,
+                "channel_name": self.index.channel_names.get(r.channel, r.channel),
+                "user": r.user,
+                "text": r.text,
+                "ts": r.ts,
+                "score": r.score,
+            }
+            for r in results
+        ]
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            setattr(self.stats, name, getattr(self.stats, name) + n)
+
+
+message_indexer = MessageIndexer.from_env()
@@ -0,0 +1,115 @@
+# Slack side of the shared rate limiter.
+# Every Web API call waits for the bucket of its method, and a 429 pauses that bucket
+# for `Retry-After` before the call is retried by slack_sdk.
+
+import json
+import time
+from typing import Any, Optional
+from urllib.parse import parse_qs
+
+from loguru import logger
+from slack_sdk import WebClient
+from slack_sdk.http_retry import (
+    ConnectionErrorRetryHandler,
+    HttpRequest,
+    HttpResponse,
+    RetryHandler,
+    RetryState,
+)
+from slack_sdk.web import SlackResponse
+
+from ..metrics import span
+from ..ratelimit import RateLimits, backoff, rate_limits, retry_after
+
+# Methods whose limit applies to each channel rather than to the workspace
+PER_CHANNEL_METHODS = {"chat.postMessage"}
+
+
+def method_key(api_method: str, channel: Optional[str] = None) -> str:
+    if channel and api_method in PER_CHANNEL_METHODS:
+        return f"slack:{api_method}:{channel}"
+    return f"slack:{api_method}"
+
+
+def request_channel(request: HttpRequest) -> Optional[str]:
+    # The sync client only passes the encoded body to the retry handlers
+    params = request.body_params or {}
+    if not params and request.data:
+        body = request.data.decode()
+        try:
+            params = json.loads(body)
+        except ValueError:
+            params = {k: v[0] for k, v in parse_qs(body).items()}
+    channel = params.get("channel") if isinstance(params, dict) else None
+    return channel if isinstance(channel, str) else None
+
+
+class RateLimitRetryHandler(RetryHandler):
+    def __init__(self, limits: RateLimits = rate_limits, max_retry_count: int = 3):
+        super().__init__(max_retry_count=max_retry_count)
+        self.limits = limits
+
+    def _can_retry(
+        self,
+        *,
+        state: RetryState,
+        request: HttpRequest,
+        response: Optional[HttpResponse] = None,
+        error: Optional[Exception] = None,
+    ) -> bool:
+        if response is None or response.status_code != 429:
+            return False
+        self.limits.record_rate_limited()
+        return self.limits.allow_retry()
+
+    def prepare_for_next_attempt(
+        self,
+        *,
+        state: RetryState,
+        request: HttpRequest,
+        response: Optional[HttpResponse] = None,
+        error: Optional[Exception] = None,
+    ) -> None:
+        state.next_attempt_requested = True
+        api_method = request.url.rstrip("/").rsplit("/", 1)[-1]
+        channel = request_channel(request)
+        delay = retry_after(response.headers if response else None) or 1.0
+        self.limits.limiter(method_key(api_method, channel)).pause(delay)
+        delay += backoff(state.current_attempt, 0.5, 5.0)
+        logger.warning(f"Slack rate limited, retrying in {delay:.2f}s: {api_method=}")
+        time.sleep(delay)
+        state.increment_current_attempt()
+
+
+def retry_handlers(limits: RateLimits = rate_limits) -> list[RetryHandler]:
+    return [ConnectionErrorRetryHandler(), RateLimitRetryHandler(limits)]
+
+
+class RateLimitedWebClient(WebClient):
+    """WebClient whose calls wait for the rate limit of their method"""
+
+    def __init__(self, *args, limits: RateLimits = rate_limits, **kwargs):
+        kwargs.setdefault("retry_handlers", retry_handlers(limits))
+        super().__init__(*args, **kwargs)
+        self.limits = limits
+
+    def api_call(self, api_method: str, **kwargs: Any) -> SlackResponse:
+        params = kwargs.get("json") or kwargs.get("params") or kwargs.get("data") or {}
+        # Timed with the wait for the rate limit and the retries
+        with span(f"slack.{api_method}"):
+            self.limits.acquire(method_key(api_method, params.get("channel")))
+            return super().api_call(api_method, **kwargs)
+
+    @classmethod
+    def from_client(cls, client: WebClient) -> "RateLimitedWebClient":
+        return cls(
+            token=client.token,
+            base_url=client.base_url,
+            timeout=client.timeout,
+            ssl=client.ssl,
+            proxy=client.proxy,
+            headers=client.headers,
+            team_id=client.default_params.get("team_id"),
+            logger=client.logger,
+            retry_handlers=client.retry_handlers,
+        )
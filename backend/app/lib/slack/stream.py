@@ -0,0 +1,105 @@
+# Incremental Slack replies.
+# A placeholder message is posted at once and then updated with the streamed text.
+# chat.update is a Tier 3 method (about 50 calls per minute), so updates are
+# coalesced and never sent more often than `min_interval`, i.e. 40 per minute for
+# one reply. Concurrent replies share the `slack:chat.update` bucket of the rate
+# limiter through the client of the Bolt app.
+
+import os
+import time
+from typing import Iterable, Optional
+
+from loguru import logger
+from slack_bolt.context.say import Say
+
+from ..metrics import registry
+
+PLACEHOLDER = "考え中..."
+DEFAULT_FLUSH_TOKENS = 40
+DEFAULT_FLUSH_INTERVAL = 2.0
+DEFAULT_MIN_INTERVAL = 1.5
+
+
+def streaming_enabled(command: str) -> bool:
+    commands = os.getenv("STREAMING_COMMANDS", "chat")
+    return command in [c.strip() for c in commands.split(",")]
+
+
+class StreamingReply:
+    def __init__(
+        self,
+        say: Say,
+        thread_ts: Optional[str] = None,
+        flush_tokens: int = DEFAULT_FLUSH_TOKENS,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+    ):
+        self.say = say
+        self.thread_ts = thread_ts
+        self.flush_tokens = flush_tokens
+        self.flush_interval = flush_interval
+        self.min_interval = min_interval
+        self.text = ""
+        self.n_updates = 0
+        self.time_to_first_token: Optional[float] = None
+        self.channel: Optional[str] = None
+        self.ts: Optional[str] = None
+        # Our own user ID as seen in the thread history
+        self.user: Optional[str] = None
+        self._pending_tokens = 0
+        self._started_at = 0.0
+        self._last_update = 0.0
+
+    def start(self):
+        self._started_at = time.monotonic()
+        resp = self.say(PLACEHOLDER, thread_ts=self.thread_ts)
+        self.channel = resp["channel"]
+        self.ts = resp["ts"]
+        self.user = (resp.get("message") or {}).get("user")
+        self._last_update = time.monotonic()
+
+    def append(self, token: str):
+        self.text += token
+        self._pending_tokens += 1
+        now = time.monotonic()
+        since_update = now - self._last_update
+        if since_update < self.min_interval:
+            return
+        if self._pending_tokens >= self.flush_tokens or (
+            since_update >= self.flush_interval
+        ):
+            self._update()
+
+    def finish(self):
+        if self._pending_tokens or not self.text:
+            self._update()
+        elapsed = time.monotonic() - self._started_at
+        logger.info(
+            f"Streamed reply: time_to_first_token={self.time_to_first_token}, "
+            f"total={elapsed:.3f}, updates={self.n_updates}, chars={len(self.text)}"
+        )
+
+    def stream(self, tokens: Iterable[str]):
+        """Post the placeholder, stream `tokens` into it and finalise it"""
+        self.start()
+        try:
+            for token in tokens:
+                self.append(token)
+        except Exception as e:
+            logger.exception("Failed to stream the reply")
+            self.text += f"\nごめんなさい、途中で止まっちゃいました！\n```{type(e).__qualname__}: {e}```"
+        finally:
+            self.finish()
+
+    def _update(self):
+        text = self.text.strip() or "ごめんなさい、文章が書けませんでした！"
+        self.say.client.chat_update(channel=self.channel, ts=self.ts, text=text)
+        if self.time_to_first_token is None and self.text.strip():
+            self.time_to_first_token = time.monotonic() - self._started_at
+            if registry.enabled:
+                registry.observe(
+                    "slack.stream.time_to_first_token", self.time_to_first_token
+                )
+        self._pending_tokens = 0
+        self._last_update = time.monotonic()
+        self.n_updates += 1
@@ -0,0 +1,78 @@
+# Cold start bookkeeping.
+# Heavy modules (langchain, trafilatura, spaCy/GiNZA, tiktoken BPE files) are imported
+# lazily by the services. After App Runner resumes the service, `warm_up` loads them
+# before the first Slack event arrives and records how long each step took. GiNZA is
+# only used by the webqa workers, which load it as the process pool starts.
+
+import importlib
+import os
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from loguru import logger
+
+from .tokenizer import get_tokenizer
+
+# Process start as seen by this module, i.e. roughly when the app was imported
+PROCESS_STARTED_AT = time.monotonic()
+
+HEAVY_MODULES = ("openai", "numpy", "langchain", "trafilatura")
+TOKENIZER_MODELS = ("text-davinci-003", "text-embedding-ada-002")
+
+
+class Startup:
+    def __init__(self):
+        self.ready = False
+        self.steps: dict[str, float] = {}
+        self.ready_after: Optional[float] = None
+        self.first_requests: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _step(self, name: str, fn: Callable[[], Any]):
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            logger.exception(f"Warm-up step failed: {name}")
+        self.steps[name] = time.perf_counter() - start
+
+    def warm_up(self):
+        from .webqa import warm_up_process_pool
+
+        for module in HEAVY_MODULES:
+            self._step(f"import:{module}", lambda: importlib.import_module(module))
+        for model in TOKENIZER_MODELS:
+            self._step(f"tiktoken:{model}", lambda: get_tokenizer(model))
+        self._step("webqa_pool", warm_up_process_pool)
+        self.mark_ready()
+
+    def mark_ready(self):
+        self.ready = True
+        self.ready_after = time.monotonic() - PROCESS_STARTED_AT
+        breakdown = ", ".join(f"{k}={v:.3f}s" for k, v in self.steps.items())
+        logger.info(f"Ready after {self.ready_after:.3f}s: {breakdown}")
+
+    def record_request(self, path: str, elapsed: float):
+        """Record the latency of the first request to each path"""
+        if path in self.first_requests:
+            return
+        with self._lock:
+            if path not in self.first_requests:
+                self.first_requests[path] = elapsed
+                logger.info(f"First request to {path} took {elapsed:.3f}s")
+
+    def metrics(self) -> dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "ready_after": self.ready_after,
+            "steps": self.steps,
+            "first_requests": self.first_requests,
+        }
+
+
+startup = Startup()
+
+
+def warmup_enabled() -> bool:
+    return os.getenv("STARTUP_WARMUP", "1") not in ("0", "false")
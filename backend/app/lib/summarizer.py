@@ -0,0 +1,173 @@
+# Map-reduce summarisation of many short texts, e.g. Slack search results.
+# Texts are packed into chunks that fit in one prompt, the chunks are summarised in
+# parallel (map) and the partial summaries are merged into one (reduce), so that
+# hundreds of messages take roughly two completion round trips.
+
+import asyncio
+from dataclasses import dataclass
+from typing import Callable, Optional, TypeVar
+
+from loguru import logger
+
+from .async_openai_client import AsyncOpenAIClient
+from .openai_client import COMPLETION_MODEL, MAX_COMPLETION_TOKENS
+from .tokenizer import count_tokens, truncate_tokens
+
+T = TypeVar("T")
+
+MAP_PROMPT = """以下は「{topic}」に関するSlackのメッセージです。重要な情報を落とさずに、日本語で簡潔に要約してください。
+
+{texts}
+
+要約:"""
+REDUCE_PROMPT = """以下は「{topic}」に関するSlackのメッセージを部分ごとに要約したものです。重複をまとめて、全体を一つの要約にしてください。
+
+{texts}
+
+要約:"""
+
+
+@dataclass
+class SummaryConfig:
+    # Prompt tokens of the texts in one map call
+    chunk_tokens: int = 2500
+    # Completion tokens of a partial and of the final summary
+    map_max_tokens: int = 300
+    reduce_max_tokens: int = 800
+    # Tokens of the texts summarised in total; the rest is dropped
+    total_tokens: int = 20000
+    map_concurrency: int = 8
+    reduce_concurrency: int = 2
+
+
+@dataclass
+class SummaryResult:
+    summary: str
+    n_texts: int
+    n_dropped: int
+    n_calls: int
+
+
+def dedup(items: list[T], key: Callable[[T], str] = str) -> list[T]:
+    """Drop items whose texts are the same after collapsing the whitespace"""
+    seen = set()
+    unique = []
+    for item in items:
+        text = " ".join(key(item).split())
+        if text and text not in seen:
+            seen.add(text)
+            unique.append(item)
+    return unique
+
+
+def pack(n_tokens: list[int], max_tokens: int) -> list[list[int]]:
+    """Group consecutive indices into chunks of at most `max_tokens`"""
+    chunks: list[list[int]] = []
+    chunk: list[int] = []
+    total = 0
+    for i, n in enumerate(n_tokens):
+        if chunk and total + n > max_tokens:
+            chunks.append(chunk)
+            chunk, total = [], 0
+        chunk.append(i)
+        total += n
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class MapReduceSummarizer:
+    def __init__(
+        self,
+        config: Optional[SummaryConfig] = None,
+        model: str = COMPLETION_MODEL,
+    ):
+        self.config = config or SummaryConfig()
+        self.model = model
+        self.openai = AsyncOpenAIClient()
+        # Completion calls of the last `summarize`
+        self.n_calls = 0
+
+    async def summarize(self, texts: list[str], topic: str) -> SummaryResult:
+        config = self.config
+        self.n_calls = 0
+        texts = dedup(texts)
+        n_texts = len(texts)
+
+        # Search results come by relevance, so the tail is dropped first
+        kept, n_tokens, total = [], [], 0
+        for text in texts:
+            text = truncate_tokens(text, config.chunk_tokens, self.model)
+            n = count_tokens(text, self.model) + 1  # newline
+            if total + n > config.total_tokens:
+                break
+            kept.append(text)
+            n_tokens.append(n)
+            total += n
+        n_dropped = n_texts - len(kept)
+        if not kept:
+            return SummaryResult("", n_texts, n_dropped, 0)
+
+        chunks = pack(n_tokens, config.chunk_tokens)
+        if len(chunks) == 1:
+            summary = await self._complete(
+                MAP_PROMPT, topic, kept, config.reduce_max_tokens
+            )
+            return SummaryResult(summary, n_texts, n_dropped, self.n_calls)
+
+        semaphore = asyncio.Semaphore(config.map_concurrency)
+
+        async def map_chunk(chunk: list[int]) -> Optional[str]:
+            async with semaphore:
+                try:
+                    return await self._complete(
+                        MAP_PROMPT,
+                        topic,
+                        [kept[i] for i in chunk],
+                        config.map_max_tokens,
+                    )
+                except Exception:
+                    logger.exception(f"Failed to summarise a chunk: {topic=}")
+                    return None
+
+        results = await asyncio.gather(*[map_chunk(chunk) for chunk in chunks])
+        summaries = [s for s in results if s]
+        if not summaries:
+            raise RuntimeError(f"All the {len(chunks)} chunks failed")
+        summary = await self._reduce(summaries, topic)
+        return SummaryResult(summary, n_texts, n_dropped, self.n_calls)
+
+    async def _reduce(self, summaries: list[str], topic: str) -> str:
+        config = self.config
+        semaphore = asyncio.Semaphore(config.reduce_concurrency)
+
+        async def reduce_chunk(chunk: list[str], max_tokens: int) -> str:
+            async with semaphore:
+                return await self._complete(REDUCE_PROMPT, topic, chunk, max_tokens)
+
+        # Only reduced in several rounds if the partial summaries do not fit in one
+        # prompt, which the defaults avoid
+        while True:
+            n_tokens = [count_tokens(s, self.model) + 1 for s in summaries]
+            chunks = pack(n_tokens, config.chunk_tokens)
+            if len(chunks) == 1:
+                return await reduce_chunk(summaries, config.reduce_max_tokens)
+            summaries = await asyncio.gather(
+                *[
+                    reduce_chunk([summaries[i] for i in chunk], config.map_max_tokens)
+                    for chunk in chunks
+                ]
+            )
+
+    async def _complete(
+        self, template: str, topic: str, texts: list[str], max_tokens: int
+    ) -> str:
+        prompt = template.format(topic=topic, texts="\n".join(texts))
+        max_tokens = min(
+            max_tokens, MAX_COMPLETION_TOKENS - count_tokens(prompt, self.model)
+        )
+        self.n_calls += 1
+        text = await self.openai.get_text_completion(
+            prompt, model=self.model, max_tokens=max_tokens
+        )
+        return text.strip()
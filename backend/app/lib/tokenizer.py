@@ -0,0 +1,35 @@
+# Shared tiktoken encodings and memoised token counting.
+
+import functools
+
+import tiktoken
+
+TOKEN_COUNT_CACHE_SIZE = 16384
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model)
+
+
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def _count_tokens(model: str, text: str) -> int:
+    return len(get_tokenizer(model).encode(text))
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Number of tokens of `text` for `model`, memoised per (model, text)"""
+    return _count_tokens(model, text)
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    """The longest prefix of `text` with at most `max_tokens` tokens"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    tokenizer = get_tokenizer(model)
+    return tokenizer.decode(tokenizer.encode(text)[:max_tokens])
+
+
+def clear_caches():
+    get_tokenizer.cache_clear()
+    _count_tokens.cache_clear()
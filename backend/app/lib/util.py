@@ -1,31 +1,114 @@
 import io
+import os
 from typing import Optional, Union
-from urllib.request import Request, urlopen
 
-from PIL import Image
+import requests
+from PIL import Image, ImageOps
 
+from .metrics import timed
 
-def download_file(url: str, file: str, access_token: Optional[str] = None):
-    """Download a file from `url` and save it to `file`"""
-    req = Request(url)
+try:
+    # HEIC photos from iPhones, if the optional plugin is installed
+    from pillow_heif import register_heif_opener
+except ImportError:
+    pass
+else:
+    register_heif_opener()
+
+# Uploaded images are cropped and resized before they are sent to OpenAI, so the
+# source may be larger than OpenAI's 4MB limit, but not arbitrarily large.
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", 20 * 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = (5.0, 30.0)
+# Largest image accepted by the OpenAI image APIs
+MAX_IMAGE_BYTES = 4 * 1024 * 1024
+
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+
+class DownloadTooLarge(Exception):
+    def __init__(self, message=""):
+        super().__init__(message)
+
+
+@timed()
+def download_file(
+    url: str,
+    access_token: Optional[str] = None,
+    max_bytes: int = DOWNLOAD_MAX_BYTES,
+) -> bytes:
+    """Download a file from `url` into memory, aborting once it exceeds `max_bytes`"""
+    headers = {}
     if access_token is not None:
-        req.add_header("Authorization", f"Bearer {access_token}")
-    content = urlopen(req).read()
-    with open(file, "wb") as f:
-        f.write(content)
+        headers["Authorization"] = f"Bearer {access_token}"
+    with _session.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as resp:
+        resp.raise_for_status()
+        content_length = int(resp.headers.get("Content-Length") or 0)
+        if content_length > max_bytes:
+            raise DownloadTooLarge(f"{url=}, {content_length=}, {max_bytes=}")
+        buf = io.BytesIO()
+        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+            buf.write(chunk)
+            if buf.tell() > max_bytes:
+                raise DownloadTooLarge(f"{url=}, {max_bytes=}")
+        return buf.getvalue()
 
 
+@timed()
 def crop_and_resize_image(
     infile: Union[str, io.BytesIO],
     outfile: Union[str, io.BytesIO],
     size: tuple[int, int] = (512, 512),
     format: str = "png",
+    max_bytes: int = MAX_IMAGE_BYTES,
 ):
+    """Crop the centre square of `infile` and save it resized to `size`"""
     im = Image.open(infile)
+    # JPEG can be decoded at 1/2, 1/4 or 1/8 scale, which is much cheaper than
+    # decoding the full image only to throw most of the pixels away
+    scale = max(size) / min(im.size)
+    if scale < 1:
+        im.draft("RGB", (round(im.width * scale), round(im.height * scale)))
+    im = ImageOps.exif_transpose(im)
+    if im.mode not in ("RGB", "RGBA"):
+        has_alpha = im.mode in ("LA", "PA", "RGBa") or "transparency" in im.info
+        im = im.convert("RGBA" if has_alpha else "RGB")
+
     xlen, ylen = im.size
-    if xlen > ylen:
-        im.crop((0, 0, ylen, ylen)).resize(size).save(outfile, format=format)
-    elif xlen < ylen:
-        im.crop((0, 0, xlen, xlen)).resize(size).save(outfile, format=format)
+    side = min(xlen, ylen)
+    left, top = (xlen - side) // 2, (ylen - side) // 2
+    # `reducing_gap` shrinks by an integer factor with `reduce` before resampling
+    im = im.resize(
+        size,
+        Image.Resampling.LANCZOS,
+        box=(left, top, left + side, top + side),
+        reducing_gap=3.0,
+    )
+    save_image(im, outfile, format=format, max_bytes=max_bytes)
+
+
+def save_image(
+    im: Image.Image,
+    outfile: Union[str, io.BytesIO],
+    format: str = "png",
+    max_bytes: int = MAX_IMAGE_BYTES,
+):
+    """Save `im`, falling back to a smaller encoding if it exceeds `max_bytes`"""
+    buf = io.BytesIO()
+    im.save(buf, format=format)
+    if buf.tell() > max_bytes and format.lower() == "png":
+        # A 256 colour palette is still accepted by OpenAI and is several times
+        # smaller than truecolour
+        buf = io.BytesIO()
+        im.quantize(256).save(buf, format=format, optimize=True)
+    if buf.tell() > max_bytes:
+        raise ValueError(f"Image is too large: {buf.tell()} > {max_bytes} bytes")
+
+    if isinstance(outfile, str):
+        with open(outfile, "wb") as f:
+            f.write(buf.getbuffer())
     else:
-        im.resize(size).save(outfile, format=format)
+        outfile.write(buf.getbuffer())
@@ -0,0 +1,453 @@
+# Document ingestion pipeline of the webqa command.
+# Pages go through fetch → extract → split → embed stages connected by bounded queues.
+# Fetching and embedding are I/O-bound and run on the event loop, while extraction
+# (trafilatura) and sentence splitting (GiNZA) are CPU-bound and run on a process
+# pool, so that a large page does not hold the GIL of the Bolt workers. Pages are
+# split in sections, and the chunks of the first sections are embedded while later
+# ones are still being split.
+
+import asyncio
+import ipaddress
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterator, Optional, Sequence
+
+import aiohttp
+import yarl
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+from loguru import logger
+
+from .async_openai_client import AsyncOpenAIClient
+from .embedding_cache import text_key
+from .metrics import registry
+from .openai_client import (
+    COMPLETION_MODEL,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_MODEL,
+    MAX_COMPLETION_TOKENS,
+    Chunk,
+    answer_prompt,
+    split_text,
+)
+from .page_cache import FetchedPage, page_cache
+from .retrieval import EmbeddingIndex, index_cache
+from .segmenter import registry as segmenter_registry
+from .tokenizer import count_tokens
+from .util import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_MAX_BYTES, DownloadTooLarge
+
+STAGES = ("fetch", "extract", "split", "embed")
+WEBQA_PROCESSES = int(os.getenv("WEBQA_PROCESSES", 2))
+FETCH_CONCURRENCY = 4
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=30.0, connect=5.0)
+MAX_REDIRECTS = 5
+# Hosts that may be fetched even if they are not public, e.g. `127.0.0.1` in tests
+WEBQA_ALLOWED_HOSTS = set(filter(None, os.getenv("WEBQA_ALLOWED_HOSTS", "").split(",")))
+# Characters of text split and embedded at a time
+SECTION_CHARS = 8000
+QUEUE_SIZE = 8
+CHUNK_MAX_TOKENS = 500
+MAX_CONTEXT_TOKENS = 1800
+
+
+@dataclass
+class StageTiming:
+    # Seconds spent on the items of the stage, summed over its workers
+    busy: float = 0.0
+    items: int = 0
+    # Seconds since the start of the pipeline when the first and the last items
+    # were done
+    first: Optional[float] = None
+    last: Optional[float] = None
+
+
+@dataclass
+class IngestResult:
+    index: EmbeddingIndex
+    # Error messages of the pages that could not be ingested
+    failed: dict[str, str]
+    timings: dict[str, StageTiming]
+    elapsed: float
+
+    def timings_dict(self) -> dict[str, Any]:
+        return {stage: asdict(t) for stage, t in self.timings.items()}
+
+
+@dataclass
+class _Page:
+    key: Optional[str] = None
+    index: Optional[EmbeddingIndex] = None
+    sections: list[Optional[tuple[list[Chunk], list[Any]]]] = field(
+        default_factory=list
+    )
+
+
+_pool_lock = threading.Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _init_worker():
+    # Sentences are only split in the workers, so GiNZA is loaded there and not in
+    # the server process
+    segmenter_registry.warmup()
+
+
+def _worker_ready() -> bool:
+    return segmenter_registry.loaded
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """The process pool shared by the webqa commands
+
+    Workers are spawned rather than forked from the threaded server, load GiNZA as
+    they start and keep it between requests.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=WEBQA_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def warm_up_process_pool() -> list[bool]:
+    """Start the workers and wait until they have loaded GiNZA"""
+    pool = get_process_pool()
+    futures = [pool.submit(_worker_ready) for _ in range(WEBQA_PROCESSES)]
+    return [future.result() for future in futures]
+
+
+def shutdown_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def extract_text(html: bytes) -> Optional[str]:
+    import trafilatura
+
+    return trafilatura.extract(html)
+
+
+def split_sections(text: str, max_chars: int = SECTION_CHARS) -> list[str]:
+    """Split `text` at line breaks into sections of about `max_chars`"""
+    sections = []
+    section: list[str] = []
+    n_chars = 0
+    for line in text.splitlines(keepends=True):
+        if section and n_chars + len(line) > max_chars:
+            sections.append("".join(section))
+            section, n_chars = [], 0
+        section.append(line)
+        n_chars += len(line)
+    if section:
+        sections.append("".join(section))
+    return sections
+
+
+def index_key(text: str) -> str:
+    # Shared with OpenAIClient.answer_question_on_text
+    return f"{EMBEDDING_MODEL}:{text_key(text)}"
+
+
+class BlockedURL(Exception):
+    pass
+
+
+def check_host(host: str):
+    """Refuse IP addresses that are not public, e.g. the metadata server"""
+    if host in WEBQA_ALLOWED_HOSTS:
+        return
+    try:
+        address = ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        return  # a host name, checked by PublicResolver
+    if not address.is_global:
+        raise BlockedURL(f"{host} is not a public address")
+
+
+class PublicResolver(AbstractResolver):
+    """Resolve host names to public addresses only"""
+
+    def __init__(self):
+        self._resolver = DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family=socket.AF_INET):
+        hosts = await self._resolver.resolve(host, port, family)
+        if host in WEBQA_ALLOWED_HOSTS:
+            return hosts
+        hosts = [h for h in hosts if ipaddress.ip_address(h["host"]).is_global]
+        if not hosts:
+            raise BlockedURL(f"{host} is not a public address")
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_web_session() -> aiohttp.ClientSession:
+    """The connection pool for fetching pages of the running event loop
+
+    Separate from the OpenAI one, since any URL posted on Slack is fetched from
+    inside our network.
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(resolver=PublicResolver(), limit_per_host=4)
+        session = aiohttp.ClientSession(connector=connector, timeout=FETCH_TIMEOUT)
+        _sessions[loop] = session
+    return session
+
+
+async def close_web_session():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def fetch_page(
+    url: str,
+    headers: Optional[dict[str, str]] = None,
+    max_bytes: int = DOWNLOAD_MAX_BYTES,
+) -> FetchedPage:
+    session = get_web_session()
+    for _ in range(MAX_REDIRECTS + 1):
+        parsed = yarl.URL(url)
+        if parsed.scheme not in ("http", "https") or not parsed.host:
+            raise BlockedURL(f"{url} is not a web page")
+        check_host(parsed.host)
+        # Redirects are followed here so that every hop is checked
+        async with session.get(url, headers=headers, allow_redirects=False) as resp:
+            if resp.status in (301, 302, 303, 307, 308) and "Location" in resp.headers:
+                url = str(parsed.join(yarl.URL(resp.headers["Location"])))
+                continue
+            resp.raise_for_status()
+            if resp.status == 304:
+                return FetchedPage(304)
+            if resp.content_length is not None and resp.content_length > max_bytes:
+                raise DownloadTooLarge(f"{url} is {resp.content_length} bytes")
+            body = bytearray()
+            async for data in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                body += data
+                if len(body) > max_bytes:
+                    raise DownloadTooLarge(f"{url} is larger than {max_bytes} bytes")
+            return FetchedPage(
+                resp.status,
+                bytes(body),
+                resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"),
+            )
+    raise BlockedURL(f"Too many redirects: {url}")
+
+
+class WebQAPipeline:
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        section_chars: int = SECTION_CHARS,
+        queue_size: int = QUEUE_SIZE,
+        max_tokens: int = CHUNK_MAX_TOKENS,
+    ):
+        # The shared process pool unless given
+        self.executor = executor
+        self.section_chars = section_chars
+        self.queue_size = queue_size
+        self.max_tokens = max_tokens
+        self.openai = AsyncOpenAIClient()
+
+    async def answer(
+        self, urls: Sequence[str], question: str
+    ) -> tuple[Optional[str], IngestResult]:
+        """Answer `question` on the pages, or None if none of them could be read"""
+        q_emb = asyncio.create_task(self.openai.get_text_embedding(question))
+        try:
+            result = await self.ingest(urls)
+        except BaseException:
+            q_emb.cancel()
+            raise
+        if len(result.index) == 0:
+            q_emb.cancel()
+            return None, result
+        chunks = result.index.select(await q_emb, MAX_CONTEXT_TOKENS)
+        prompt = answer_prompt("\n\n###\n\n".join(chunks), question)
+        max_tokens = MAX_COMPLETION_TOKENS - count_tokens(prompt, COMPLETION_MODEL)
+        answer = await self.openai.get_text_completion(prompt, max_tokens=max_tokens)
+        return answer, result
+
+    async def ingest(self, urls: Sequence[str]) -> IngestResult:
+        loop = asyncio.get_running_loop()
+        executor = self.executor or get_process_pool()
+        start = time.perf_counter()
+        timings = {stage: StageTiming() for stage in STAGES}
+        # A URL given twice would be extracted and split twice into one `_Page`
+        urls = list(dict.fromkeys(urls))
+        pages = {url: _Page() for url in urls}
+        failed: dict[str, str] = {}
+
+        @contextmanager
+        def timed(stage: str, n_items: int = 1) -> Iterator[None]:
+            t = time.perf_counter()
+            yield
+            now = time.perf_counter()
+            if registry.enabled:
+                registry.observe(f"webqa.{stage}", now - t)
+            timing = timings[stage]
+            timing.busy += now - t
+            timing.items += n_items
+            if timing.first is None:
+                timing.first = now - start
+            timing.last = now - start
+
+        def fail(url: str, stage: str, e: Exception):
+            logger.warning(f"Failed to {stage} a page: {url=}, {e=}")
+            failed.setdefault(url, f"{type(e).__qualname__}: {e}")
+
+        to_extract: asyncio.Queue = asyncio.Queue(self.queue_size)
+        to_split: asyncio.Queue = asyncio.Queue(self.queue_size)
+        to_embed: asyncio.Queue = asyncio.Queue(self.queue_size)
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def fetch(url: str):
+            async with semaphore:
+                try:
+                    with timed("fetch"):
+                        cached = await page_cache.fetch(url, fetch_page)
+                except Exception as e:
+                    fail(url, "fetch", e)
+                    return
+            await to_extract.put((url, cached))
+
+        async def extract():
+            while (item := await to_extract.get()) is not None:
+                url, cached = item
+                text = cached.text
+                if text is None:
+                    try:
+                        with timed("extract"):
+                            text = await loop.run_in_executor(
+                                executor, extract_text, cached.html
+                            )
+                    except Exception as e:
+                        fail(url, "extract", e)
+                        continue
+                    page_cache.set_text(cached, text)
+                if not text:
+                    failed[url] = "No text was extracted"
+                    continue
+                page = pages[url]
+                page.key = index_key(text)
+                page.index = index_cache.get(page.key)
+                if page.index is not None:
+                    continue
+                sections = split_sections(text, self.section_chars)
+                page.sections = [None] * len(sections)
+                for i, section in enumerate(sections):
+                    await to_split.put((url, i, section))
+
+        async def split():
+            while (item := await to_split.get()) is not None:
+                url, i, section = item
+                try:
+                    with timed("split"):
+                        chunks = await loop.run_in_executor(
+                            executor, split_text, section, self.max_tokens
+                        )
+                except Exception as e:
+                    fail(url, "split", e)
+                    continue
+                await to_embed.put((url, i, chunks))
+
+        async def embed():
+            stop = False
+            while not stop and (item := await to_embed.get()) is not None:
+                # Sections split while the previous request was in flight go into
+                # one request
+                items = [item]
+                while not to_embed.empty():
+                    if (item := to_embed.get_nowait()) is None:
+                        stop = True
+                        break
+                    items.append(item)
+                chunks = [c for _, _, section in items for c in section]
+                try:
+                    with timed("embed", len(items)):
+                        embs = await self.openai.get_text_embeddings(
+                            [c.text for c in chunks],
+                            n_tokens_list=[c.n_tokens for c in chunks],
+                        )
+                except Exception as e:
+                    for url, _, _ in items:
+                        fail(url, "embed", e)
+                    continue
+                for url, i, section in items:
+                    pages[url].sections[i] = (section, embs[: len(section)])
+                    embs = embs[len(section) :]
+
+        n_workers = {
+            "extract": WEBQA_PROCESSES,
+            "split": WEBQA_PROCESSES,
+            "embed": EMBEDDING_CONCURRENCY,
+        }
+        workers = {
+            "extract": [
+                asyncio.create_task(extract()) for _ in range(n_workers["extract"])
+            ],
+            "split": [asyncio.create_task(split()) for _ in range(n_workers["split"])],
+            "embed": [asyncio.create_task(embed()) for _ in range(n_workers["embed"])],
+        }
+        try:
+            await asyncio.gather(*[fetch(url) for url in urls])
+            # Stop the stages one after another once their input is exhausted
+            for stage, queue in (
+                ("extract", to_extract),
+                ("split", to_split),
+                ("embed", to_embed),
+            ):
+                for _ in workers[stage]:
+                    await queue.put(None)
+                await asyncio.gather(*workers[stage])
+        finally:
+            for tasks in workers.values():
+                for task in tasks:
+                    task.cancel()
+
+        indices = []
+        for url, page in pages.items():
+            if url in failed or page.key is None:
+                continue
+            if page.index is None:
+                sections = [s for s in page.sections if s is not None]
+                chunks = [c for s in sections for c in s[0]]
+                page.index = EmbeddingIndex(
+                    [c.text for c in chunks],
+                    [c.n_tokens for c in chunks],
+                    [emb for s in sections for emb in s[1]],
+                )
+                index_cache.put(page.key, page.index)
+            indices.append(page.index)
+
+        elapsed = time.perf_counter() - start
+        result = IngestResult(EmbeddingIndex.concat(indices), failed, timings, elapsed)
+        logger.info(
+            f"Ingested {len(indices)}/{len(urls)} pages in {elapsed:.2f}s: "
+            + ", ".join(
+                f"{stage} {t.busy:.2f}s/{t.items}" for stage, t in timings.items()
+            )
+        )
+        return result
@@ -0,0 +1,92 @@
+# The backend under uvicorn in a subprocess, as in production, for tests and
+# benchmarks that go through HTTP.
+
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Optional
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class AppServer:
+    """Serve `app.app:app` with `env` added to the environment
+
+    Usage::
+
+        with AppServer({"SLACK_API_URL": slack.base_url, ...}) as server:
+            urllib.request.urlopen(f"{server.url}/_health")
+    """
+
+    def __init__(
+        self,
+        env: dict[str, str],
+        port: Optional[int] = None,
+        workers: int = 1,
+        startup_timeout: float = 120.0,
+    ):
+        self.env = env
+        self.port = port or free_port()
+        self.workers = workers
+        self.startup_timeout = startup_timeout
+        self.proc: Optional[subprocess.Popen] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def pid(self) -> int:
+        assert self.proc is not None
+        return self.proc.pid
+
+    def __enter__(self) -> "AppServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        command = [sys.executable, "-m", "uvicorn", "app.app:app"]
+        command += ["--port", str(self.port), "--workers", str(self.workers)]
+        self.proc = subprocess.Popen(
+            command, env={**os.environ, **self.env}, cwd=BACKEND_DIR
+        )
+        try:
+            self.wait_ready()
+        except BaseException:
+            self.stop()
+            raise
+
+    def wait_ready(self):
+        assert self.proc is not None
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {self.proc.returncode}")
+            try:
+                with urllib.request.urlopen(f"{self.url}/_health") as resp:
+                    if resp.status == 200:
+                        return
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(0.05)
+        raise TimeoutError(f"{self.url} was not ready within {self.startup_timeout}s")
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
@@ -0,0 +1,10 @@
+import os
+from unittest import mock
+
+# lib.slack creates the Bolt app at import time, which verifies the token
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-test")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "test-secret")
+mock.patch(
+    "slack_sdk.WebClient.auth_test",
+    return_value={"ok": True, "user_id": "UBOT", "bot_id": "BBOT", "team_id": "T1"},
+).start()
@@ -0,0 +1,196 @@
+# A local fake of the OpenAI API for tests and benchmarks.
+
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+EMBEDDING_DIM = 16
+# A 1x1 transparent PNG
+FAKE_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR4nGNgYGBgAAAABQABpfZFQAAA"
+    "AABJRU5ErkJggg=="
+)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> list[float]:
+    digest = hashlib.sha256(text.encode()).digest()
+    return [b / 255 for b in digest[:dim]]
+
+
+class FakeOpenAIServer:
+    """Serve a subset of the OpenAI API on localhost with an artificial latency
+
+    Usage::
+
+        with FakeOpenAIServer(latency=0.05) as server:
+            openai.api_base = server.api_base
+            ...
+            assert server.calls["/v1/embeddings"] == 1
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        max_rps: Optional[float] = None,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        # Requests per second accepted before answering 429, like OpenAI's limits
+        self.max_rps = max_rps
+        self.rate_limited = 0
+        # Fraction of the requests answered with 500
+        self.error_rate = error_rate
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._allowance = max_rps or 0.0
+        self._allowance_updated = time.monotonic()
+        self.calls: dict[str, int] = {}
+        # TCP connections accepted, to check that clients keep them alive
+        self.connections = 0
+        self.requests: list[tuple[str, Any]] = []
+        self._lock = threading.Lock()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        assert self._httpd is not None
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                status, resp = server.handle(self.path, self.headers, body)
+                if isinstance(resp, list):
+                    # Server-sent events of a streamed completion
+                    events = [f"data: {json.dumps(e)}\n\n" for e in resp]
+                    data = "".join([*events, "data: [DONE]\n\n"]).encode()
+                    content_type = "text/event-stream"
+                else:
+                    data = json.dumps(resp).encode()
+                    content_type = "application/json"
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                    self.send_header("x-ratelimit-remaining-requests", "0")
+                    self.send_header("x-ratelimit-reset-requests", "1s")
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def handle(self, path: str, headers: Any, body: bytes) -> tuple[int, Any]:
+        """Status and JSON response, or a list of events for a streamed one"""
+        with self._lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+        is_json = headers.get("Content-Type", "").startswith("application/json")
+        payload = json.loads(body) if body and is_json else None
+        with self._lock:
+            self.requests.append((path, payload))
+            if self.max_rps is not None and not self._take_allowance():
+                self.rate_limited += 1
+                return 429, {
+                    "error": {
+                        "message": "Rate limit reached for requests",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }
+                }
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return 500, {
+                    "error": {
+                        "message": "The server had an error while processing",
+                        "type": "server_error",
+                    }
+                }
+        if self.latency:
+            time.sleep(self.latency)
+        if path == "/v1/embeddings":
+            inputs = payload["input"]
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            data = [
+                {"object": "embedding", "index": i, "embedding": fake_embedding(t)}
+                for i, t in enumerate(inputs)
+            ]
+            return 200, {"object": "list", "data": data, "model": payload["model"]}
+        if path == "/v1/completions":
+            text = f"echo: {payload['prompt'][-20:]}"
+            if payload.get("stream"):
+                return 200, [
+                    {
+                        "object": "text_completion",
+                        "model": payload["model"],
+                        "choices": [{"text": token, "index": 0}],
+                    }
+                    for token in text
+                ]
+            return 200, {
+                "object": "text_completion",
+                "model": payload["model"],
+                "choices": [{"text": text, "index": 0, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": 1,
+                    "completion_tokens": 1,
+                    "total_tokens": 2,
+                },
+            }
+        if path == "/v1/edits":
+            return 200, {
+                "object": "edit",
+                "choices": [{"text": payload["input"], "index": 0}],
+            }
+        if path in ("/v1/images/generations", "/v1/images/variations"):
+            image = base64.b64encode(FAKE_PNG).decode()
+            return 200, {"data": [{"b64_json": image} for _ in range(3)]}
+        return 404, {"error": {"message": f"Unknown path: {path}", "type": "invalid"}}
+
+    def _take_allowance(self) -> bool:
+        now = time.monotonic()
+        elapsed = now - self._allowance_updated
+        self._allowance = min(self.max_rps, self._allowance + elapsed * self.max_rps)
+        self._allowance_updated = now
+        if self._allowance < 1:
+            return False
+        self._allowance -= 1
+        return True
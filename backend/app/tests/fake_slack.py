@@ -0,0 +1,300 @@
+# A local fake of the Slack Web API for tests and benchmarks.
+
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl
+
+from .fake_openai import FAKE_PNG
+
+
+class FakeSlackServer:
+    """Serve a subset of the Slack Web API on localhost with an artificial latency
+
+    Usage::
+
+        with FakeSlackServer(latency=0.05) as server:
+            client = WebClient(token="xoxb-test", base_url=server.base_url)
+            ...
+            assert server.calls["conversations.replies"] == 1
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        max_rps: Optional[float] = None,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        # Requests per second of each method accepted before answering 429
+        self.max_rps = max_rps
+        # Fraction of the requests answered with 500
+        self.error_rate = error_rate
+        self.errors = 0
+        # Called with the method and the parameters of every request that succeeds
+        self.listener: Optional[Callable[[str, dict[str, Any]], None]] = None
+        # Served at /files/<name>, e.g. for `url_private` of file_share events
+        self.files: dict[str, bytes] = {"image.png": FAKE_PNG}
+        self._random = random.Random(seed)
+        self._allowances: dict[str, tuple[float, float]] = {}
+        self._file_ids = itertools.count(1)
+        self.calls: dict[str, int] = {}
+        self.requests: list[tuple[str, dict[str, str]]] = []
+        # Messages of each (channel, thread_ts), oldest first
+        self.threads: dict[tuple[str, str], list[dict[str, Any]]] = {}
+        # Names of the public channels the bot is a member of, by ID
+        self.channels: dict[str, str] = {}
+        # Matches returned by search.messages for any query
+        self.search_matches: list[dict[str, Any]] = []
+        # Number of upcoming calls of each method answered with 429
+        self.rate_limited: dict[str, int] = {}
+        self._clock = 1700000000.0
+        self._lock = threading.Lock()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/api/"
+
+    @property
+    def url(self) -> str:
+        assert self._httpd is not None
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def file_url(self, name: str) -> str:
+        return f"{self.url}/files/{name}"
+
+    def __enter__(self) -> "FakeSlackServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                data = server.files.get(self.path.removeprefix("/files/"))
+                if data is None:
+                    self.send_response(404)
+                    data = b"Not Found"
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                if self.path.startswith("/upload/"):
+                    # Upload URL returned by files.getUploadURLExternal
+                    data = f"OK - {len(raw)}".encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                body = raw.decode()
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body) if body else {}
+                else:
+                    params = dict(parse_qsl(body))
+                method = self.path.removeprefix("/api/").split("?")[0]
+                if server._take_rate_limited(method):
+                    data = b'{"ok": false, "error": "ratelimited"}'
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                elif server._take_error():
+                    data = b'{"ok": false, "error": "internal_error"}'
+                    self.send_response(500)
+                else:
+                    data = json.dumps(server.handle(method, params)).encode()
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def post(
+        self,
+        channel: str,
+        user: str,
+        text: str,
+        thread_ts: Optional[str] = None,
+        ts: Optional[str] = None,
+    ) -> str:
+        """Add a message to a thread (a new one if `thread_ts` is None)"""
+        with self._lock:
+            if ts is None:
+                self._clock += 1
+                ts = f"{self._clock:.6f}"
+            message = {"type": "message", "ts": ts, "user": user, "text": text}
+            if thread_ts is None:
+                thread_ts = ts
+            message["thread_ts"] = thread_ts
+            self.threads.setdefault((channel, thread_ts), []).append(message)
+            return ts
+
+    def _take_rate_limited(self, method: str) -> bool:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.rate_limited.get(method, 0) > 0:
+                self.rate_limited[method] -= 1
+                return True
+            if self.max_rps is None:
+                return False
+            now = time.monotonic()
+            allowance, updated = self._allowances.get(method, (self.max_rps, now))
+            allowance = min(self.max_rps, allowance + (now - updated) * self.max_rps)
+            limited = allowance < 1
+            self._allowances[method] = (allowance if limited else allowance - 1, now)
+            return limited
+
+    def _take_error(self) -> bool:
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def handle(self, method: str, params: dict[str, Any]) -> dict[str, Any]:
+        with self._lock:
+            self.requests.append((method, params))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.listener is not None:
+            self.listener(method, params)
+        if method == "auth.test":
+            return {"ok": True, "user_id": "UBOT", "bot_id": "BBOT", "team_id": "T1"}
+        if method == "conversations.replies":
+            return self._conversations_replies(params)
+        if method == "conversations.list":
+            return self._conversations_list(params)
+        if method == "conversations.history":
+            return self._conversations_history(params)
+        if method == "search.messages":
+            return self._search_messages(params)
+        if method == "chat.postMessage":
+            ts = self.post(
+                params["channel"], "UBOT", params["text"], params.get("thread_ts")
+            )
+            message = {"ts": ts, "user": "UBOT", "text": params["text"]}
+            return {
+                "ok": True,
+                "channel": params["channel"],
+                "ts": ts,
+                "message": message,
+            }
+        if method == "chat.update":
+            with self._lock:
+                for messages in self.threads.values():
+                    for m in messages:
+                        if m["ts"] == params["ts"]:
+                            m["text"] = params["text"]
+            return {"ok": True, "channel": params["channel"], "ts": params["ts"]}
+        if method == "files.getUploadURLExternal":
+            file_id = f"F{next(self._file_ids)}"
+            upload_url = f"{self.url}/upload/{file_id}"
+            return {"ok": True, "upload_url": upload_url, "file_id": file_id}
+        if method == "files.completeUploadExternal":
+            files = json.loads(params["files"])
+            return {"ok": True, "files": [{"id": f["id"]} for f in files]}
+        return {"ok": False, "error": "unknown_method"}
+
+    def _conversations_replies(self, params: dict[str, Any]) -> dict[str, Any]:
+        with self._lock:
+            thread = list(self.threads.get((params["channel"], params["ts"]), []))
+        if not thread:
+            return {"ok": False, "error": "thread_not_found"}
+        # Like Slack, the parent message is returned regardless of `oldest`
+        oldest = float(params.get("oldest", 0))
+        messages = thread[:1] + [m for m in thread[1:] if float(m["ts"]) > oldest]
+        limit = int(params.get("limit", 100))
+        offset = int(params.get("cursor") or 0)
+        page = messages[offset : offset + limit]
+        next_cursor = str(offset + limit) if offset + limit < len(messages) else ""
+        return {
+            "ok": True,
+            "messages": page,
+            "has_more": bool(next_cursor),
+            "response_metadata": {"next_cursor": next_cursor},
+        }
+
+    def _page(self, items: list[Any], params: dict[str, Any]) -> tuple[list[Any], str]:
+        limit = int(params.get("limit", 100))
+        offset = int(params.get("cursor") or 0)
+        next_cursor = str(offset + limit) if offset + limit < len(items) else ""
+        return items[offset : offset + limit], next_cursor
+
+    def _conversations_list(self, params: dict[str, Any]) -> dict[str, Any]:
+        channels = [
+            {"id": id, "name": name, "is_member": True, "is_private": False}
+            for id, name in self.channels.items()
+        ]
+        page, next_cursor = self._page(channels, params)
+        return {
+            "ok": True,
+            "channels": page,
+            "response_metadata": {"next_cursor": next_cursor},
+        }
+
+    def _conversations_history(self, params: dict[str, Any]) -> dict[str, Any]:
+        # The parent messages of the channel, newest first
+        oldest = float(params.get("oldest", 0))
+        with self._lock:
+            messages = [
+                thread[0]
+                for (channel, _), thread in self.threads.items()
+                if channel == params["channel"] and float(thread[0]["ts"]) > oldest
+            ]
+        messages.sort(key=lambda m: float(m["ts"]), reverse=True)
+        page, next_cursor = self._page(messages, params)
+        return {
+            "ok": True,
+            "messages": page,
+            "has_more": bool(next_cursor),
+            "response_metadata": {"next_cursor": next_cursor},
+        }
+
+    def _search_messages(self, params: dict[str, Any]) -> dict[str, Any]:
+        count = min(int(params.get("count", 20)), 100)
+        page = int(params.get("page", 1))
+        total = len(self.search_matches)
+        return {
+            "ok": True,
+            "query": params["query"],
+            "messages": {
+                "total": total,
+                "matches": self.search_matches[(page - 1) * count : page * count],
+                "paging": {
+                    "count": count,
+                    "total": total,
+                    "page": page,
+                    "pages": max(1, -(-total // count)),
+                },
+            },
+        }
@@ -0,0 +1,110 @@
+# A local web server of HTML fixtures for tests and benchmarks of webqa.
+
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+LAST_MODIFIED = "Wed, 01 Mar 2023 00:00:00 GMT"
+WORDS = ["猫", "犬", "天気", "会議", "予定", "Python", "Slack", "ラーメン", "旅行", "本"]
+
+
+def make_article(title: str, n_paragraphs: int, sentences: int = 8) -> str:
+    """A deterministic Japanese article that trafilatura recognises as the content"""
+    paragraphs = []
+    for i in range(n_paragraphs):
+        text = "".join(
+            f"{title}の{i}段落{j}文目では{WORDS[(i + j) % len(WORDS)]}について"
+            f"{WORDS[(i * j) % len(WORDS)]}と比べながら詳しく説明します。"
+            for j in range(sentences)
+        )
+        paragraphs.append(f"<p>{text}</p>")
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        f"<title>{title}</title></head><body>"
+        "<nav><a href='/'>ホーム</a></nav>"
+        f"<article><h1>{title}</h1>{''.join(paragraphs)}</article>"
+        "<footer>Copyright</footer></body></html>"
+    )
+
+
+class FakeWebServer:
+    """Serve `pages` (path → HTML) on localhost with an artificial latency
+
+    Pages have an ETag and a Last-Modified, and conditional requests are answered
+    with 304 while the page is unchanged.
+
+    Usage::
+
+        with FakeWebServer({"/a": make_article("A", 10)}) as server:
+            url = server.url("/a")
+            ...
+            assert server.calls["/a"] == 1
+    """
+
+    def __init__(self, pages: dict[str, str], latency: float = 0.0):
+        self.pages = pages
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._httpd: Optional[ThreadingHTTPServer] = None
+
+    def url(self, path: str) -> str:
+        assert self._httpd is not None
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def __enter__(self) -> "FakeWebServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with server._lock:
+                    server.calls[self.path] = server.calls.get(self.path, 0) + 1
+                if server.latency:
+                    time.sleep(server.latency)
+                page = server.pages.get(self.path)
+                if page is None:
+                    self.send_response(404)
+                    data = b"Not Found"
+                else:
+                    data = page.encode()
+                    etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        with server._lock:
+                            server.not_modified += 1
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", LAST_MODIFIED)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
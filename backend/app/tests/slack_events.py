@@ -0,0 +1,196 @@
+# Signed Slack Events API payloads for tests and benchmarks.
+
+import hashlib
+import hmac
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional, Sequence
+
+BOT_USER = "UBOT"
+EVENT_COMMANDS = (
+    "chat",
+    "chat_next",
+    "text",
+    "textedit",
+    "code",
+    "image",
+    "image_variation",
+    "slacksearch",
+    "webqa",
+)
+WORDS = ["猫", "犬", "天気", "会議", "予定", "Python", "Slack", "ラーメン", "旅行", "本"]
+
+
+def sign(body: bytes, secret: str, timestamp: Optional[int] = None) -> dict[str, str]:
+    """Headers of a request signed like Slack does with the signing secret"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    basestring = f"v0:{timestamp}:".encode() + body
+    digest = hmac.new(secret.encode(), basestring, hashlib.sha256).hexdigest()
+    return {
+        "Content-Type": "application/json",
+        "X-Slack-Request-Timestamp": str(timestamp),
+        "X-Slack-Signature": f"v0={digest}",
+    }
+
+
+def envelope(event: dict[str, Any], event_id: str, team_id: str = "T1") -> dict:
+    return {
+        "token": "verification-token",
+        "team_id": team_id,
+        "api_app_id": "A1",
+        "type": "event_callback",
+        "event_id": event_id,
+        "event_time": int(float(event["ts"])),
+        "event": event,
+    }
+
+
+def app_mention(channel: str, user: str, text: str, ts: str) -> dict[str, Any]:
+    return {
+        "type": "app_mention",
+        "channel": channel,
+        "user": user,
+        "text": f"<@{BOT_USER}> {text}",
+        "ts": ts,
+        "event_ts": ts,
+    }
+
+
+def thread_message(
+    channel: str, user: str, text: str, ts: str, thread_ts: str
+) -> dict[str, Any]:
+    return {
+        "type": "message",
+        "channel": channel,
+        "channel_type": "channel",
+        "user": user,
+        "text": text,
+        "ts": ts,
+        "thread_ts": thread_ts,
+        "event_ts": ts,
+    }
+
+
+def file_share(channel: str, user: str, file_url: str, ts: str) -> dict[str, Any]:
+    return {
+        "type": "message",
+        "subtype": "file_share",
+        "channel": channel,
+        "channel_type": "channel",
+        "user": user,
+        "text": "",
+        "ts": ts,
+        "event_ts": ts,
+        "files": [
+            {
+                "id": f"F{ts.replace('.', '')}",
+                "filetype": "png",
+                "url_private": file_url,
+            }
+        ],
+    }
+
+
+@dataclass
+class SlackEvent:
+    # What the event exercises, e.g. `chat` or `image_variation`
+    command: str
+    payload: dict[str, Any]
+    # Messages of the thread that must exist before the event is sent, as
+    # (user, text, ts), the parent first
+    thread: list[tuple[str, str, str]] = field(default_factory=list)
+
+    @property
+    def event(self) -> dict[str, Any]:
+        return self.payload["event"]
+
+    def signed(self, secret: str) -> tuple[bytes, dict[str, str]]:
+        body = json.dumps(self.payload).encode()
+        return body, sign(body, secret)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"command": self.command, "payload": self.payload, "thread": self.thread}
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> "SlackEvent":
+        thread = [tuple(m) for m in d.get("thread", [])]
+        return cls(d["command"], d["payload"], thread)  # type: ignore
+
+
+class EventGenerator:
+    """Events of the commands in proportion to `mix`, each from a distinct user
+
+    Usage::
+
+        generator = EventGenerator({"chat": 2, "image": 1}, file_url=..., web_urls=...)
+        for event in generator.generate(100):
+            body, headers = event.signed(secret)
+    """
+
+    def __init__(
+        self,
+        mix: dict[str, float],
+        seed: int = 0,
+        channels: int = 10,
+        file_url: str = "",
+        web_urls: Sequence[str] = (),
+    ):
+        unknown = set(mix) - set(EVENT_COMMANDS)
+        if unknown:
+            raise ValueError(f"Unknown commands: {sorted(unknown)}")
+        if mix.get("webqa") and not web_urls:
+            raise ValueError("webqa events need web_urls")
+        self.mix = mix
+        self.channels = channels
+        self.file_url = file_url
+        self.web_urls = list(web_urls)
+        self._random = random.Random(seed)
+        self._clock = 1700000000
+
+    def generate(self, n: int) -> list[SlackEvent]:
+        commands = self._random.choices(
+            list(self.mix), weights=list(self.mix.values()), k=n
+        )
+        return [self.make(command, i) for i, command in enumerate(commands)]
+
+    def make(self, command: str, i: int) -> SlackEvent:
+        channel = f"C{i % self.channels:03d}"
+        user = f"U{i:06d}"
+        ts = self._ts()
+        words = "".join(self._random.choices(WORDS, k=self._random.randint(5, 20)))
+
+        if command == "chat_next":
+            thread_ts, reply_ts = ts, self._ts()
+            ts = self._ts()
+            thread = [
+                (user, f"<@{BOT_USER}> chat {words}", thread_ts),
+                (BOT_USER, f"{words}についてですね。", reply_ts),
+                (user, f"{words}をもっと詳しく", ts),
+            ]
+            event = thread_message(channel, user, thread[-1][1], ts, thread_ts)
+            return SlackEvent(command, envelope(event, f"Ev{i:08d}"), thread)
+        if command == "image_variation":
+            event = file_share(channel, user, self.file_url, ts)
+            return SlackEvent(command, envelope(event, f"Ev{i:08d}"))
+
+        if command == "textedit":
+            text = f"textedit {words}\ninstruction\n丁寧語にしてください"
+        elif command == "code":
+            text = f"code # {words}\ndef fib(n):"
+        elif command == "image":
+            text = f"image {words}の絵"
+        elif command == "slacksearch":
+            text = f"slacksearch {self._random.choice(WORDS)}"
+        elif command == "webqa":
+            url = self._random.choice(self.web_urls)
+            text = f"webqa <{url}> {self._random.choice(WORDS)}について教えて"
+        else:
+            text = f"{command} {words}"
+        event = app_mention(channel, user, text, ts)
+        return SlackEvent(command, envelope(event, f"Ev{i:08d}"))
+
+    def _ts(self) -> str:
+        self._clock += 1
+        return f"{self._clock}.000100"
@@ -0,0 +1,20 @@
+import pytest
+
+from lib.activity import Activity
+
+
+def test_activity():
+    activity = Activity(window=300)
+    start = activity.started_at
+    assert activity.to_dict(start)["last_event_at"] is None
+
+    for i in range(10):
+        activity.record(start + 30 + i)
+    # Right after a resume the rate is over the time elapsed since then
+    assert activity.rate(start + 120) == pytest.approx(10 * 60 / 120)
+    assert activity.rate(start + 320) == pytest.approx(10 * 60 / 300)
+    assert activity.rate(start + 400) == 0
+
+    signal = activity.to_dict(start + 400)
+    assert signal["events"] == 10
+    assert signal["last_event_at"] == start + 39
@@ -1,9 +1,78 @@
-from chalice.test import Client
+import json
+import time
+import urllib.error
+import urllib.request
 
-from app import app
+import pytest
 
+from .app_server import AppServer
+from .fake_slack import FakeSlackServer
+from .slack_events import SlackEvent, app_mention, envelope
 
-def test_health():
-    with Client(app) as client:
-        response = client.http.get("/_health")
-        assert response.json_body == {"status": "ok"}
+SIGNING_SECRET = "test-app-secret"
+
+
+@pytest.fixture(scope="module")
+def server():
+    with FakeSlackServer() as slack:
+        env = {
+            "SLACK_BOT_TOKEN": "xoxb-test",
+            "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+            "SLACK_API_URL": slack.base_url,
+            "STARTUP_WARMUP": "0",
+        }
+        with AppServer(env, startup_timeout=60) as app:
+            yield app, slack
+
+
+def post(url: str, body: bytes, headers: dict[str, str]) -> int:
+    request = urllib.request.Request(url, data=body, headers=headers)
+    try:
+        with urllib.request.urlopen(request) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_health(server):
+    app, _ = server
+    with urllib.request.urlopen(f"{app.url}/_health") as resp:
+        assert json.load(resp) == {"status": "ok"}
+
+
+def test_signed_event_is_answered(server):
+    app, slack = server
+    event = app_mention("C1", "U1", "help", "1700000000.000100")
+    body, headers = SlackEvent("help", envelope(event, "Ev1")).signed(SIGNING_SECRET)
+    assert post(f"{app.url}/slack/events", body, headers) == 200
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        replies = [p for m, p in slack.requests if m == "chat.postMessage"]
+        if replies:
+            break
+        time.sleep(0.05)
+    assert replies and "コマンド一覧" in replies[0]["text"]
+
+    # The span of the command ends after its reply has been posted
+    span = 'openai_bot_span_seconds_count{span="command_help",command="help"}'
+    while time.monotonic() < deadline:
+        with urllib.request.urlopen(f"{app.url}/metrics") as resp:
+            assert resp.headers["Content-Type"].startswith("text/plain")
+            metrics = resp.read().decode()
+        if span in metrics:
+            break
+        time.sleep(0.05)
+    assert span in metrics
+
+    with urllib.request.urlopen(f"{app.url}/_activity") as resp:
+        activity = json.load(resp)
+    assert activity["events"] >= 1
+    assert activity["last_event_at"] >= activity["started_at"]
+
+
+def test_unsigned_event_is_rejected(server):
+    app, _ = server
+    event = app_mention("C1", "U2", "help", "1700000001.000100")
+    body, headers = SlackEvent("help", envelope(event, "Ev2")).signed("wrong-secret")
+    assert post(f"{app.url}/slack/events", body, headers) == 401
@@ -0,0 +1,120 @@
+import multiprocessing
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from lib.idempotency import DONE, IN_PROGRESS, EventStore, MemoryBackend, SQLiteBackend
+
+from .app_server import AppServer
+from .fake_slack import FakeSlackServer
+from .slack_events import SlackEvent, app_mention, envelope
+
+SIGNING_SECRET = "test-idempotency-secret"
+
+
+def make_store(backend: str, tmp_path, **kwargs) -> EventStore:
+    if backend == "memory":
+        return EventStore(MemoryBackend(), **kwargs)
+    return EventStore(SQLiteBackend(str(tmp_path / "events.db")), **kwargs)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_event_states(backend, tmp_path):
+    store = make_store(backend, tmp_path, lease=0.2, ttl=60)
+    assert store.begin("Ev1")
+    assert store.backend.state("Ev1") == IN_PROGRESS
+    assert not store.begin("Ev1", retry=True)
+    store.complete("Ev1")
+    assert store.backend.state("Ev1") == DONE
+    store.release("Ev1")  # finished events are kept
+    assert not store.begin("Ev1", retry=True)
+
+    # A retry after an error is accepted once
+    assert store.begin("Ev2")
+    store.release("Ev2")
+    assert store.begin("Ev2", retry=True)
+    assert not store.begin("Ev2", retry=True)
+
+    # So is a retry after the lease of a dead worker expired
+    time.sleep(0.3)
+    assert store.begin("Ev2", retry=True)
+    assert store.stats.to_dict() == {
+        "accepted": 2,
+        "retries_accepted": 2,
+        "duplicates": 3,
+        "released": 2,
+        "errors": 0,
+    }
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_concurrent_claims(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    barrier = threading.Barrier(16)
+
+    def claim(_) -> bool:
+        barrier.wait()
+        return store.begin("Ev1")
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(claim, range(16)))
+    assert results.count(True) == 1
+
+
+def claim_all(path: str, keys: list[str], start: float) -> list[str]:
+    store = EventStore(SQLiteBackend(path))
+    time.sleep(max(0.0, start - time.time()))
+    return [key for key in keys if store.begin(key)]
+
+
+def test_concurrent_claims_across_processes(tmp_path):
+    path = str(tmp_path / "events.db")
+    SQLiteBackend(path)
+    keys = [f"Ev{i}" for i in range(100)]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(4) as pool:
+        start = time.time() + 1.0
+        claimed = pool.starmap(claim_all, [(path, keys, start)] * 4)
+    winners = [key for keys_claimed in claimed for key in keys_claimed]
+    assert sorted(winners) == sorted(keys)
+
+
+def post(url: str, event: SlackEvent, retry_num: int) -> int:
+    body, headers = event.signed(SIGNING_SECRET)
+    if retry_num:
+        headers["X-Slack-Retry-Num"] = str(retry_num)
+        headers["X-Slack-Retry-Reason"] = "http_timeout"
+    request = urllib.request.Request(url, data=body, headers=headers)
+    with urllib.request.urlopen(request) as resp:
+        return resp.status
+
+
+def test_same_event_on_several_workers(tmp_path):
+    with FakeSlackServer() as slack:
+        env = {
+            "SLACK_BOT_TOKEN": "xoxb-test",
+            "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+            "SLACK_API_URL": slack.base_url,
+            "STARTUP_WARMUP": "0",
+            "EVENT_STORE_URL": f"sqlite:///{tmp_path / 'events.db'}",
+        }
+        with AppServer(env, workers=3, startup_timeout=60) as app:
+            url = f"{app.url}/slack/events"
+            events = [
+                SlackEvent(
+                    "help",
+                    envelope(app_mention("C1", f"U{i}", "help", f"170000000{i}.0"), id),
+                )
+                for i, id in enumerate(["Ev1", "Ev2"])
+            ]
+            deliveries = [(event, n) for event in events for n in range(6)]
+            with ThreadPoolExecutor(max_workers=len(deliveries)) as executor:
+                statuses = list(executor.map(lambda d: post(url, *d), deliveries))
+            assert statuses == [200] * len(deliveries)
+
+            time.sleep(1.0)
+            replies = [p for m, p in slack.requests if m == "chat.postMessage"]
+    assert len(replies) == 2
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+from lib.jobs import JobQueue, QueueFull, parse_limits
+
+
+def test_parse_limits():
+    assert parse_limits("image=2, webqa=1") == {"image": 2, "webqa": 1}
+    assert parse_limits("") == {}
+
+
+def test_per_command_limit_and_backpressure():
+    queue = JobQueue(workers=4, max_queue=3, limits={"image": 1})
+    lock = threading.Lock()
+    running = {"image": 0, "text": 0}
+    peak = {"image": 0, "text": 0}
+    release = threading.Event()
+
+    def job(command):
+        with lock:
+            running[command] += 1
+            peak[command] = max(peak[command], running[command])
+        release.wait()
+        with lock:
+            running[command] -= 1
+
+    try:
+        for command in ("image", "text", "text"):
+            queue.submit(command, job, command)
+        time.sleep(0.1)
+        # Image jobs wait for the running one even though a worker is idle
+        for _ in range(3):
+            queue.submit("image", job, "image")
+        time.sleep(0.1)
+        assert queue.metrics()["queue_depth"] == 3
+        with pytest.raises(QueueFull):
+            queue.submit("image", job, "image")
+        release.set()
+        assert queue.join(timeout=5)
+    finally:
+        queue.stop()
+
+    metrics = queue.metrics()
+    assert peak == {"image": 1, "text": 2}
+    assert metrics["completed"] == 6 and metrics["rejected"] == 1
+    assert metrics["wait_time_max"] > 0
@@ -0,0 +1,85 @@
+import pytest
+
+from lib import tokenizer
+from lib.memory import ConversationMemory, speaker_names
+
+
+class FakeTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return list(range(len(text)))
+
+
+@pytest.fixture(autouse=True)
+def fake_tokenizer(monkeypatch):
+    monkeypatch.setattr(
+        tokenizer.tiktoken, "encoding_for_model", lambda model: FakeTokenizer()
+    )
+    tokenizer.clear_caches()
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls: list[tuple[str, str]] = []
+
+    def __call__(self, summary: str, lines: str) -> str:
+        self.calls.append((summary, lines))
+        return f"summary{len(self.calls)}"
+
+
+def test_speaker_names():
+    messages = [("U1", "a"), ("UBOT", "b"), ("U2", "c"), ("U1", "d")]
+    assert speaker_names(messages, "U1", "UBOT") == {
+        "UBOT": "Assistant",
+        "U1": "人間A",
+        "U2": "人間B",
+    }
+    assert speaker_names(messages[:2], "U1", "UBOT") == {
+        "UBOT": "Assistant",
+        "U1": "人間",
+    }
+    # Unknown bot user: the previous behaviour
+    assert speaker_names(messages, "U1", None)["U2"] == "Assistant"
+
+
+def test_format_thread_fits_short_threads():
+    memory = ConversationMemory(max_tokens=1000, summarize=FakeSummarizer())
+    messages = [("U1", "こんにちは"), ("UBOT", "こんにちは！"), ("U2", "元気？")]
+    thread = memory.format_thread(("C1", "1.0"), messages, "U2", "UBOT")
+    expected = "人間A: こんにちは\nAssistant: こんにちは！\n人間B: 元気？\nAssistant: "
+    assert thread == expected
+    assert memory.summary_calls == 0
+
+
+def test_format_thread_summarises_incrementally():
+    summarizer = FakeSummarizer()
+    memory = ConversationMemory(max_tokens=600, summarize=summarizer)
+    messages = []
+    for i in range(200):
+        usr = "UBOT" if i % 2 else f"U{i % 3}"
+        messages.append((usr, f"message {i:03d} " + "x" * 30))
+        thread = memory.format_thread(("C1", "1.0"), messages, usr, "UBOT")
+        assert len(thread) <= 600 + len("Assistant: ") + len(messages)
+        assert messages[-1][1] in thread
+
+    # Every summary extends the previous one with the turns that fell out since
+    assert 10 < len(summarizer.calls) < 50
+    assert [summary for summary, _ in summarizer.calls[1:]] == [
+        f"summary{i}" for i in range(1, len(summarizer.calls))
+    ]
+    folded = "\n".join(lines for _, lines in summarizer.calls)
+    for i in range(150):
+        assert folded.count(f"message {i:03d} ") == 1
+    assert thread.startswith(f"これまでの会話の要約: summary{len(summarizer.calls)}")
+
+
+def test_threads_opening_alike_keep_their_summaries():
+    summarizer = FakeSummarizer()
+    memory = ConversationMemory(max_tokens=100, summarize=summarizer)
+    first = [("U1", "hello")] + [("U1", f"first {i} " + "x" * 30) for i in range(5)]
+    second = [("U1", "hello")] + [("U1", f"second {i} " + "x" * 30) for i in range(5)]
+    memory.format_thread(("C1", "1.0"), first, "U1")
+    memory.format_thread(("C1", "2.0"), second, "U1")
+    assert "first" not in summarizer.calls[1][1]
+    thread = memory.format_thread(("C1", "1.0"), first, "U1")
+    assert thread.startswith("これまでの会話の要約: summary1")
+    assert len(summarizer.calls) == 2
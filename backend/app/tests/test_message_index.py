@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from lib.message_index import IndexedMessage, MessageIndex
+
+DIM = 32
+TS = 1700000000
+
+
+def clustered(rng: np.random.Generator, n: int, centres: np.ndarray) -> np.ndarray:
+    """Vectors around random `centres`, like embeddings of messages on a few topics"""
+    labels = rng.integers(0, len(centres), n)
+    return (centres[labels] + 0.3 * rng.standard_normal((n, DIM))).astype(np.float32)
+
+
+def messages(start: int, n: int, channels: int = 4) -> list[IndexedMessage]:
+    return [
+        IndexedMessage(f"C{i % channels}", f"{TS + i}.000100", "U1", f"message {i}")
+        for i in range(start, start + n)
+    ]
+
+
+def brute_force(embs: np.ndarray, query: np.ndarray, k: int) -> set[int]:
+    embs = embs / np.linalg.norm(embs, axis=1, keepdims=True)
+    return set(np.argsort(-(embs @ query))[:k].tolist())
+
+
+def row_ids(results) -> set[int]:
+    return {int(r.text.split()[1]) for r in results}
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    centres = rng.standard_normal((50, DIM))
+    return rng, centres, clustered(rng, 5000, centres)
+
+
+def test_search_before_and_after_training(tmp_path, data):
+    rng, centres, embs = data
+    index = MessageIndex(str(tmp_path), nprobe=8, min_train=1000)
+    for start in range(0, len(embs), 500):
+        index.add(messages(start, 500), embs[start : start + 500])
+        if start == 0:
+            # Exact until it is trained
+            query = clustered(rng, 1, centres)[0]
+            expected = brute_force(embs[:500], query / np.linalg.norm(query), 10)
+            assert row_ids(index.search(query, 10)) == expected
+        if index.needs_training():
+            index.train()
+    assert len(index) == 5000
+    assert index.nlist == int(np.sqrt(4000))
+
+    recall = []
+    for query in clustered(rng, 50, centres):
+        results = index.search(query, 10)
+        scores = [r.score for r in results]
+        assert scores == sorted(scores, reverse=True)
+        expected = brute_force(embs, query / np.linalg.norm(query), 10)
+        recall.append(len(row_ids(results) & expected) / 10)
+    assert np.mean(recall) >= 0.9
+
+
+def test_filters(tmp_path, data):
+    rng, centres, embs = data
+    # Few enough rows per channel to be searched exactly, but not in total
+    index = MessageIndex(str(tmp_path), min_train=1000, exact_limit=1500)
+    index.add(messages(0, 5000), embs)
+    index.train()
+    query = clustered(rng, 1, centres)[0]
+
+    results = index.search(query, 20, channels=["C1"])
+    assert {r.channel for r in results} == {"C1"}
+    c1 = [i for i in range(5000) if i % 4 == 1]
+    expected = {c1[i] for i in brute_force(embs[c1], query / np.linalg.norm(query), 20)}
+    assert row_ids(results) == expected
+
+    results = index.search(query, 20, oldest=TS + 2000, latest=TS + 2999)
+    assert len(results) == 20
+    assert all(TS + 2000 <= float(r.ts) <= TS + 2999 for r in results)
+    # Through the inverted lists
+    results = index.search(query, 20, channels=["C1", "C2"])
+    assert len(results) == 20 and {r.channel for r in results} <= {"C1", "C2"}
+    assert index.search(query, 10, channels=["C9"]) == []
+
+
+def test_edit_and_delete(tmp_path, data):
+    rng, centres, embs = data
+    index = MessageIndex(str(tmp_path), min_train=100)
+    index.add(messages(0, 200), embs[:200])
+    index.train()
+    first = messages(0, 1)[0]
+
+    # An edit replaces the message, which is found by its new content
+    edited = IndexedMessage(first.channel, first.ts, first.user, "message 0 edited")
+    index.add([edited], embs[300:301])
+    assert len(index) == 200
+    results = index.search(embs[300], 1)
+    assert results[0].text == "message 0 edited"
+    assert results[0].score == pytest.approx(1.0)
+    assert all(r.text != "message 0" for r in index.search(embs[0], 200))
+
+    assert index.delete(first.channel, first.ts)
+    assert not index.delete(first.channel, first.ts)
+    assert len(index) == 199
+    assert all(r.ts != first.ts for r in index.search(embs[300], 200))
+
+
+def test_reopen(tmp_path, data):
+    rng, centres, embs = data
+    index = MessageIndex(str(tmp_path), min_train=1000)
+    index.add(messages(0, 3000), embs[:3000])
+    index.train()
+    index.add(messages(3000, 1000), embs[3000:4000])
+    index.delete("C0", f"{TS}.000100")
+    index.set_channel_name("C1", "general")
+    query = clustered(rng, 1, centres)[0]
+    expected = index.search(query, 10)
+    index.close()
+
+    index = MessageIndex(str(tmp_path), min_train=1000)
+    assert len(index) == 3999
+    assert index.nlist == int(np.sqrt(3000))
+    assert index.search(query, 10) == expected
+    assert index.channel_id("general") == "C1"
+    assert index.latest_ts()["C3"] == f"{TS + 3999}.000100"
+    # New rows go to the existing lists until it has grown enough to retrain
+    index.add(messages(4000, 1000), embs[4000:])
+    assert len(index) == 4999
+    assert index.search(embs[4500], 1)[0].text == "message 4500"
+    assert not index.needs_training()
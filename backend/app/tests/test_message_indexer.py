@@ -0,0 +1,161 @@
+import datetime
+import hashlib
+
+import numpy as np
+import pytest
+from slack_sdk import WebClient
+
+from lib.message_index import MessageIndex
+from lib.slack import command
+from lib.slack.indexer import MessageIndexer, parse_event, parse_query
+
+from .fake_slack import FakeSlackServer
+
+DIM = 64
+
+
+def embed(texts: list[str]) -> list[np.ndarray]:
+    """Bag of words, so that messages sharing words are similar"""
+    embs = []
+    for text in texts:
+        emb = np.zeros(DIM, dtype=np.float32)
+        for word in text.lower().split():
+            emb[int(hashlib.sha256(word.encode()).hexdigest(), 16) % DIM] += 1
+        embs.append(emb)
+    return embs
+
+
+def message_event(channel: str, ts: str, text: str, **kwargs) -> dict:
+    return {
+        "type": "message",
+        "channel": channel,
+        "channel_type": "channel",
+        "user": "U1",
+        "ts": ts,
+        "text": text,
+        **kwargs,
+    }
+
+
+@pytest.fixture
+def indexer(tmp_path):
+    indexer = MessageIndexer(
+        MessageIndex(str(tmp_path)), batch_size=8, flush_interval=0.05, embed=embed
+    )
+    yield indexer
+    indexer.stop()
+
+
+def test_parse_event():
+    change = parse_event(message_event("C1", "1.0", "hello"))
+    assert change.message.text == "hello"
+    assert parse_event(message_event("C1", "1.0", "hi", bot_id="B1")) is None
+    assert (
+        parse_event(message_event("C1", "1.0", "joined", subtype="channel_join"))
+        is None
+    )
+    assert (
+        parse_event({**message_event("C1", "1.0", "hi"), "channel_type": "im"}) is None
+    )
+
+    edited = message_event(
+        "C1", "2.0", "", subtype="message_changed", message={"ts": "1.0", "text": "x"}
+    )
+    change = parse_event(edited)
+    assert (change.ts, change.message.text) == ("1.0", "x")
+    deleted = message_event(
+        "C1", "2.0", "", subtype="message_deleted", deleted_ts="1.0"
+    )
+    assert parse_event(deleted).message is None
+
+
+def test_parse_query():
+    channels = {"random": "C2"}
+    query = parse_query(
+        "deploy failures in:<#C1|general> in:#random after:2023-01-09", channels.get
+    )
+    assert query.text == "deploy failures"
+    assert query.channels == ["C1", "C2"]
+    jst = datetime.timezone(datetime.timedelta(hours=9))
+    assert query.oldest == datetime.datetime(2023, 1, 10, tzinfo=jst).timestamp()
+    assert query.latest is None
+
+    query = parse_query("on:2023-01-09 release")
+    assert query.text == "release" and query.channels is None
+    assert query.latest - query.oldest == 24 * 60 * 60
+
+
+def test_index_events(indexer):
+    texts = ["the deploy failed again", "lunch at noon", "deploy succeeded"]
+    for i, text in enumerate(texts):
+        indexer.submit(message_event("C1", f"170000000{i}.0", text))
+    assert indexer.join(timeout=5)
+    assert len(indexer.index) == 3
+    results = indexer.search("deploy failed", 1)
+    assert results[0]["text"] == "the deploy failed again"
+
+    indexer.submit(
+        message_event(
+            "C1",
+            "1700000010.0",
+            "",
+            subtype="message_changed",
+            message={"ts": "1700000001.0", "user": "U1", "text": "deploy failed lunch"},
+        )
+    )
+    indexer.submit(
+        message_event(
+            "C1",
+            "1700000011.0",
+            "",
+            subtype="message_deleted",
+            deleted_ts="1700000000.0",
+        )
+    )
+    assert indexer.join(timeout=5)
+    assert len(indexer.index) == 2
+    results = indexer.search("deploy failed", 1)
+    assert results[0]["text"] == "deploy failed lunch"
+    stats = indexer.stats.to_dict()
+    assert stats["indexed"] == 4 and stats["deleted"] == 1 and stats["errors"] == 0
+
+
+def test_backfill(indexer):
+    with FakeSlackServer() as slack:
+        slack.channels = {"C1": "general", "C2": "random"}
+        for i in range(500):
+            slack.post(f"C{i % 2 + 1}", "U1", f"message {i}")
+        client = WebClient(token="xoxb-test", base_url=slack.base_url)
+        # The fake posts its messages in November 2023
+        indexer.backfill_days = 10000
+        indexer.backfill(client)
+        assert len(indexer.index) == 500
+        assert slack.calls["conversations.history"] == 4
+
+        # Only the messages posted since are fetched next time
+        slack.post("C1", "U1", "message 500")
+        indexer.backfill(client)
+        assert len(indexer.index) == 501
+        assert indexer.stats.backfilled == 501
+
+    results = indexer.search("message 500 in:#general", 5)
+    assert results[0]["text"] == "message 500"
+    assert {r["channel_name"] for r in results} == {"general"}
+
+
+def test_slacksearch_uses_the_index(indexer, monkeypatch):
+    indexer.submit(message_event("C1", "1700000000.0", "the deploy failed"))
+    assert indexer.join(timeout=5)
+    summarized = []
+    monkeypatch.setattr(command, "message_indexer", indexer)
+    monkeypatch.setattr(
+        command,
+        "summarize_slack_messages",
+        lambda messages, query: summarized.append(messages) or "summary",
+    )
+    replies = []
+    command.command_slacksearch(
+        "deploy", 300, None, "U2", "C1", replies.append, user_token=""
+    )
+    assert replies == ["<@U2> summary"]
+    assert [m["text"] for m in summarized[0]] == ["the deploy failed"]
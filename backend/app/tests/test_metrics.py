@@ -0,0 +1,117 @@
+import asyncio
+
+import openai
+import pytest
+
+from lib.metrics import Histogram, command_label, registry, span, timed
+from lib.openai_client import COMPLETION_MODEL
+from lib.ratelimit import RateLimits
+from lib.slack.command import command_text
+from lib.slack.ratelimit import RateLimitedWebClient
+
+from .fake_openai import FakeOpenAIServer
+from .fake_slack import FakeSlackServer
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    registry.clear()
+    yield
+    registry.clear()
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "Latency", ("span",), buckets=(0.1, 1))
+    histogram.observe(0.05, span='say "hi"')
+    histogram.observe(0.5, span='say "hi"')
+    histogram.observe(5, span='say "hi"')
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{span="say \\"hi\\"",le="0.1"} 1',
+        'latency_seconds_bucket{span="say \\"hi\\"",le="1.0"} 2',
+        'latency_seconds_bucket{span="say \\"hi\\"",le="+Inf"} 3',
+        'latency_seconds_sum{span="say \\"hi\\""} 5.55',
+        'latency_seconds_count{span="say \\"hi\\""} 3',
+    ]
+
+
+def test_timed_functions():
+    @timed()
+    def sync():
+        pass
+
+    @timed("async")
+    async def coroutine():
+        await asyncio.sleep(0.01)
+
+    @timed("gen")
+    def generator():
+        yield 1
+        yield 2
+
+    @timed("fail")
+    def fail():
+        raise ValueError
+
+    with command_label("text"):
+        sync()
+        asyncio.run(coroutine())
+        assert list(generator()) == [1, 2]
+        with pytest.raises(ValueError):
+            fail()
+    sync()
+
+    name = "test_timed_functions.<locals>.sync"
+    assert registry.spans.count(span=name, command="text") == 1
+    assert registry.spans.count(span=name, command="") == 1
+    assert registry.spans.count(span="async", command="text") == 1
+    assert registry.spans.count(span="gen", command="text") == 1
+    assert registry.errors.get(span="fail", command="text") == 1
+    assert registry.errors.get(span="async", command="text") == 0
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(registry, "enabled", False)
+
+    @timed()
+    def sync():
+        return 1
+
+    assert sync() == 1
+    with span("block"):
+        pass
+    registry.record_tokens(COMPLETION_MODEL, {"prompt_tokens": 1})
+    assert all(line.startswith("#") for line in registry.render().splitlines())
+
+
+def test_command_is_instrumented(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    with FakeOpenAIServer() as server, FakeSlackServer() as slack:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        client = RateLimitedWebClient(
+            token="xoxb-test", base_url=slack.base_url, limits=RateLimits()
+        )
+
+        def say(text: str):
+            client.chat_postMessage(channel="C1", text=text)
+
+        with command_label("text"):
+            command_text("猫について", user="U1", say=say, nocache=True)
+
+    for name in (
+        "command_text",
+        "generate_text_completion",
+        "AsyncOpenAIClient.get_text_completion",
+        "slack.chat.postMessage",
+    ):
+        assert registry.spans.count(span=name, command="text") == 1
+    for type in ("prompt", "completion"):
+        tokens = registry.tokens.get(command="text", model=COMPLETION_MODEL, type=type)
+        assert tokens == 1
+    text = registry.render()
+    assert 'openai_bot_span_seconds_count{span="command_text",command="text"} 1' in text
+    assert (
+        "openai_bot_openai_tokens_total"
+        f'{{command="text",model="{COMPLETION_MODEL}",type="prompt"}} 1.0'
+    ) in text
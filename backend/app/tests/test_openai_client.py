@@ -0,0 +1,110 @@
+import cProfile
+import pstats
+import time
+
+import openai
+import pytest
+
+from lib import openai_client, tokenizer
+from lib.aio import run
+from lib.async_openai_client import AsyncOpenAIClient
+from lib.embedding_cache import EmbeddingCache
+from lib.openai_client import EMBEDDING_CONCURRENCY, OpenAIClient
+from lib.retrieval import IndexCache
+
+from .fake_openai import FakeOpenAIServer
+
+
+class FakeTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return list(range(len(text)))
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(openai_client, "embedding_cache", EmbeddingCache())
+    monkeypatch.setattr(openai_client, "index_cache", IndexCache())
+    monkeypatch.setattr(
+        tokenizer.tiktoken, "encoding_for_model", lambda model: FakeTokenizer()
+    )
+    tokenizer.clear_caches()
+    with FakeOpenAIServer(latency=0.05) as server:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        yield server
+
+
+def test_get_text_embeddings_batches(fake_openai):
+    chunks = [f"chunk {i:03d} " + "x" * 90 for i in range(100)]  # 100 tokens each
+    client = OpenAIClient()
+    start = time.perf_counter()
+    embs = client.get_text_embeddings(chunks, max_batch_tokens=1000)
+    elapsed = time.perf_counter() - start
+
+    assert fake_openai.calls["/v1/embeddings"] == 10
+    assert elapsed < 100 * fake_openai.latency / 2
+    expected = [client.get_text_embedding(c) for c in chunks[:3]]
+    assert [e.tolist() for e in embs[:3]] == [e.tolist() for e in expected]
+    assert len(embs) == 100
+
+
+def test_get_text_embeddings_respects_input_limit(fake_openai):
+    client = OpenAIClient()
+    embs = client.get_text_embeddings([str(i) for i in range(10)], max_batch_inputs=4)
+    assert fake_openai.calls["/v1/embeddings"] == 3
+    assert len(embs) == 10
+
+
+def test_create_context_reuses_cached_embeddings(fake_openai, tmp_path):
+    text = "これは最初の文です。" * 20 + "これは二番目の文です。" * 20
+    question = "二番目の文は？"
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite3"))
+    openai_client.embedding_cache = cache  # restored by the fixture
+
+    client = OpenAIClient()
+    context = client._create_context(question, text)
+    n_calls = fake_openai.calls["/v1/embeddings"]
+    assert client._create_context(question, text) == context
+    assert fake_openai.calls["/v1/embeddings"] == n_calls
+    assert cache.stats.misses > 1 and cache.stats.hits > 0
+
+    # The on-disk tier survives a restart
+    openai_client.embedding_cache = EmbeddingCache(path=cache.path)
+    openai_client.index_cache = IndexCache()
+    assert client._create_context(question, text) == context
+    assert fake_openai.calls["/v1/embeddings"] == n_calls
+    assert openai_client.embedding_cache.stats.disk_hits > 0
+
+
+def test_answer_question_on_text_encodes_each_text_once(fake_openai):
+    sentences = [f"{i}番目の文です。" for i in range(30)]
+    text = "".join(sentences)
+    client = OpenAIClient()
+    profiler = cProfile.Profile()
+    profiler.runcall(client.answer_question_on_text, text, "10番目の文は？")
+    stats = pstats.Stats(profiler).stats  # type: ignore
+
+    encode_calls = sum(
+        nc
+        for (file, _, func), (_, nc, *_) in stats.items()
+        if file == __file__ and func == "encode"
+    )
+    # Each sentence for splitting and the prompt for max_tokens
+    assert encode_calls == len(sentences) + 1
+
+
+def test_async_client_shares_connection_pool(fake_openai):
+    client = AsyncOpenAIClient()
+    chunks = [f"chunk {i:03d} " + "x" * 90 for i in range(20)]
+    embs = run(client.get_text_embeddings(chunks, max_batch_tokens=500))
+    assert fake_openai.calls["/v1/embeddings"] == 4
+    connections = fake_openai.connections
+    assert 0 < connections <= EMBEDDING_CONCURRENCY
+    assert run(client.get_text_completion("hello")) == "echo: hello"
+    assert len(run(client.get_image("cat"))) == 3
+    # Served on the connections kept alive since the embeddings
+    assert fake_openai.connections == connections
+
+    assert [e.tolist() for e in embs] == [
+        e.tolist() for e in OpenAIClient().get_text_embeddings(chunks)
+    ]
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+
+import openai
+import pytest
+
+from lib.ratelimit import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    RateLimiter,
+    RateLimits,
+    RetryBudget,
+    parse_duration,
+    retry_after,
+)
+from lib.slack.ratelimit import RateLimitedWebClient
+
+from .fake_openai import FakeOpenAIServer
+from .fake_slack import FakeSlackServer
+
+
+def test_parse_headers():
+    assert parse_duration("20") == 20
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("soon") is None
+    assert retry_after({"Retry-After": ["3"]}) == 3
+    headers = {
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "2s",
+        "x-ratelimit-remaining-tokens": "100",
+        "x-ratelimit-reset-tokens": "30s",
+    }
+    assert retry_after(headers) == 2
+    assert retry_after({}) is None
+
+
+def test_rate_limiter_serves_by_priority():
+    limiter = RateLimiter(rate=20, capacity=1)
+    limiter.acquire()
+    order = []
+
+    def acquire(name: str, level: int):
+        limiter.acquire(level)
+        order.append(name)
+
+    threads = [
+        threading.Thread(target=acquire, args=(f"bulk{i}", PRIORITY_BULK))
+        for i in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.01)
+    threads.append(
+        threading.Thread(target=acquire, args=("chat", PRIORITY_INTERACTIVE))
+    )
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+    assert order[0] == "chat"
+    assert sorted(order[1:]) == ["bulk0", "bulk1", "bulk2"]
+
+
+def test_rate_limiter_waits_on_the_event_loop():
+    limiter = RateLimiter(rate=20, capacity=1)
+    limiter.acquire()
+    order = []
+
+    async def acquire(name: str, level: int):
+        await limiter.acquire_async(level)
+        order.append(name)
+
+    async def main():
+        threads = threading.active_count()
+        bulk = [
+            asyncio.create_task(acquire(f"bulk{i}", PRIORITY_BULK)) for i in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        # No thread is held by the waiting tasks
+        assert limiter.waiting == 4 and threading.active_count() == threads
+        chat = asyncio.create_task(acquire("chat", PRIORITY_INTERACTIVE))
+        cancelled = asyncio.create_task(acquire("cancelled", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(chat, *bulk)
+
+    # A thread waiting next to the tasks is served by priority as well
+    thread = threading.Thread(target=limiter.acquire, args=(PRIORITY_BULK,))
+    thread.start()
+    time.sleep(0.01)
+    asyncio.run(main())
+    thread.join()
+    assert order == ["chat", "bulk0", "bulk1", "bulk2"]
+    assert order == ["chat", "bulk0", "bulk1", "bulk2"]
+    assert limiter.waiting == 0
+
+
+def test_rate_limiter_pause():
+    limiter = RateLimiter(rate=100, capacity=10)
+    limiter.pause(0.2)
+    assert not limiter.try_acquire()
+    assert limiter.acquire() >= 0.15
+
+
+def test_call_retries_rate_limited_requests(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    limits = RateLimits(base_delay=0.01)
+    with FakeOpenAIServer(max_rps=5) as server:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        monkeypatch.setattr(openai, "api_key", "sk-test")
+
+        def complete():
+            resp = openai.Completion.create(model="m", prompt="p", max_tokens=1)
+            return resp.choices[0].text
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(limits.call("openai:m", complete))
+            )
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(results) == 10
+    assert server.rate_limited > 0
+    assert limits.stats.retries >= server.rate_limited
+    assert limits.stats.failures == 0
+
+
+def test_call_gives_up():
+    limits = RateLimits(budget=RetryBudget(reserve=1), base_delay=0.01)
+    calls = []
+
+    def fail(e: Exception):
+        calls.append(e)
+        raise e
+
+    with pytest.raises(openai.error.RateLimitError):
+        limits.call(
+            "openai:m",
+            lambda: fail(
+                openai.error.RateLimitError("quota", code="insufficient_quota")
+            ),
+        )
+    assert len(calls) == 1
+
+    calls.clear()
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        limits.call("openai:m", lambda: fail(openai.error.ServiceUnavailableError()))
+    # One retry from the budget
+    assert len(calls) == 2
+    assert limits.stats.budget_exhausted == 1
+
+
+def test_slack_client_waits_for_retry_after():
+    limits = RateLimits()
+    with FakeSlackServer() as server:
+        server.rate_limited["chat.postMessage"] = 1
+        client = RateLimitedWebClient(
+            token="xoxb-test", base_url=server.base_url, limits=limits
+        )
+        start = time.perf_counter()
+        client.chat_postMessage(channel="C1", text="first")
+        client.chat_postMessage(channel="C1", text="second")
+        elapsed = time.perf_counter() - start
+
+    assert server.calls["chat.postMessage"] == 3
+    assert elapsed >= 1
+    assert limits.stats.rate_limited == 1 and limits.stats.retries == 1
+    # Only the channel that was rate limited is paused
+    assert set(limits._limiters) == {"slack:chat.postMessage:C1"}
+    assert limits.limits["slack:chat.postMessage"] == 60
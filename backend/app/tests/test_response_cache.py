@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from lib import tokenizer
+from lib.response_cache import MemoryBackend, ResponseCache, SQLiteBackend
+from lib.slack.command import Options, parse
+
+
+class FakeTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return list(range(len(text)))
+
+
+@pytest.fixture(autouse=True)
+def fake_tokenizer(monkeypatch):
+    monkeypatch.setattr(
+        tokenizer.tiktoken, "encoding_for_model", lambda model: FakeTokenizer()
+    )
+    tokenizer.clear_caches()
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_response_cache(backend, tmp_path):
+    if backend == "memory":
+        cache = ResponseCache(MemoryBackend(max_entries=2), ttl=0.2)
+    else:
+        cache = ResponseCache(SQLiteBackend(str(tmp_path / "db"), max_entries=2), 0.2)
+    calls = []
+
+    def call(prompt):
+        def fn():
+            calls.append(prompt)
+            return f"reply to {prompt}"
+
+        return cache.get_or_call("f", "model", (prompt,), 0.9, fn)
+
+    assert call("hello") == "reply to hello"
+    assert call("hello \r\n") == "reply to hello"  # normalised
+    assert calls == ["hello"]
+    assert cache.stats.hits == 1
+    assert cache.stats.saved_tokens == len("hello \r\n") + len("reply to hello")
+
+    cache.get_or_call("f", "model", ("hello",), 0.9, lambda: "fresh", nocache=True)
+    assert cache.get_or_call("f", "model", ("hello",), 0.0, lambda: "other") == "other"
+
+    call("a"), call("b"), call("hello")  # size-bounded eviction
+    assert calls == ["hello", "a", "b", "hello"]
+    time.sleep(0.3)  # TTL expiry
+    call("hello")
+    assert calls[-1] == "hello" and len(calls) == 5
+    assert cache.stats.hit_ratio == pytest.approx(1 / 7)
+
+
+def test_parse_nocache():
+    assert parse("<@U1> text nocache hello")[2].nocache
+    assert parse("<@U1> nocache hello")[:2] == ("text", ["hello"])
+    # Only the cached commands take the flag
+    assert parse("<@U1> chat nocache hello")[1:] == (["nocache hello"], Options())
+    command, args, options = parse("<@U1> code print(1)")
+    assert (command, args, options.nocache) == ("code", ["print(1)"], False)
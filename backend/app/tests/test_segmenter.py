@@ -0,0 +1,76 @@
+import sys
+import threading
+import time
+import types
+
+from lib.segmenter import GINZA_EXCLUDE, SegmenterRegistry, split_sentences_by_rule
+
+
+class FakeNLP:
+    pipe_names = ["tok2vec", "parser"]
+
+    def __call__(self, text: str):
+        return types.SimpleNamespace(sents=text.split("|"))
+
+
+def test_split_sentences_by_rule():
+    text = "「本当？」と彼は言った。すごい！！本当に？そうだ\n次の行"
+    assert split_sentences_by_rule(text) == [
+        "「本当？」と彼は言った。",
+        "すごい！！",
+        "本当に？",
+        "そうだ\n",
+        "次の行",
+    ]
+    assert split_sentences_by_rule("（笑）。『はい。』\n\n") == ["（笑）。", "『はい。』\n"]
+
+
+def test_load_once_under_concurrency(monkeypatch):
+    registry = SegmenterRegistry()
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return FakeNLP()
+
+    monkeypatch.setattr(registry, "_load", load)
+    barrier = threading.Barrier(8)
+    segmenters = []
+
+    def get():
+        barrier.wait()
+        segmenters.append(registry.get())
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert registry.loaded
+    assert [s("a|b") for s in segmenters] == [["a", "b"]] * 8
+
+
+def test_load_excludes_unused_components(monkeypatch):
+    loaded = []
+
+    def load(model: str, exclude: list[str]):
+        loaded.append((model, exclude))
+        return FakeNLP()
+
+    monkeypatch.setitem(sys.modules, "spacy", types.SimpleNamespace(load=load))
+    registry = SegmenterRegistry()
+    assert registry.get()("一文目。|二文目。") == ["一文目。", "二文目。"]
+    assert loaded == [("ja_ginza", GINZA_EXCLUDE)]
+    assert "parser" not in GINZA_EXCLUDE
+
+
+def test_fall_back_to_rules_without_ginza(monkeypatch):
+    # `import spacy` raises ImportError
+    monkeypatch.setitem(sys.modules, "spacy", None)
+    registry = SegmenterRegistry()
+    assert registry.get() is split_sentences_by_rule
+    assert registry.loaded
+    registry.reset()
+    assert not registry.loaded
@@ -0,0 +1,74 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pytest
+
+from lib import service
+from lib.singleflight import SingleFlight, request_key
+
+from .fake_openai import FakeOpenAIServer
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = []
+    barrier = threading.Barrier(10)
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return "result"
+
+    def request(_):
+        barrier.wait()
+        return flight.do("key", fetch)
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(request, range(10)))
+
+    assert results == ["result"] * 10
+    assert len(calls) == 1
+    assert flight.stats.calls == 1
+    assert flight.stats.coalesced + flight.stats.hits == 9
+    # Kept for a while afterwards
+    assert flight.do("key", fetch) == "result"
+    assert len(calls) == 1
+
+
+def test_results_expire_and_errors_are_not_kept():
+    flight = SingleFlight(ttl=0.1)
+    assert flight.do("key", lambda: 1) == 1
+    time.sleep(0.15)
+    assert flight.do("key", lambda: 2) == 2
+
+    # Expired results are dropped without waiting for the size bound
+    flight.do("other", lambda: 3)
+    time.sleep(0.15)
+    flight.do("last", lambda: 4)
+    assert list(flight._results) == ["last"]
+
+    with pytest.raises(ValueError):
+        flight.do("error", lambda: int("x"))
+    assert flight.do("error", lambda: 5) == 5
+    assert flight.stats.errors == 1
+
+
+def test_request_key_normalizes_whitespace():
+    assert request_key("f", "猫の絵 \r\n") == request_key("f", "猫の絵")
+    assert request_key("f", "a", "b") != request_key("f", "ab")
+
+
+def test_generate_image_coalesces_identical_prompts(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(service, "single_flight", SingleFlight())
+    with FakeOpenAIServer(latency=0.3) as server:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            prompts = ["猫の絵"] * 4 + ["犬の絵"]
+            results = list(executor.map(service.generate_image, prompts))
+
+    assert [reply for reply, _ in results] == ["画像ができたよ！"] * 5
+    assert all(len(images) == 3 for _, images in results)
+    assert server.calls["/v1/images/generations"] == 2
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+from slack_sdk import WebClient
+
+from lib import tokenizer
+from lib.slack.history import Message, ThreadHistory
+
+from .fake_slack import FakeSlackServer
+
+
+class FakeTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return list(range(len(text)))
+
+
+@pytest.fixture
+def fake_slack(monkeypatch):
+    monkeypatch.setattr(
+        tokenizer.tiktoken, "encoding_for_model", lambda model: FakeTokenizer()
+    )
+    tokenizer.clear_caches()
+    with FakeSlackServer(latency=0.02) as server:
+        yield server
+
+
+def fetch_naively(client: WebClient, channel: str, thread_ts: str) -> list[str]:
+    texts = []
+    cursor = None
+    while True:
+        resp = client.conversations_replies(
+            channel=channel, ts=thread_ts, limit=200, cursor=cursor
+        )
+        texts += [m["text"] for m in resp["messages"]]
+        cursor = resp["response_metadata"]["next_cursor"]
+        if not cursor:
+            return texts
+
+
+def test_thread_history_fetches_new_messages_only(fake_slack):
+    client = WebClient(token="xoxb-test", base_url=fake_slack.base_url)
+    thread_ts = fake_slack.post("C1", "U1", "message 0")
+    for i in range(1, 1000):
+        fake_slack.post("C1", f"U{i % 3}", f"message {i}", thread_ts)
+    history = ThreadHistory(max_messages=2000)
+
+    # The first fetch follows the pagination
+    messages = history.get(client, "C1", thread_ts)
+    assert [m.text for m in messages] == [f"message {i}" for i in range(1000)]
+    assert history.api_calls == 5
+
+    naive_elapsed = incremental_elapsed = 0.0
+    for i in range(1000, 1010):
+        fake_slack.post("C1", "U1", f"message {i}", thread_ts)
+        start = time.perf_counter()
+        expected = fetch_naively(client, "C1", thread_ts)
+        naive_elapsed += time.perf_counter() - start
+        start = time.perf_counter()
+        messages = history.get(client, "C1", thread_ts)
+        incremental_elapsed += time.perf_counter() - start
+        assert [m.text for m in messages] == expected
+
+    assert history.api_calls == 5 + 10
+    assert fake_slack.calls["conversations.replies"] == 5 + 10 + 10 * 6
+    assert incremental_elapsed < naive_elapsed / 3
+
+
+def test_thread_history_keeps_unfetched_messages(fake_slack, tmp_path):
+    client = WebClient(token="xoxb-test", base_url=fake_slack.base_url)
+    thread_ts = fake_slack.post("C1", "U1", "question")
+    history = ThreadHistory(path=str(tmp_path / "history.db"))
+    history.get(client, "C1", thread_ts)
+
+    # Someone replies while we are posting ours
+    fake_slack.post("C1", "U2", "interrupt", thread_ts)
+    ts = fake_slack.post("C1", "UBOT", "考え中...", thread_ts)
+    history.put("C1", thread_ts, Message(ts, "UBOT", "answer"))
+    texts = [m.text for m in history.get(client, "C1", thread_ts)]
+    assert texts == ["question", "interrupt", "考え中..."]
+
+    history.put("C1", thread_ts, Message(ts, "UBOT", "answer"))
+    fake_slack.post("C1", "U1", "thanks", thread_ts)
+    expected = ["question", "interrupt", "answer", "thanks"]
+    assert [m.text for m in history.get(client, "C1", thread_ts)] == expected
+
+    # Restored from SQLite after a restart
+    restarted = ThreadHistory(path=str(tmp_path / "history.db"))
+    assert [m.text for m in restarted.get(client, "C1", thread_ts)] == expected
+    assert restarted.api_calls == 1
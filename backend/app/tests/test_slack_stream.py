@@ -0,0 +1,60 @@
+import time
+
+from lib.metrics import registry
+from lib.ratelimit import DEFAULT_RATE_LIMITS
+from lib.slack import stream
+from lib.slack.stream import StreamingReply
+
+
+class FakeClient:
+    def __init__(self):
+        self.updates: list[str] = []
+
+    def chat_update(self, channel: str, ts: str, text: str):
+        self.updates.append(text)
+
+
+class FakeSay:
+    def __init__(self):
+        self.client = FakeClient()
+        self.messages: list[str] = []
+
+    def __call__(self, text: str, thread_ts=None):
+        self.messages.append(text)
+        return {"channel": "C1", "ts": "1.0"}
+
+
+def test_streaming_reply_coalesces_updates():
+    def tokens():
+        for i in range(100):
+            time.sleep(0.002)
+            yield f"{i} "
+
+    registry.clear()
+    say = FakeSay()
+    reply = StreamingReply(say, flush_tokens=30, min_interval=0.05)
+    reply.stream(tokens())
+
+    assert len(say.messages) == 1
+    assert 1 < len(say.client.updates) < 10
+    assert say.client.updates[-1] == " ".join(str(i) for i in range(100))
+    assert reply.time_to_first_token is not None
+    span = "slack.stream.time_to_first_token"
+    assert registry.spans.count(span=span, command="") == 1
+
+
+def test_streaming_reply_finalises_on_error():
+    def tokens():
+        yield "途中まで"
+        raise RuntimeError("boom")
+
+    say = FakeSay()
+    StreamingReply(say).stream(tokens())
+    assert say.client.updates[-1].startswith("途中まで")
+    assert "RuntimeError: boom" in say.client.updates[-1]
+
+
+def test_streaming_reply_stays_within_tier_3():
+    # One reply alone never uses up the shared chat.update bucket
+    per_minute = 60 / stream.DEFAULT_MIN_INTERVAL
+    assert per_minute < DEFAULT_RATE_LIMITS["slack:chat.update"]
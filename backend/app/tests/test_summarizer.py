@@ -0,0 +1,81 @@
+import time
+
+import openai
+import pytest
+from slack_sdk import WebClient
+
+from lib import tokenizer
+from lib.aio import run
+from lib.slack.command import search_messages
+from lib.summarizer import MapReduceSummarizer, SummaryConfig, dedup, pack
+
+from .fake_openai import FakeOpenAIServer
+from .fake_slack import FakeSlackServer
+
+
+class FakeTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return [ord(c) for c in text]
+
+    def decode(self, tokens: list[int]) -> str:
+        return "".join(chr(t) for t in tokens)
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(
+        tokenizer.tiktoken, "encoding_for_model", lambda model: FakeTokenizer()
+    )
+    tokenizer.clear_caches()
+    with FakeOpenAIServer(latency=0.2) as server:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        yield server
+
+
+def test_dedup_and_pack():
+    assert dedup(["a b", "a  b\n", "", "c"]) == ["a b", "c"]
+    assert pack([3, 3, 3, 5, 1], 6) == [[0, 1], [2], [3, 4]]
+    assert pack([10, 1], 5) == [[0], [1]]
+
+
+def test_summarize_map_reduce(fake_openai):
+    texts = [f"message {i:03d} " + "x" * 87 for i in range(300)]  # 100 tokens with "\n"
+    texts += texts[:50]
+    config = SummaryConfig(chunk_tokens=2500, total_tokens=20000)
+    summarizer = MapReduceSummarizer(config)
+
+    start = time.perf_counter()
+    result = run(summarizer.summarize(texts, "テスト"))
+    elapsed = time.perf_counter() - start
+
+    # 300 unique texts of which 200 fit in the budget: 8 chunks and one reduce
+    assert (result.n_texts, result.n_dropped) == (300, 100)
+    assert result.n_calls == fake_openai.calls["/v1/completions"] == 9
+    assert elapsed < 4 * fake_openai.latency
+    assert result.summary.startswith("echo: ")
+    prompts = [p["prompt"] for _, p in fake_openai.requests]
+    assert "message 199 " in "".join(prompts)
+    assert "message 200 " not in "".join(prompts)
+
+
+def test_summarize_truncates_long_texts(fake_openai):
+    config = SummaryConfig(chunk_tokens=100)
+    result = run(MapReduceSummarizer(config).summarize(["y" * 1000], "テスト"))
+    assert result.n_calls == 1
+    prompt = fake_openai.requests[0][1]["prompt"]
+    assert "y" * 100 in prompt and "y" * 101 not in prompt
+
+
+def test_search_messages_follows_pagination():
+    with FakeSlackServer() as server:
+        server.search_matches = [
+            {"permalink": f"https://example.slack.com/p{i}", "text": str(i)}
+            for i in range(250)
+        ]
+        client = WebClient(token="xoxb-test", base_url=server.base_url)
+        matches = search_messages(client, "query", 300, "xoxp-test")
+        assert [m["text"] for m in matches] == [str(i) for i in range(250)]
+        assert server.calls["search.messages"] == 3
+
+        assert len(search_messages(client, "query", 120, "xoxp-test")) == 120
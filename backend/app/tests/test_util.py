@@ -0,0 +1,94 @@
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from lib.util import DownloadTooLarge, crop_and_resize_image, download_file, save_image
+
+BODY = b"x" * 300_000
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.headers.append(self.headers.get("Authorization"))
+        self.send_response(200)
+        if self.path == "/sized":
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+        else:
+            # No Content-Length, so the cap has to be enforced while reading
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(BODY), 65536):
+                chunk = BODY[i : i + 65536]
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.headers = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_download_file(server):
+    url = f"http://127.0.0.1:{server.server_port}"
+    assert download_file(f"{url}/sized", "xoxb-test") == BODY
+    assert download_file(f"{url}/chunked") == BODY
+    assert server.headers == ["Bearer xoxb-test", None]
+
+    with pytest.raises(DownloadTooLarge):
+        download_file(f"{url}/sized", max_bytes=len(BODY) - 1)
+    with pytest.raises(DownloadTooLarge):
+        download_file(f"{url}/chunked", max_bytes=len(BODY) - 1)
+
+
+def test_crop_and_resize_image():
+    # Left third red, middle third green, right third blue
+    im = Image.new("RGB", (3000, 1000), (255, 0, 0))
+    im.paste((0, 255, 0), (1000, 0, 2000, 1000))
+    im.paste((0, 0, 255), (2000, 0, 3000, 1000))
+    src = io.BytesIO()
+    im.save(src, format="jpeg")
+
+    out = io.BytesIO()
+    crop_and_resize_image(io.BytesIO(src.getvalue()), out, size=(256, 256))
+    resized = Image.open(out)
+    assert resized.format == "PNG"
+    assert resized.size == (256, 256)
+    r, g, b = resized.convert("RGB").getpixel((128, 128))
+    assert g > 200 and r < 50 and b < 50
+
+    # Left half white, rotated 90 degrees clockwise by EXIF: the top becomes white
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    im = Image.new("RGB", (400, 200))
+    im.paste((255, 255, 255), (0, 0, 200, 200))
+    src = io.BytesIO()
+    im.save(src, format="jpeg", exif=exif)
+    out = io.BytesIO()
+    crop_and_resize_image(io.BytesIO(src.getvalue()), out, size=(100, 100))
+    rotated = Image.open(out).convert("L")
+    assert rotated.getpixel((90, 10)) > 200
+    assert rotated.getpixel((10, 90)) < 50
+
+
+def test_save_image_max_bytes():
+    noise = Image.effect_noise((512, 512), 100).convert("RGB")
+    out = io.BytesIO()
+    save_image(noise, out, max_bytes=500_000)
+    assert out.tell() <= 500_000
+    assert Image.open(out).mode == "P"
+
+    with pytest.raises(ValueError):
+        save_image(noise, io.BytesIO(), max_bytes=1000)
@@ -0,0 +1,189 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import openai
+import pytest
+
+from lib import tokenizer, webqa
+from lib.aio import run
+from lib.embedding_cache import EmbeddingCache
+from lib.page_cache import CachedPage, PageCache
+from lib.retrieval import IndexCache
+from lib.segmenter import registry as segmenter_registry
+from lib.slack.command import parse
+from lib.webqa import (
+    BlockedURL,
+    WebQAPipeline,
+    extract_text,
+    fetch_page,
+    split_sections,
+)
+
+from .fake_openai import FakeOpenAIServer
+from .fake_web import FakeWebServer, make_article
+
+
+class FakeTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return list(range(len(text)))
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr("lib.async_openai_client.embedding_cache", EmbeddingCache())
+    monkeypatch.setattr(webqa, "index_cache", IndexCache())
+    monkeypatch.setattr(webqa, "WEBQA_ALLOWED_HOSTS", {"127.0.0.1"})
+    # Always revalidated
+    monkeypatch.setattr(webqa, "page_cache", PageCache(fresh_for=0))
+    monkeypatch.setattr(
+        tokenizer.tiktoken, "encoding_for_model", lambda model: FakeTokenizer()
+    )
+    tokenizer.clear_caches()
+    with FakeOpenAIServer(latency=0.05) as server:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        yield server
+
+
+def test_parse_several_urls():
+    text = "<@UBOT> webqa <https://a.example/x> <https://b.example|b.example> 要約して"
+    command, args, _ = parse(text)
+    assert command == "webqa"
+    assert args == ["https://a.example/x", "https://b.example", "要約して"]
+
+
+def test_split_sections():
+    text = "".join(f"{i:03d}" * 10 + "\n" for i in range(100))  # 31 chars a line
+    sections = split_sections(text, max_chars=100)
+    assert "".join(sections) == text
+    assert all(len(s) <= 100 for s in sections)
+    assert len(sections) == 34
+
+
+def test_extract_text_on_a_process_pool():
+    html = make_article("猫", 3).encode()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        text = executor.submit(extract_text, html).result()
+    assert "猫の0段落0文目" in text
+    assert "Copyright" not in text
+
+
+def test_workers_load_the_segmenter_as_they_start(monkeypatch):
+    monkeypatch.setattr(webqa, "WEBQA_PROCESSES", 1)
+    segmenter_registry.reset()
+    try:
+        assert webqa.warm_up_process_pool() == [True]
+    finally:
+        webqa.shutdown_process_pool()
+    # but not in this process
+    assert not segmenter_registry.loaded
+
+
+def test_pipeline_answers_on_several_pages(fake_openai):
+    pages = {"/cat": make_article("猫", 40), "/dog": make_article("犬", 5)}
+    executor = ThreadPoolExecutor(max_workers=2)
+    with FakeWebServer(pages) as web:
+        urls = [web.url("/cat"), web.url("/dog"), web.url("/missing")]
+        pipeline = WebQAPipeline(executor=executor, section_chars=2000)
+        answer, result = run(pipeline.answer(urls, "猫について教えて"))
+
+        assert answer.startswith("echo: ")
+        assert list(result.failed) == [web.url("/missing")]
+        assert result.timings["fetch"].items == 3 - 1
+        assert result.timings["extract"].items == 2
+        # The long page is split and embedded section by section
+        assert result.timings["split"].items > 2
+        assert result.timings["embed"].items == result.timings["split"].items
+        texts = result.index.texts
+        assert any("猫の39段落" in t for t in texts)
+        assert any("犬の4段落" in t for t in texts)
+
+        # Pages that were already indexed are neither split nor embedded again
+        embeddings = fake_openai.calls["/v1/embeddings"]
+        result = run(pipeline.ingest(urls[:2]))
+        assert result.timings["split"].items == 0
+        assert len(result.index) == len(texts)
+        assert fake_openai.calls["/v1/embeddings"] == embeddings
+    executor.shutdown()
+
+
+def test_pipeline_ingests_a_repeated_url_once(fake_openai):
+    executor = ThreadPoolExecutor(max_workers=2)
+    with FakeWebServer({"/cat": make_article("猫", 40)}) as web:
+        url = web.url("/cat")
+        pipeline = WebQAPipeline(executor=executor, section_chars=2000)
+        result = run(pipeline.ingest([url, url]))
+
+        assert result.timings["fetch"].items == 1
+        assert result.timings["extract"].items == 1
+        assert result.timings["embed"].items == result.timings["split"].items
+        texts = result.index.texts
+        assert any("猫の0段落" in t for t in texts)
+        assert any("猫の39段落" in t for t in texts)
+
+        # The cached index is complete
+        embeddings = fake_openai.calls["/v1/embeddings"]
+        result = run(pipeline.ingest([url]))
+        assert len(result.index) == len(texts)
+        assert fake_openai.calls["/v1/embeddings"] == embeddings
+    executor.shutdown()
+
+
+def test_fetch_page_refuses_private_addresses():
+    with FakeWebServer({"/a": make_article("猫", 1)}) as web:
+        for url in (
+            web.url("/a"),
+            web.url("/a").replace("127.0.0.1", "localhost"),
+            "http://169.254.169.254/latest/meta-data/",
+            "file:///etc/passwd",
+        ):
+            with pytest.raises(BlockedURL):
+                run(fetch_page(url))
+        assert web.calls == {}
+
+
+def test_unchanged_page_reuses_the_index(fake_openai):
+    pages = {"/cat": make_article("猫", 40)}
+    executor = ThreadPoolExecutor(max_workers=2)
+    with FakeWebServer(pages) as web:
+        url = web.url("/cat")
+        pipeline = WebQAPipeline(executor=executor, section_chars=2000)
+        run(pipeline.answer([url], "猫について教えて"))
+        calls = dict(fake_openai.calls)
+
+        # 304: one embedding of the question and one completion
+        answer, result = run(pipeline.answer([url], "犬について教えて"))
+        assert answer is not None
+        assert web.not_modified == 1
+        assert result.timings["extract"].items == 0
+        assert result.timings["split"].items == 0
+        assert fake_openai.calls["/v1/embeddings"] == calls["/v1/embeddings"] + 1
+        assert fake_openai.calls["/v1/completions"] == calls["/v1/completions"] + 1
+        assert webqa.page_cache.stats.revalidated == 1
+
+        # A changed page is extracted and indexed again
+        pages["/cat"] = make_article("猫", 41)
+        _, result = run(pipeline.answer([url], "猫について教えて"))
+        assert web.not_modified == 1
+        assert result.timings["extract"].items == 1
+        assert any("猫の40段落" in t for t in result.index.texts)
+    executor.shutdown()
+
+
+def test_page_cache_limits():
+    cache = PageCache(max_entries=2, max_bytes=100)
+    cache.put("a", CachedPage(b"x" * 10))
+    cache.put("b", CachedPage(b"x" * 10))
+    cache.put("c", CachedPage(b"x" * 10))
+    assert cache.get("a") is None
+    page = cache.get("b")
+    cache.set_text(page, "猫" * 30)  # 100 bytes, so the least recently used goes
+    assert cache.get("c") is None and cache.get("b") is not None
+    assert cache.stats.evictions == 2
+
+    cache = PageCache(max_age=0)
+    cache.put("a", CachedPage(b""))
+    time.sleep(0.01)
+    assert cache.get("a") is None
@@ -0,0 +1,93 @@
+# Compare the prompt size and reply latency of the token-budgeted conversation memory
+# with the previous last-3-messages window on synthetic 200 message threads.
+# Completions and summaries go to the fake OpenAI server.
+#
+#   cd backend && poetry run python -m benchmarks.bench_chat_memory
+
+import argparse
+import os
+import random
+import statistics
+import time
+
+import openai
+
+from app.lib.memory import ConversationMemory
+from app.lib.openai_client import COMPLETION_MODEL, OpenAIClient
+from app.lib.service import CHAT_MAX_TOKENS, CHAT_PREFIX
+from app.lib.tokenizer import count_tokens
+from app.tests.fake_openai import FakeOpenAIServer
+
+WORDS = ["猫", "犬", "天気", "会議", "予定", "Python", "Slack", "ラーメン", "旅行", "本"]
+
+
+def format_thread_before(messages: list[tuple[str, str]], user: str) -> str:
+    replies = []
+    for usr, msg in messages[-3:]:
+        if usr == user:
+            replies.append(f"人間: {msg}")
+        else:
+            replies.append(f"Assistant: {msg}")
+    return "\n".join(replies + ["Assistant: "])
+
+
+def make_thread(n: int, n_humans: int, rng: random.Random) -> list[tuple[str, str]]:
+    messages = []
+    for i in range(n):
+        if i % 2:
+            user = "UBOT"
+        else:
+            user = f"U{rng.randrange(n_humans)}"
+        length = rng.randint(5, 60)
+        messages.append((user, "".join(rng.choices(WORDS, k=length)) + "。"))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--humans", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    threads = [
+        make_thread(args.messages, args.humans, rng) for _ in range(args.threads)
+    ]
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    with FakeOpenAIServer(latency=args.latency) as server:
+        client = OpenAIClient()  # sets the API key
+        openai.api_base = server.api_base
+        memory = ConversationMemory()
+        for name, format_thread in (
+            ("last 3", lambda m, user: format_thread_before(m, user)),
+            ("memory", lambda m, user: memory.format_thread(m, user, "UBOT")),
+        ):
+            calls_before = server.calls.get("/v1/completions", 0)
+            prompt_tokens = []
+            latencies = []
+            for thread in threads:
+                # A reply to each human message as the thread grows
+                for end in range(1, len(thread) + 1, 2):
+                    messages, user = thread[:end], thread[end - 1][0]
+                    start = time.perf_counter()
+                    prompt = f"{CHAT_PREFIX}\n\n{format_thread(messages, user)}"
+                    client.get_text_completion(prompt, max_tokens=CHAT_MAX_TOKENS)
+                    latencies.append(time.perf_counter() - start)
+                    prompt_tokens.append(count_tokens(prompt, COMPLETION_MODEL))
+            calls = server.calls["/v1/completions"] - calls_before
+            median_tokens = statistics.median(prompt_tokens)
+            print(
+                f"{name:>7}: prompt tokens median {median_tokens:.0f} "
+                f"max {max(prompt_tokens)}, "
+                f"latency median {statistics.median(latencies) * 1000:.0f}ms"
+                f" p95 {statistics.quantiles(latencies, n=20)[-1] * 1000:.0f}ms, "
+                f"completion calls {calls} for {len(latencies)} replies"
+            )
+        print(f"summaries: {memory.summary_calls}")
+
+
+if __name__ == "__main__":
+    main()
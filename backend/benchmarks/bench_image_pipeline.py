@@ -0,0 +1,88 @@
+# Compare the per-request latency and open file descriptors of the in-memory image
+# variation pipeline with the previous temp-file based one.
+#
+#   cd backend && poetry run python -m benchmarks.bench_image_pipeline
+
+import argparse
+import base64
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import openai
+from PIL import Image
+
+from app.lib.openai_client import OpenAIClient
+from app.lib.util import crop_and_resize_image
+from app.tests.fake_openai import FakeOpenAIServer
+
+
+def open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def variation_with_temp_files(image: bytes) -> list[str]:
+    # The previous pipeline: download -> temp file -> resized temp file -> OpenAI
+    # -> one temp file per output image
+    _, input_file = tempfile.mkstemp(suffix=".jpg")
+    with open(input_file, "wb") as f:
+        f.write(image)
+    _, resized_file = tempfile.mkstemp(suffix=".png")
+    crop_and_resize_image(input_file, resized_file, size=(512, 512), format="png")
+    resp = openai.Image.create_variation(
+        image=open(resized_file, "rb"),
+        n=3,
+        size="512x512",
+        response_format="b64_json",
+    )
+    os.remove(resized_file)
+    os.remove(input_file)
+    output_files = []
+    for img in resp.data:
+        _, output_file = tempfile.mkstemp(suffix=".png")
+        with open(output_file, "wb") as f:
+            f.write(base64.b64decode(img.b64_json))
+        output_files.append(output_file)
+    for output_file in output_files:  # removed after the upload
+        os.remove(output_file)
+    return output_files
+
+
+def variation_in_memory(image: bytes) -> list[bytes]:
+    return OpenAIClient().get_image_variation(image)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--size", type=int, nargs=2, default=[3000, 2000])
+    args = parser.parse_args()
+
+    buf = io.BytesIO()
+    Image.new("RGB", tuple(args.size), (200, 100, 50)).save(buf, format="jpeg")
+    image = buf.getvalue()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    with FakeOpenAIServer() as server:
+        OpenAIClient()  # sets the API key
+        openai.api_base = server.api_base
+        for name, fn in (
+            ("temp files", variation_with_temp_files),
+            ("in memory", variation_in_memory),
+        ):
+            fds_before = open_fds()
+            latencies = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                fn(image)
+                latencies.append(time.perf_counter() - start)
+            print(
+                f"{name:>10}: median {statistics.median(latencies) * 1000:.1f}ms, "
+                f"open fds {fds_before} -> {open_fds()}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Build time, query latency and recall@k of MessageIndex against a brute-force scan,
+# on synthetic embeddings clustered around topics like those of real messages.
+#
+#   cd backend && poetry run python -m benchmarks.bench_message_index
+#   cd backend && poetry run python -m benchmarks.bench_message_index \
+#       --sizes 100000 --dim 1536
+#
+# Messages are added in batches and the inverted lists trained whenever the index asks
+# for it, as the indexer does. text-embedding-ada-002 has 1536 dimensions, i.e. 6GB
+# for 1M messages, so the default runs at 256 dimensions to fit in memory; query time
+# grows about linearly with the dimension.
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from app.lib.message_index import IndexedMessage, MessageIndex
+from app.lib.retrieval import normalize
+
+TS = 1700000000
+CHANNELS = 50
+
+
+def clustered(rng: np.random.Generator, n: int, centres: np.ndarray) -> np.ndarray:
+    labels = rng.integers(0, len(centres), n)
+    noise = rng.standard_normal((n, centres.shape[1]), dtype=np.float32)
+    return normalize(centres[labels] + 0.5 * noise)
+
+
+def messages(start: int, n: int) -> list[IndexedMessage]:
+    return [
+        IndexedMessage(f"C{i % CHANNELS}", f"{TS + i}.000100", "U1", str(i))
+        for i in range(start, start + n)
+    ]
+
+
+def percentile(values: list[float], p: float) -> float:
+    return float(np.percentile(values, p))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--dim", type=int, default=256)
+    # Messages per topic
+    parser.add_argument("--topic-size", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--batch", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(
+        f"{'messages':>9} {'add':>8} {'train':>8} {'lists':>6} {'nprobe':>6} "
+        f"{'p50':>8} {'p95':>8} {'filtered':>9} {'brute':>8} {'recall':>7}"
+    )
+    for n in args.sizes:
+        topics = max(1, n // args.topic_size)
+        centres = rng.standard_normal((topics, args.dim), dtype=np.float32)
+        embs = np.empty((n, args.dim), dtype=np.float32)
+        for start in range(0, n, args.batch):
+            end = min(start + args.batch, n)
+            embs[start:end] = clustered(rng, end - start, centres)
+        queries = clustered(rng, args.queries, centres)
+
+        with tempfile.TemporaryDirectory() as path:
+            index = MessageIndex(path)
+            t_add = t_train = 0.0
+            for start in range(0, n, args.batch):
+                end = min(start + args.batch, n)
+                t0 = time.perf_counter()
+                index.add(messages(start, end - start), embs[start:end])
+                t1 = time.perf_counter()
+                if index.needs_training():
+                    index.train()
+                t_add += t1 - t0
+                t_train += time.perf_counter() - t1
+
+            brute_times = []
+            expected = []
+            for q in queries:
+                t0 = time.perf_counter()
+                scores = embs @ q
+                top = np.argpartition(-scores, args.k - 1)[: args.k]
+                brute_times.append(time.perf_counter() - t0)
+                expected.append(set(top.tolist()))
+
+            for nprobe in args.nprobe:
+                index.nprobe = nprobe
+                times = []
+                recall = []
+                for q, truth in zip(queries, expected):
+                    t0 = time.perf_counter()
+                    results = index.search(q, args.k)
+                    times.append(time.perf_counter() - t0)
+                    found = {int(r.text) for r in results}
+                    recall.append(len(found & truth) / args.k)
+                # One channel and the last 10% of the messages
+                filtered = []
+                for i, q in enumerate(queries):
+                    t0 = time.perf_counter()
+                    index.search(q, args.k, channels=[f"C{i % CHANNELS}"])
+                    index.search(q, args.k, oldest=TS + n * 0.9)
+                    filtered.append((time.perf_counter() - t0) / 2)
+                print(
+                    f"{n:>9} {t_add:>7.1f}s {t_train:>7.1f}s {index.nlist:>6} "
+                    f"{nprobe:>6} {percentile(times, 50) * 1000:>6.2f}ms "
+                    f"{percentile(times, 95) * 1000:>6.2f}ms "
+                    f"{statistics.median(filtered) * 1000:>7.2f}ms "
+                    f"{statistics.median(brute_times) * 1000:>6.1f}ms "
+                    f"{statistics.mean(recall):>7.3f}"
+                )
+            index.close()
+        del embs
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# Overhead of a timed function call with the metrics enabled and disabled, compared
+# with the plain function.
+#
+#   cd backend && poetry run python -m benchmarks.bench_metrics
+
+import argparse
+import timeit
+
+from app.lib.metrics import command_label, registry, timed
+
+
+def plain(x: int) -> int:
+    return x + 1
+
+
+instrumented = timed()(plain)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200_000)
+    args = parser.parse_args()
+
+    def per_call(fn) -> float:
+        best = min(timeit.repeat(lambda: fn(1), number=args.number, repeat=5))
+        return best / args.number * 1e9
+
+    base = per_call(plain)
+    print(f"{'plain':>9}: {base:6.0f}ns")
+    for enabled in (False, True):
+        registry.enabled = enabled
+        with command_label("text"):
+            ns = per_call(instrumented)
+        name = "enabled" if enabled else "disabled"
+        print(f"{name:>9}: {ns:6.0f}ns (+{ns - base:.0f}ns)")
+
+
+if __name__ == "__main__":
+    main()
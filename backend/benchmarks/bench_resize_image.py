@@ -0,0 +1,100 @@
+# Compare the time and peak RSS of crop_and_resize_image with the previous
+# implementation (full decode, top-left crop, default filter) on large inputs.
+# WebP stands in for HEIC: neither can be draft-decoded, and HEIC needs pillow-heif.
+#
+#   cd backend && poetry run python -m benchmarks.bench_resize_image
+
+import argparse
+import io
+import multiprocessing
+import statistics
+import time
+from typing import Callable
+
+from PIL import Image
+
+from app.lib.util import crop_and_resize_image
+
+
+def crop_and_resize_image_before(infile, outfile, size=(512, 512), format="png"):
+    im = Image.open(infile)
+    xlen, ylen = im.size
+    if xlen > ylen:
+        im.crop((0, 0, ylen, ylen)).resize(size).save(outfile, format=format)
+    elif xlen < ylen:
+        im.crop((0, 0, xlen, xlen)).resize(size).save(outfile, format=format)
+    else:
+        im.resize(size).save(outfile, format=format)
+
+
+def make_image(size: tuple[int, int], format: str) -> bytes:
+    # Gradient plus noise, so that the encoders cannot cheat on flat colours
+    im = Image.linear_gradient("L").resize(size).convert("RGB")
+    noise = Image.effect_noise(size, 30).convert("RGB")
+    im = Image.blend(im, noise, 0.3)
+    buf = io.BytesIO()
+    im.save(buf, format=format, quality=90)
+    return buf.getvalue()
+
+
+def read_status(field: str) -> int:
+    """Read a memory field of /proc/self/status in kB"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def reset_peak_rss():
+    # ru_maxrss survives fork and exec, but VmHWM can be reset (Linux 4.0+)
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def measure(fn: Callable, image: bytes, repeat: int, conn):
+    reset_peak_rss()
+    baseline = read_status("VmRSS")
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(io.BytesIO(image), io.BytesIO(), size=(512, 512), format="png")
+        latencies.append(time.perf_counter() - start)
+    peak = read_status("VmHWM")
+    conn.send((statistics.median(latencies), (peak - baseline) / 1024))
+
+
+def run(fn: Callable, image: bytes, repeat: int) -> tuple[float, float]:
+    # A forked child would reuse the memory the parent has freed but still holds
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=measure, args=(fn, image, repeat, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--size", type=int, nargs=2, default=[6000, 4000])
+    args = parser.parse_args()
+
+    size = tuple(args.size)
+    for format in ("jpeg", "png", "webp"):
+        image = make_image(size, format)
+        print(f"{format} {size[0]}x{size[1]} ({len(image) / 1e6:.1f}MB)")
+        for name, fn in (
+            ("before", crop_and_resize_image_before),
+            ("after", crop_and_resize_image),
+        ):
+            latency, peak_mb = run(fn, image, args.repeat)
+            print(
+                f"  {name:>6}: median {latency * 1000:7.1f}ms, "
+                f"peak RSS +{peak_mb:.0f}MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
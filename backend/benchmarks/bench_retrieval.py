@@ -0,0 +1,76 @@
+# Compare top-k context selection of EmbeddingIndex with the previous
+# distances_from_embeddings + full sort implementation.
+#
+#   cd backend && poetry run python -m benchmarks.bench_retrieval
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from app.lib.retrieval import EmbeddingIndex
+
+DIM = 1536  # text-embedding-ada-002
+
+
+def select_baseline(q_emb, texts, n_tokens_list, embs, max_ctx_len):
+    from openai.embeddings_utils import distances_from_embeddings
+
+    distances = distances_from_embeddings(q_emb, embs, distance_metric="cosine")
+    returns = []
+    cur_ctx_len = 0
+    items = sorted(zip(texts, n_tokens_list, distances), key=lambda x: x[2])
+    for text, n_tokens, _ in items:
+        cur_ctx_len += n_tokens + 4
+        if cur_ctx_len > max_ctx_len:
+            break
+        returns.append(text)
+    return returns
+
+
+def timeit(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ctx-len", type=int, default=1800)
+    parser.add_argument("--skip-baseline", action="store_true")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>8} {'build':>10} {'index':>10} {'baseline':>10}")
+    for n in args.sizes:
+        texts = [f"chunk {i}" for i in range(n)]
+        n_tokens_list = rng.integers(50, 500, size=n).tolist()
+        embs = list(rng.standard_normal((n, DIM), dtype=np.float32))
+        q_emb = rng.standard_normal(DIM, dtype=np.float32)
+
+        start = time.perf_counter()
+        index = EmbeddingIndex(texts, n_tokens_list, embs)
+        build = time.perf_counter() - start
+        t_index = timeit(lambda: index.select(q_emb, args.max_ctx_len), args.repeat)
+        if args.skip_baseline:
+            baseline = "-"
+        else:
+            embs64 = [e.astype(np.float64).tolist() for e in embs]
+            t_base = timeit(
+                lambda: select_baseline(
+                    q_emb.tolist(), texts, n_tokens_list, embs64, args.max_ctx_len
+                ),
+                1,
+            )
+            baseline = f"{t_base * 1000:.1f}ms"
+        print(f"{n:>8} {build * 1000:>8.1f}ms {t_index * 1000:>8.2f}ms {baseline:>10}")
+
+
+if __name__ == "__main__":
+    main()
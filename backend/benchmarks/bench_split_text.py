@@ -0,0 +1,61 @@
+# Compare cold and warm latency and peak RSS of OpenAIClient._split_text.
+#
+#   cd backend && poetry run python -m benchmarks.bench_split_text
+
+import argparse
+import resource
+import statistics
+import time
+
+from app.lib.openai_client import OpenAIClient
+from app.lib.segmenter import registry
+
+SAMPLE = "".join(
+    [
+        "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。",
+        "何でも薄暗いじめじめした所でニャーニャー泣いていた事だけは記憶している。",
+    ]
+)
+
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--size", type=int, default=50, help="Repeat SAMPLE N times")
+    args = parser.parse_args()
+
+    client = OpenAIClient()
+    text = SAMPLE * args.size
+
+    registry.reset()
+    rss_before = peak_rss_mib()
+    start = time.perf_counter()
+    chunks = client._split_text(text)
+    cold = time.perf_counter() - start
+    rss_cold = peak_rss_mib()
+
+    warm = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        client._split_text(text)
+        warm.append(time.perf_counter() - start)
+    rss_warm = peak_rss_mib()
+
+    print(f"segmenter loaded: {registry.loaded}, chunks: {len(chunks)}")
+    print(f"cold: {cold * 1000:.1f} ms")
+    print(
+        f"warm: median {statistics.median(warm) * 1000:.1f} ms, "
+        f"max {max(warm) * 1000:.1f} ms ({args.repeat} runs)"
+    )
+    print(
+        f"peak RSS: {rss_before:.0f} MiB (start), {rss_cold:.0f} MiB (after cold), "
+        f"{rss_warm:.0f} MiB (after warm)"
+    )
+
+
+if __name__ == "__main__":
+    main()
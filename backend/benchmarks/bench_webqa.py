@@ -0,0 +1,118 @@
+# Compare the staged webqa ingestion pipeline with the previous blocking chain
+# (fetch_url → extract → _split_text → embeddings → completion) on HTML fixtures
+# served by a local web server, with the OpenAI API faked. Prints the latency of
+# each, the per-stage timings of the pipeline and the cost of a follow-up question
+# on unchanged pages.
+#
+#   cd backend && poetry run python -m benchmarks.bench_webqa --pages 3
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import openai
+import requests
+
+from app.lib import webqa
+from app.lib.aio import run
+from app.lib.async_openai_client import close_session
+from app.lib.embedding_cache import embedding_cache
+from app.lib.openai_client import OpenAIClient
+from app.lib.page_cache import page_cache
+from app.lib.retrieval import index_cache
+from app.lib.webqa import (
+    STAGES,
+    WEBQA_PROCESSES,
+    WebQAPipeline,
+    close_web_session,
+    extract_text,
+)
+from app.tests.fake_openai import FakeOpenAIServer
+from app.tests.fake_web import FakeWebServer, make_article
+
+QUESTION = "猫について教えて"
+
+
+def answer_before(urls: list[str]) -> str:
+    import trafilatura
+
+    # trafilatura.fetch_url refuses local addresses
+    texts = [trafilatura.extract(requests.get(url).text) for url in urls]
+    return OpenAIClient().answer_question_on_text("\n".join(texts), QUESTION)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--paragraphs", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--page-latency", type=float, default=0.2)
+    parser.add_argument(
+        "--start-method", default="spawn", choices=("spawn", "forkserver", "fork")
+    )
+    args = parser.parse_args()
+
+    pages = {
+        f"/page{i}": make_article(f"記事{i}", args.paragraphs) for i in range(args.pages)
+    }
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    webqa.WEBQA_ALLOWED_HOSTS.add("127.0.0.1")
+    context = multiprocessing.get_context(args.start_method)
+    with FakeOpenAIServer(latency=args.latency) as server, FakeWebServer(
+        pages, latency=args.page_latency
+    ) as web, ProcessPoolExecutor(WEBQA_PROCESSES, mp_context=context) as executor:
+        openai.api_base = server.api_base
+        urls = [web.url(path) for path in pages]
+        # Start the workers and import trafilatura in them
+        list(executor.map(extract_text, [b"<html></html>"] * WEBQA_PROCESSES))
+        pipeline = WebQAPipeline(executor=executor)
+
+        for name, answer in (
+            ("before", lambda: answer_before(urls)),
+            ("pipeline", lambda: run(pipeline.answer(urls, QUESTION))),
+        ):
+            latencies = []
+            for _ in range(args.repeat):
+                embedding_cache.clear()
+                index_cache.clear()
+                page_cache.clear()
+                start = time.perf_counter()
+                result = answer()
+                latencies.append(time.perf_counter() - start)
+            median = statistics.median(latencies)
+            print(
+                f"{name:>8}: {len(urls)} pages, median {median:.2f}s "
+                f"min {min(latencies):.2f}s"
+            )
+
+        _, ingest = result
+
+        # A follow-up question on the same pages, revalidated with 304s
+        page_cache.fresh_for = 0
+        calls = dict(server.calls)
+        start = time.perf_counter()
+        run(pipeline.answer(urls, "犬について教えて"))
+        elapsed = time.perf_counter() - start
+        new_calls = {k: v - calls.get(k, 0) for k, v in server.calls.items()}
+        print(
+            f"follow-up: {elapsed:.2f}s, {web.not_modified} pages not modified, "
+            f"OpenAI calls {new_calls}"
+        )
+        run(close_web_session())
+        run(close_session())
+
+        print(f"{'stage':>8} {'busy':>7} {'items':>6} {'first':>7} {'last':>7}")
+        for stage in STAGES:
+            t = ingest.timings[stage]
+            print(
+                f"{stage:>8} {t.busy:>6.2f}s {t.items:>6} {t.first or 0:>6.2f}s "
+                f"{t.last or 0:>6.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Load test comparing the sync OpenAIClient with the pooled AsyncOpenAIClient
+# against a local mock OpenAI server.
+#
+#   cd backend && poetry run python -m benchmarks.load_openai --requests 500
+
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import openai
+
+from app.lib.aio import run
+from app.lib.async_openai_client import AsyncOpenAIClient
+from app.lib.openai_client import OpenAIClient
+from app.tests.fake_openai import FakeOpenAIServer
+
+
+def sync_request(prompt: str) -> str:
+    return OpenAIClient().get_text_completion(prompt)
+
+
+def async_request(prompt: str) -> str:
+    return run(AsyncOpenAIClient().get_text_completion(prompt))
+
+
+def load(fn: Callable[[str], str], n_requests: int, concurrency: int) -> dict:
+    latencies = []
+
+    def timed(i: int):
+        start = time.perf_counter()
+        fn(f"prompt {i}")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": n_requests / elapsed,
+        "p50": statistics.median(latencies),
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-load-test")
+    with FakeOpenAIServer(latency=args.latency) as server:
+        openai.api_base = server.api_base
+        print(f"{'path':>6} {'req/s':>8} {'p50':>9} {'p99':>9}")
+        for name, fn in (("sync", sync_request), ("async", async_request)):
+            load(fn, args.concurrency, args.concurrency)  # warm up
+            r = load(fn, args.requests, args.concurrency)
+            print(
+                f"{name:>6} {r['rps']:>8.1f} {r['p50'] * 1000:>7.1f}ms "
+                f"{r['p99'] * 1000:>7.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# Load test of a burst of simultaneous mentions in 10 channels against rate limited
+# fake OpenAI and Slack servers. Half of the mentions are `chat` (interactive, one
+# completion) and the other half `slacksearch` (bulk, map-reduce over search results),
+# each answered with chat.postMessage. Compares no retries, retries only and the
+# shared rate limiter on failed replies, throughput and latency by priority.
+#
+#   cd backend && poetry run python -m benchmarks.load_rate_limit --mentions 50
+
+import argparse
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from app.lib import async_openai_client, openai_client
+from app.lib.openai_client import OpenAIClient
+from app.lib.ratelimit import PRIORITY_BULK, PRIORITY_INTERACTIVE, RateLimits, priority
+from app.lib.service import CHAT_MAX_TOKENS, CHAT_PREFIX, summarize_slack_messages
+from app.tests.fake_openai import FakeOpenAIServer
+from app.tests.fake_slack import FakeSlackServer
+
+WORDS = ["猫", "犬", "天気", "会議", "予定", "Python", "Slack", "ラーメン", "旅行", "本"]
+ERROR_PREFIX = "ごめんなさい"
+
+
+def make_messages(n: int, rng: random.Random) -> list[dict]:
+    return [
+        {
+            "user": f"U{rng.randrange(20)}",
+            "channel_name": "general",
+            "text": "".join(rng.choices(WORDS, k=rng.randint(50, 150))),
+        }
+        for _ in range(n)
+    ]
+
+
+def chat(text: str) -> str:
+    try:
+        return OpenAIClient().get_text_completion(
+            f"{CHAT_PREFIX}\n\n人間: {text}\nAssistant: ", max_tokens=CHAT_MAX_TOKENS
+        )
+    except Exception as e:
+        return f"{ERROR_PREFIX}、文章が書けませんでした！\n{e}"
+
+
+def load(
+    limits: RateLimits,
+    client: WebClient,
+    n_mentions: int,
+    messages: list[dict],
+) -> dict[str, list]:
+    # The clients look up the limiter when they are called
+    openai_client.rate_limits = limits
+    async_openai_client.rate_limits = limits
+    results: dict[str, list] = {"chat": [], "slacksearch": []}
+
+    def mention(i: int):
+        start = time.perf_counter()
+        if i % 2:
+            command, level = "slacksearch", PRIORITY_BULK
+        else:
+            command, level = "chat", PRIORITY_INTERACTIVE
+        with priority(level):
+            if command == "chat":
+                reply = chat(f"質問 {i}")
+            else:
+                reply = summarize_slack_messages(messages, f"検索 {i}")
+            try:
+                client.chat_postMessage(channel=f"C{i % 10}", text=reply)
+            except SlackApiError:
+                reply = f"{ERROR_PREFIX}: chat.postMessage"
+        ok = not reply.lstrip().startswith(ERROR_PREFIX)
+        results[command].append((ok, time.perf_counter() - start))
+
+    with ThreadPoolExecutor(max_workers=n_mentions) as executor:
+        list(executor.map(mention, range(n_mentions)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mentions", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--max-rps", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--slack-429", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-load-test")
+    OpenAIClient()  # sets the API key
+    messages = make_messages(args.messages, random.Random(0))
+    per_minute = args.max_rps * 60
+
+    print(
+        f"{'mode':>8} {'ok':>4} {'failed':>7} {'completions/s':>14} {'chat p50':>9} "
+        f"{'chat p95':>9} {'search p50':>11} {'search p95':>11} {'429s':>5}"
+    )
+    with FakeSlackServer() as slack:
+        # app.lib.slack creates the Bolt app on import, which verifies the token
+        os.environ["SLACK_API_URL"] = slack.base_url
+        os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-load-test")
+        os.environ.setdefault("SLACK_SIGNING_SECRET", "load-test")
+        from app.lib.slack.ratelimit import RateLimitedWebClient
+
+        modes = {
+            "none": (
+                RateLimits({"openai:default": 1e6}, max_attempts=1),
+                WebClient(token="xoxb-load-test", base_url=slack.base_url),
+            ),
+            "retry": (
+                RateLimits({"openai:default": 1e6}),
+                RateLimitedWebClient(
+                    token="xoxb-load-test", base_url=slack.base_url, limits=RateLimits()
+                ),
+            ),
+        }
+        limits = RateLimits({"openai:default": per_minute * 0.9}, burst=1.0)
+        modes["limiter"] = (
+            limits,
+            RateLimitedWebClient(
+                token="xoxb-load-test", base_url=slack.base_url, limits=limits
+            ),
+        )
+
+        for name, (limits, client) in modes.items():
+            slack.rate_limited["chat.postMessage"] = args.slack_429
+            with FakeOpenAIServer(latency=args.latency, max_rps=args.max_rps) as server:
+                openai.api_base = server.api_base
+                start = time.perf_counter()
+                results = load(limits, client, args.mentions, messages)
+                elapsed = time.perf_counter() - start
+
+            all_results = results["chat"] + results["slacksearch"]
+            n_ok = sum(ok for ok, _ in all_results)
+            latency = {}
+            for command, rs in results.items():
+                latencies = sorted(t for _, t in rs)
+                latency[command] = (
+                    statistics.median(latencies),
+                    latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                )
+            n_429 = server.rate_limited + args.slack_429
+            # Completions accepted by the server, which is at most --max-rps
+            goodput = (len(server.requests) - server.rate_limited) / elapsed
+            print(
+                f"{name:>8} {n_ok:>4} {len(all_results) - n_ok:>7} {goodput:>14.2f} "
+                f"{latency['chat'][0]:>8.2f}s {latency['chat'][1]:>8.2f}s "
+                f"{latency['slacksearch'][0]:>10.2f}s "
+                f"{latency['slacksearch'][1]:>10.2f}s {n_429:>5}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# Replay signed Slack events against the backend at a target rate, with OpenAI, the
+# Slack Web API and the web pages of webqa served by local stubs. The app runs under
+# uvicorn in a subprocess like in production. Reports the throughput, the ack latency
+# of /slack/events, the p50/p95/p99 latency from each event to its first reply in
+# Slack per command, and the RSS of the server, and compares them with a baseline.
+#
+#   cd backend && poetry run python -m benchmarks.replay --rate 5 --events 100 \
+#       --baseline benchmarks/baselines/replay.json
+#
+# Baselines are only comparable on the same machine and with the same options.
+#
+# Save a new baseline with `--save benchmarks/baselines/replay.json`, and a workload
+# to replay later with `--save-events events.jsonl` (`--events-file` to load it).
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from app.lib.ratelimit import parse_limits
+from app.tests.app_server import AppServer
+from app.tests.fake_openai import FakeOpenAIServer
+from app.tests.fake_slack import FakeSlackServer
+from app.tests.fake_web import FakeWebServer, make_article
+from app.tests.slack_events import EventGenerator, SlackEvent
+
+SIGNING_SECRET = "replay-secret"
+DEFAULT_MIX = (
+    "chat=4,chat_next=2,text=2,textedit=1,code=1,image=1,image_variation=1,"
+    "slacksearch=1,webqa=1"
+)
+# Replies that tell the user that the command failed
+FAILURE_MARKERS = ("ごめんなさい", "混み合って", "おかしいよ", "できないよ")
+MENTION = re.compile(r"<@(U\d+)>")
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(values: list[float]) -> dict[str, Optional[float]]:
+    return {f"p{q}": percentile(values, q) for q in (50, 95, 99)}
+
+
+def rss_bytes(pid: int) -> int:
+    """RSS of `pid` and its descendants, e.g. uvicorn workers and webqa processes"""
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except (FileNotFoundError, ProcessLookupError):
+        return total
+    return total + sum(rss_bytes(child) for child in children)
+
+
+class MemorySampler:
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples: list[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "MemorySampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(rss_bytes(self.pid))
+            self._stop.wait(self.interval)
+
+    def to_dict(self) -> dict[str, float]:
+        mb = [s / 1024 / 1024 for s in self.samples if s] or [0.0]
+        return {"rss_start_mb": mb[0], "rss_peak_mb": max(mb), "rss_end_mb": mb[-1]}
+
+
+class Replies:
+    """First reply in Slack to each event, matched by the mentioned user or thread"""
+
+    def __init__(self, events: list[SlackEvent]):
+        self.by_user = {e.event["user"]: i for i, e in enumerate(events)}
+        self.by_thread = {
+            e.event.get("thread_ts") or e.event["ts"]: i for i, e in enumerate(events)
+        }
+        self.times: dict[int, float] = {}
+        self.failed: set[int] = set()
+        self.done = threading.Condition()
+
+    def __call__(self, method: str, params: dict[str, Any]):
+        if method not in ("chat.postMessage", "files.completeUploadExternal"):
+            return
+        text = params.get("text") or params.get("initial_comment") or ""
+        thread_ts = params.get("thread_ts")
+        mention = MENTION.search(text)
+        if thread_ts in self.by_thread:
+            i = self.by_thread[thread_ts]
+        elif mention and mention.group(1) in self.by_user:
+            i = self.by_user[mention.group(1)]
+        else:
+            return
+        with self.done:
+            if i not in self.times:
+                self.times[i] = time.monotonic()
+                if any(marker in text for marker in FAILURE_MARKERS):
+                    self.failed.add(i)
+                self.done.notify_all()
+
+    def wait(self, n: int, timeout: float) -> bool:
+        with self.done:
+            return self.done.wait_for(lambda: len(self.times) >= n, timeout)
+
+
+def search_matches(n: int, rng: random.Random) -> list[dict[str, Any]]:
+    words = ["猫", "犬", "天気", "会議", "予定", "Python", "Slack", "ラーメン"]
+    return [
+        {
+            "channel": {"id": "C000", "name": "general", "is_private": False},
+            "user": f"U{rng.randrange(20)}",
+            "text": "".join(rng.choices(words, k=rng.randint(20, 80))),
+            "permalink": f"https://example.slack.com/archives/C000/p{i}",
+        }
+        for i in range(n)
+    ]
+
+
+def post_event(url: str, event: SlackEvent) -> tuple[int, float]:
+    body, headers = event.signed(SIGNING_SECRET)
+    request = urllib.request.Request(url, data=body, headers=headers)
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        status = 0
+    return status, time.monotonic() - start
+
+
+def replay(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    pages = {f"/page{i}": make_article(f"記事{i}", args.paragraphs) for i in range(3)}
+    with FakeOpenAIServer(
+        latency=args.openai_latency,
+        max_rps=args.openai_max_rps,
+        error_rate=args.openai_error_rate,
+        seed=args.seed,
+    ) as openai_server, FakeSlackServer(
+        latency=args.slack_latency,
+        max_rps=args.slack_max_rps,
+        error_rate=args.slack_error_rate,
+        seed=args.seed,
+    ) as slack, FakeWebServer(
+        pages, latency=args.page_latency
+    ) as web:
+        # Saved events refer to the stubs by placeholders since their ports change
+        stubs = {"{slack}": slack.url, "{web}": web.url("")}
+        if args.events_file:
+            with open(args.events_file) as f:
+                lines = f.read()
+            for placeholder, url in stubs.items():
+                lines = lines.replace(placeholder, url)
+            events = [SlackEvent.from_dict(json.loads(s)) for s in lines.splitlines()]
+        else:
+            generator = EventGenerator(
+                parse_limits(args.mix),
+                seed=args.seed,
+                file_url=slack.file_url("image.png"),
+                web_urls=[web.url(path) for path in pages],
+            )
+            events = generator.generate(args.events)
+        if args.save_events:
+            with open(args.save_events, "w") as f:
+                for event in events:
+                    line = json.dumps(event.to_dict(), ensure_ascii=False)
+                    for placeholder, url in stubs.items():
+                        line = line.replace(url, placeholder)
+                    f.write(line + "\n")
+
+        slack.search_matches = search_matches(args.search_matches, rng)
+        for event in events:
+            for user, text, ts in event.thread:
+                thread_ts = event.thread[0][2]
+                slack.post(event.event["channel"], user, text, thread_ts, ts=ts)
+        replies = Replies(events)
+        slack.listener = replies
+
+        env = {
+            "SLACK_BOT_TOKEN": "xoxb-replay",
+            "SLACK_USER_TOKEN": "xoxp-replay",
+            "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+            "SLACK_API_URL": slack.base_url,
+            "OPENAI_API_KEY": "sk-replay",
+            "OPENAI_API_BASE": openai_server.api_base,
+            "WEBQA_ALLOWED_HOSTS": "127.0.0.1",
+        }
+        with AppServer(
+            env, args.port, args.workers, args.startup_timeout
+        ) as server, MemorySampler(server.pid) as memory, ThreadPoolExecutor(
+            max_workers=args.concurrency
+        ) as executor:
+            start = time.monotonic()
+            sent_at: list[float] = []
+            acks = []
+            for i, event in enumerate(events):
+                # Open loop: slow acks do not delay the following events
+                delay = start + i / args.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                sent_at.append(time.monotonic())
+                acks.append(
+                    executor.submit(post_event, f"{server.url}/slack/events", event)
+                )
+            acks = [f.result() for f in acks]
+            replies.wait(len(events), args.drain_timeout)
+        openai_calls = sum(openai_server.calls.values())
+        slack_calls = sum(slack.calls.values())
+
+    commands: dict[str, dict[str, Any]] = {}
+    for i, event in enumerate(events):
+        stats = commands.setdefault(
+            event.command, {"sent": 0, "replied": 0, "failed": 0, "latencies": []}
+        )
+        stats["sent"] += 1
+        if i in replies.times:
+            stats["replied"] += 1
+            stats["failed"] += i in replies.failed
+            stats["latencies"].append(replies.times[i] - sent_at[i])
+    for stats in commands.values():
+        stats.update(summarize(stats.pop("latencies")))
+
+    end = max(replies.times.values(), default=time.monotonic())
+    n_replied = len(replies.times)
+    return {
+        "config": {
+            k: v
+            for k, v in vars(args).items()
+            if k not in ("save", "baseline", "save_events")
+        },
+        "events": len(events),
+        "replied": n_replied,
+        "failed": len(replies.failed),
+        "duration": end - start,
+        "throughput": n_replied / (end - start),
+        "ack": {
+            **summarize([elapsed for _, elapsed in acks]),
+            "errors": sum(status != 200 for status, _ in acks),
+        },
+        "commands": dict(sorted(commands.items())),
+        "memory": memory.to_dict(),
+        "upstream_calls": {"openai": openai_calls, "slack": slack_calls},
+    }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def print_report(report: dict[str, Any]):
+    ack = report["ack"]
+    memory = report["memory"]
+    print(
+        f"{report['events']} events in {report['duration']:.1f}s: "
+        f"{report['replied']} replied ({report['failed']} failed), "
+        f"{report['throughput']:.2f} replies/s"
+    )
+    print(
+        f"ack p50 {ack['p50'] * 1000:.1f}ms p95 {ack['p95'] * 1000:.1f}ms "
+        f"p99 {ack['p99'] * 1000:.1f}ms, {ack['errors']} errors"
+    )
+    print(
+        f"rss start {memory['rss_start_mb']:.0f}MB peak {memory['rss_peak_mb']:.0f}MB "
+        f"end {memory['rss_end_mb']:.0f}MB, upstream calls {report['upstream_calls']}"
+    )
+    print(
+        f"{'command':>16} {'sent':>5} {'replied':>8} {'failed':>7} "
+        f"{'p50':>7} {'p95':>7} {'p99':>7}"
+    )
+    for command, stats in report["commands"].items():
+        print(
+            f"{command:>16} {stats['sent']:>5} {stats['replied']:>8} "
+            f"{stats['failed']:>7} {format_seconds(stats['p50']):>7} "
+            f"{format_seconds(stats['p95']):>7} {format_seconds(stats['p99']):>7}"
+        )
+
+
+def change(new: Optional[float], old: Optional[float]) -> str:
+    if new is None or old is None:
+        return "-"
+    if old == 0:
+        return f"{new:.3g} (was 0)"
+    return f"{new:.3g} vs {old:.3g} ({(new - old) / old:+.1%})"
+
+
+def print_comparison(report: dict[str, Any], baseline: dict[str, Any]):
+    if report["config"] != baseline["config"]:
+        changed = {
+            k: (v, baseline["config"].get(k))
+            for k, v in report["config"].items()
+            if baseline["config"].get(k) != v
+        }
+        print(f"Warning: the configuration differs from the baseline: {changed}")
+    print("compared with the baseline:")
+    print(f"  throughput: {change(report['throughput'], baseline['throughput'])}")
+    print(f"  failed: {report['failed']} vs {baseline['failed']}")
+    print(f"  ack p95: {change(report['ack']['p95'], baseline['ack']['p95'])}")
+    peak, base_peak = report["memory"]["rss_peak_mb"], baseline["memory"]["rss_peak_mb"]
+    print(f"  rss peak MB: {change(peak, base_peak)}")
+    for command, stats in report["commands"].items():
+        old = baseline["commands"].get(command, {})
+        for q in ("p50", "p95", "p99"):
+            print(f"  {command} {q}: {change(stats[q], old.get(q))}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=5, help="events per second")
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--openai-max-rps", type=float, default=None)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--slack-latency", type=float, default=0.05)
+    parser.add_argument("--slack-max-rps", type=float, default=None)
+    parser.add_argument("--slack-error-rate", type=float, default=0.0)
+    parser.add_argument("--page-latency", type=float, default=0.2)
+    parser.add_argument("--paragraphs", type=int, default=50)
+    parser.add_argument("--search-matches", type=int, default=100)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--events-file")
+    parser.add_argument("--save-events")
+    parser.add_argument("--save", help="write the report as JSON")
+    parser.add_argument("--baseline", help="compare with a report saved with --save")
+    args = parser.parse_args()
+
+    report = replay(args)
+    print_report(report)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(report, json.load(f))
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
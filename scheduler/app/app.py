@@ -1,24 +1,51 @@
 import os
+import time
+from typing import Any
 
 import boto3
+from chalice import Chalice, Rate, Response
 
-from chalice import Chalice, Cron
+from chalicelib.scheduler import Config, ParameterStore, Scheduler
+from chalicelib.slack import verify_signature
 
 service_arn = os.getenv("APPRUNNER_ARN")
+state_parameter = os.getenv("STATE_PARAMETER", "/openai-bot-scheduler/state")
+slack_signing_secret = os.getenv("SLACK_SIGNING_SECRET", "")
 app = Chalice(app_name="openai-bot-scheduler")
 
 
-@app.schedule(Cron("*", 10, "*", "*", "?", "*"))  # JST 19:00
-def pause_service(event):
-    client = boto3.client("apprunner")
-    print(f"Pausing App Runner Service: {service_arn}")
-    response = client.pause_service(ServiceArn=service_arn)
-    return response
+def wake_message(action: str, status: str) -> str:
+    if action == "resume":
+        return "起動しています。数分後にもう一度話しかけてください！"
+    if status == "RUNNING":
+        return "起動済みです。そのまま話しかけてください！"
+    return "停止または起動の途中です。しばらくしてからもう一度試してください！"
 
 
-@app.schedule(Cron("*", 0, "*", "*", "?", "*"))  # JST 9:00
-def resume_service(event):
-    client = boto3.client("apprunner")
-    print(f"Resuming App Runner Service: {service_arn}")
-    response = client.resume_service(ServiceArn=service_arn)
-    return response
+def create_scheduler() -> Scheduler:
+    return Scheduler(
+        boto3.client("apprunner"),
+        str(service_arn),
+        ParameterStore(boto3.client("ssm"), state_parameter),
+        Config.from_env(),
+    )
+
+
+@app.schedule(Rate(5, unit=Rate.MINUTES))
+def scale_service(event: Any) -> dict[str, Any]:
+    return create_scheduler().tick(time.time()).to_dict()
+
+
+# Slash command, e.g. `/wake`, to resume the service outside the usual hours
+@app.route(
+    "/wake", methods=["POST"], content_types=["application/x-www-form-urlencoded"]
+)
+def wake_service() -> Any:
+    request = app.current_request
+    if not slack_signing_secret or not verify_signature(
+        slack_signing_secret, request.raw_body, request.headers
+    ):
+        return Response(body="invalid signature", status_code=401)
+    decision = create_scheduler().wake(time.time())
+    text = wake_message(decision.action, decision.status)
+    return {"response_type": "ephemeral", "text": text}
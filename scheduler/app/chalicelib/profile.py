@@ -0,0 +1,61 @@
+# Activity profile learned from the traffic of past weeks.
+# The week is split into 7 * 24 hourly buckets (UTC) holding an exponential moving
+# average of the Slack events per hour seen while the service was running, so the
+# scheduler can resume the service ahead of the hours in which users usually ask.
+
+import datetime
+import math
+from typing import Any, Optional
+
+HOURS_PER_WEEK = 7 * 24
+# Weight of one observed hour, i.e. the last 3 weeks account for about 2/3
+DEFAULT_ALPHA = 0.3
+
+
+def hour_of_week(timestamp: float) -> int:
+    dt = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return dt.weekday() * 24 + dt.hour
+
+
+class ActivityProfile:
+    def __init__(
+        self, rates: Optional[list[float]] = None, alpha: float = DEFAULT_ALPHA
+    ) -> None:
+        self.rates = list(rates) if rates else [0.0] * HOURS_PER_WEEK
+        if len(self.rates) != HOURS_PER_WEEK:
+            raise ValueError(f"Expected {HOURS_PER_WEEK} rates, got {len(self.rates)}")
+        self.alpha = alpha
+
+    def observe(self, start: float, end: float, events: int) -> None:
+        """Learn from `events` that arrived between `start` and `end`"""
+        elapsed = end - start
+        if elapsed <= 0:
+            return
+        # Weighted by the time observed, so the tick interval does not matter
+        weight = 1 - (1 - self.alpha) ** (elapsed / 3600)
+        bucket = hour_of_week((start + end) / 2)
+        rate = events * 3600 / elapsed
+        self.rates[bucket] += weight * (rate - self.rates[bucket])
+
+    def record_demand(self, timestamp: float, rate: float) -> None:
+        """Expect at least `rate` events per hour at this time of the week"""
+        bucket = hour_of_week(timestamp)
+        self.rates[bucket] = max(self.rates[bucket], rate)
+
+    def expected_rate(self, start: float, end: float) -> float:
+        """Highest expected events per hour in the buckets between `start` and `end`"""
+        first = math.floor(start / 3600)
+        last = math.floor(end / 3600)
+        return max(
+            self.rates[hour_of_week(hour * 3600)] for hour in range(first, last + 1)
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        # Rounded to stay well below the 4KB limit of an SSM parameter
+        return {"rates": [round(rate, 3) for rate in self.rates]}
+
+    @classmethod
+    def from_dict(
+        cls, data: dict[str, Any], alpha: float = DEFAULT_ALPHA
+    ) -> "ActivityProfile":
+        return cls(data.get("rates"), alpha=alpha)
@@ -0,0 +1,247 @@
+# Pause and resume the App Runner service according to its traffic.
+# Every tick the scheduler reads the activity the backend publishes on /_activity
+# while it is running and learns an hourly profile of the week from it. The service
+# is paused once it has been idle for IDLE_MINUTES, unless the profile expects demand
+# within RESUME_LEAD_MINUTES, and a paused service is resumed that long ahead of the
+# hours in which users usually ask. Users who ask at other times wake it up with
+# `wake`, which is also remembered in the profile.
+
+import json
+import os
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Optional, Protocol
+
+from .profile import DEFAULT_ALPHA, ActivityProfile
+
+RUNNING = "RUNNING"
+PAUSED = "PAUSED"
+# Longer gaps between ticks, e.g. while paused, are not learned from
+MAX_OBSERVATION = 60 * 60.0
+
+
+class AppRunnerClient(Protocol):
+    def describe_service(self, ServiceArn: str) -> dict[str, Any]:
+        ...
+
+    def pause_service(self, ServiceArn: str) -> dict[str, Any]:
+        ...
+
+    def resume_service(self, ServiceArn: str) -> dict[str, Any]:
+        ...
+
+
+class StateStore(Protocol):
+    def load(self) -> Optional[dict[str, Any]]:
+        ...
+
+    def save(self, state: dict[str, Any]) -> None:
+        ...
+
+
+class MemoryStore:
+    def __init__(self, state: Optional[dict[str, Any]] = None) -> None:
+        self.state = state
+
+    def load(self) -> Optional[dict[str, Any]]:
+        return json.loads(json.dumps(self.state)) if self.state else None
+
+    def save(self, state: dict[str, Any]) -> None:
+        self.state = json.loads(json.dumps(state))
+
+
+class ParameterStore:
+    """State kept as JSON in an SSM parameter"""
+
+    def __init__(self, client: Any, name: str) -> None:
+        self.client = client
+        self.name = name
+
+    def load(self) -> Optional[dict[str, Any]]:
+        try:
+            response = self.client.get_parameter(Name=self.name)
+        except self.client.exceptions.ParameterNotFound:
+            return None
+        state: dict[str, Any] = json.loads(response["Parameter"]["Value"])
+        return state
+
+    def save(self, state: dict[str, Any]) -> None:
+        self.client.put_parameter(
+            Name=self.name,
+            Value=json.dumps(state, separators=(",", ":")),
+            Type="String",
+            Overwrite=True,
+        )
+
+
+@dataclass
+class Config:
+    idle_minutes: float = 60.0
+    # App Runner takes a few minutes to resume, and the backend to warm up
+    resume_lead_minutes: float = 30.0
+    # Events per hour above which an hour of the week is expected to be busy
+    demand_threshold: float = 0.5
+    alpha: float = DEFAULT_ALPHA
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        return cls(
+            idle_minutes=float(os.getenv("IDLE_MINUTES", cls.idle_minutes)),
+            resume_lead_minutes=float(
+                os.getenv("RESUME_LEAD_MINUTES", cls.resume_lead_minutes)
+            ),
+            demand_threshold=float(os.getenv("DEMAND_THRESHOLD", cls.demand_threshold)),
+            alpha=float(os.getenv("PROFILE_ALPHA", cls.alpha)),
+        )
+
+
+@dataclass
+class ActivitySignal:
+    started_at: float
+    last_event_at: Optional[float]
+    events: int
+    requests_per_minute: float
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ActivitySignal":
+        return cls(
+            started_at=data["started_at"],
+            last_event_at=data.get("last_event_at"),
+            events=data["events"],
+            requests_per_minute=data.get("requests_per_minute", 0.0),
+        )
+
+
+def fetch_activity(service_url: str) -> ActivitySignal:
+    with urllib.request.urlopen(f"https://{service_url}/_activity", timeout=10) as r:
+        return ActivitySignal.from_dict(json.load(r))
+
+
+@dataclass
+class State:
+    profile: ActivityProfile
+    # The counts of the backend process seen at the previous tick
+    cursor: dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"profile": self.profile.to_dict(), "cursor": self.cursor}
+
+
+@dataclass
+class Decision:
+    action: str  # "pause", "resume" or "none"
+    reason: str
+    status: str
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class Scheduler:
+    def __init__(
+        self,
+        client: AppRunnerClient,
+        service_arn: str,
+        store: StateStore,
+        config: Optional[Config] = None,
+        fetch: Callable[[str], ActivitySignal] = fetch_activity,
+    ) -> None:
+        self.client = client
+        self.service_arn = service_arn
+        self.store = store
+        self.config = config or Config()
+        self.fetch = fetch
+
+    def load_state(self) -> State:
+        data = self.store.load() or {}
+        profile = ActivityProfile.from_dict(
+            data.get("profile", {}), alpha=self.config.alpha
+        )
+        return State(profile, data.get("cursor", {}))
+
+    def describe(self) -> dict[str, Any]:
+        service: dict[str, Any] = self.client.describe_service(
+            ServiceArn=self.service_arn
+        )["Service"]
+        return service
+
+    def expects_demand(self, profile: ActivityProfile, now: float) -> bool:
+        end = now + self.config.resume_lead_minutes * 60
+        return profile.expected_rate(now, end) >= self.config.demand_threshold
+
+    def tick(self, now: float) -> Decision:
+        service = self.describe()
+        status = service["Status"]
+        state = self.load_state()
+        if status == RUNNING:
+            decision = self._tick_running(state, service["ServiceUrl"], now)
+        elif status != PAUSED:
+            # e.g. OPERATION_IN_PROGRESS while pausing or resuming
+            decision = Decision("none", "not settled", status)
+        elif self.expects_demand(state.profile, now):
+            self.resume()
+            decision = Decision("resume", "demand expected", status)
+        else:
+            decision = Decision("none", "no demand expected", status)
+        self.store.save(state.to_dict())
+        print(f"{decision.action}: {decision.reason} (status={status})")
+        return decision
+
+    def _tick_running(self, state: State, service_url: str, now: float) -> Decision:
+        try:
+            signal = self.fetch(service_url)
+        except Exception as e:
+            # The service may still be starting
+            reason = f"activity unavailable: {type(e).__qualname__}: {e}"
+            return Decision("none", reason, RUNNING)
+        self._learn(state, signal, now)
+
+        last_active = max(signal.started_at, signal.last_event_at or 0.0)
+        # The clocks of Lambda and App Runner may differ, so trust the rate as well
+        if signal.requests_per_minute > 0 or (
+            now - last_active < self.config.idle_minutes * 60
+        ):
+            return Decision("none", "active", RUNNING)
+        if self.expects_demand(state.profile, now):
+            return Decision("none", "idle but demand expected", RUNNING)
+        self.pause()
+        return Decision("pause", "idle", RUNNING)
+
+    def _learn(self, state: State, signal: ActivitySignal, now: float) -> None:
+        cursor = state.cursor
+        if (
+            cursor.get("started_at") == signal.started_at
+            and cursor.get("events", 0) <= signal.events
+        ):
+            start, events = cursor["at"], signal.events - cursor["events"]
+        else:
+            # A new backend process, whose counts start from zero
+            start, events = signal.started_at, signal.events
+        if now - start <= MAX_OBSERVATION:
+            state.profile.observe(start, now, events)
+        state.cursor = {
+            "started_at": signal.started_at,
+            "events": signal.events,
+            "at": now,
+        }
+
+    def wake(self, now: float) -> Decision:
+        """Resume the service on demand"""
+        status = self.describe()["Status"]
+        if status != PAUSED:
+            return Decision("none", "not paused", status)
+        state = self.load_state()
+        # Resume ahead of this hour from next week on
+        state.profile.record_demand(now, self.config.demand_threshold)
+        self.resume()
+        self.store.save(state.to_dict())
+        print(f"resume: woken up on demand (status={status})")
+        return Decision("resume", "woken up on demand", status)
+
+    def pause(self) -> None:
+        print(f"Pausing App Runner Service: {self.service_arn}")
+        self.client.pause_service(ServiceArn=self.service_arn)
+
+    def resume(self) -> None:
+        print(f"Resuming App Runner Service: {self.service_arn}")
+        self.client.resume_service(ServiceArn=self.service_arn)
@@ -0,0 +1,28 @@
+import hashlib
+import hmac
+import time
+from typing import Mapping, Optional
+
+# Requests older than this are rejected as replays, as Slack recommends
+MAX_AGE = 60 * 5
+
+
+def verify_signature(
+    signing_secret: str,
+    body: bytes,
+    headers: Mapping[str, str],
+    now: Optional[float] = None,
+) -> bool:
+    """Check the signature of a request from Slack, e.g. a slash command"""
+    headers = {k.lower(): v for k, v in headers.items()}
+    timestamp = headers.get("x-slack-request-timestamp", "")
+    signature = headers.get("x-slack-signature", "")
+    try:
+        age = abs((time.time() if now is None else now) - int(timestamp))
+    except ValueError:
+        return False
+    if age > MAX_AGE:
+        return False
+    base = b"v0:" + timestamp.encode() + b":" + body
+    expected = hmac.new(signing_secret.encode(), base, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"v0={expected}", signature)
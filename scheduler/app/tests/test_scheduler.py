@@ -0,0 +1,295 @@
+import datetime
+import json
+import random
+from pathlib import Path
+from typing import Any, Optional
+
+import pytest
+
+from chalicelib.profile import ActivityProfile, hour_of_week
+from chalicelib.scheduler import (
+    PAUSED,
+    RUNNING,
+    ActivitySignal,
+    Config,
+    MemoryStore,
+    Scheduler,
+)
+
+# A Monday
+MONDAY = datetime.datetime(2023, 1, 2, tzinfo=datetime.timezone.utc).timestamp()
+HOUR = 3600.0
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+TICK = 5 * 60.0
+# Time App Runner takes to pause or resume the service
+TRANSITION = 5 * 60.0
+
+
+class StubBackend:
+    """The activity counters of a backend process"""
+
+    def __init__(self, started_at: float) -> None:
+        self.started_at = started_at
+        self.last_event_at: Optional[float] = None
+        self.events: list[float] = []
+        self.now = started_at
+
+    def record(self, now: float) -> None:
+        self.events.append(now)
+        self.last_event_at = now
+
+    def signal(self) -> ActivitySignal:
+        recent = [t for t in self.events if t >= self.now - 300]
+        return ActivitySignal(
+            started_at=self.started_at,
+            last_event_at=self.last_event_at,
+            events=len(self.events),
+            requests_per_minute=len(recent) / 5,
+        )
+
+
+class StubAppRunner:
+    """Just enough of the boto3 apprunner client, with pausing and resuming taking
+    TRANSITION seconds"""
+
+    def __init__(self, now: float, status: str = RUNNING) -> None:
+        self.now = now
+        self.status = status
+        self.backend: Optional[StubBackend] = (
+            StubBackend(now) if status == RUNNING else None
+        )
+        self.calls: list[tuple[str, float]] = []
+        self._pending: Optional[tuple[float, str]] = None
+
+    def advance(self, now: float) -> None:
+        self.now = now
+        if self._pending and self._pending[0] <= now:
+            self.status = self._pending[1]
+            # The backend starts from scratch whenever the service is resumed
+            self.backend = StubBackend(now) if self.status == RUNNING else None
+            self._pending = None
+        if self.backend:
+            self.backend.now = now
+
+    def describe_service(self, ServiceArn: str) -> dict[str, Any]:
+        return {"Service": {"Status": self.status, "ServiceUrl": "bot.example.com"}}
+
+    def _transition(self, name: str, before: str, after: str) -> dict[str, Any]:
+        assert self.status == before, f"{name} while {self.status}"
+        self.calls.append((name, self.now))
+        self.status = "OPERATION_IN_PROGRESS"
+        self._pending = (self.now + TRANSITION, after)
+        return {}
+
+    def pause_service(self, ServiceArn: str) -> dict[str, Any]:
+        return self._transition("pause", RUNNING, PAUSED)
+
+    def resume_service(self, ServiceArn: str) -> dict[str, Any]:
+        return self._transition("resume", PAUSED, RUNNING)
+
+    def fetch(self, service_url: str) -> ActivitySignal:
+        if self.backend is None:
+            raise ConnectionError("service is not running")
+        return self.backend.signal()
+
+
+def make_scheduler(
+    client: StubAppRunner, store: Optional[MemoryStore] = None, **config: Any
+) -> Scheduler:
+    return Scheduler(
+        client, "arn", store or MemoryStore(), Config(**config), fetch=client.fetch
+    )
+
+
+def office_hours_trace(weeks: int, seed: int = 0) -> list[float]:
+    """Events on weekdays between 00:00 and 09:00 UTC, i.e. 9:00-18:00 JST"""
+    rng = random.Random(seed)
+    events = []
+    for day in range(weeks * 7):
+        if day % 7 >= 5:
+            continue
+        start = MONDAY + day * DAY
+        events += [start + 60 * rng.randrange(9 * 60) for _ in range(50)]
+    return sorted(events)
+
+
+def simulate(
+    scheduler: Scheduler, client: StubAppRunner, trace: list[float], end: float
+) -> dict[str, Any]:
+    """Replay `trace` minute by minute, waking the service up for missed events"""
+    missed: list[float] = []
+    running = 0.0
+    events = iter(trace)
+    event = next(events, None)
+    start = now = client.now
+    while now < end:
+        client.advance(now)
+        if client.status == RUNNING:
+            running += 60
+        while event is not None and event < now + 60:
+            if client.backend is not None:
+                client.backend.record(event)
+            else:
+                missed.append(event)
+                scheduler.wake(event)
+            event = next(events, None)
+        if now % TICK == 0:
+            scheduler.tick(now)
+        now += 60
+    return {"missed": missed, "uptime": running / (now - start)}
+
+
+def test_profile():
+    profile = ActivityProfile(alpha=0.5)
+    # 12 events on Monday at 01:00, whatever the tick interval
+    profile.observe(MONDAY + HOUR, MONDAY + 2 * HOUR, 12)
+    assert profile.rates[1] == pytest.approx(0.5 * 12)
+    ticked = ActivityProfile(alpha=0.5)
+    for minute in range(0, 60, 5):
+        start = MONDAY + HOUR + minute * 60
+        ticked.observe(start, start + 300, 1)
+    assert ticked.rates[1] == pytest.approx(profile.rates[1])
+    assert profile.expected_rate(MONDAY, MONDAY + HOUR) == profile.rates[1]
+    assert profile.expected_rate(MONDAY + 2 * HOUR, MONDAY + 3 * HOUR) == 0
+
+    # The week wraps around from Sunday to Monday
+    assert hour_of_week(MONDAY - 1) == 7 * 24 - 1
+    assert profile.expected_rate(MONDAY - 0.5 * HOUR, MONDAY + 1.5 * HOUR) > 0
+
+    profile.record_demand(MONDAY + 5 * HOUR, 0.5)
+    assert profile.rates[5] == 0.5
+    assert ActivityProfile.from_dict(profile.to_dict()).rates == profile.rates
+
+
+def test_pause_after_idle_window():
+    client = StubAppRunner(MONDAY)
+    scheduler = make_scheduler(client, idle_minutes=60)
+    assert client.backend is not None
+    client.backend.record(MONDAY + 10 * 60)
+
+    client.advance(MONDAY + 30 * 60)
+    assert scheduler.tick(client.now).reason == "active"
+    client.advance(MONDAY + 69 * 60)
+    assert scheduler.tick(client.now).action == "none"
+    client.advance(MONDAY + 71 * 60)
+    assert scheduler.tick(client.now).action == "pause"
+    assert client.calls == [("pause", MONDAY + 71 * 60)]
+
+
+def test_stay_up_when_demand_expected():
+    client = StubAppRunner(MONDAY + 2.5 * HOUR)
+    profile = ActivityProfile()
+    profile.record_demand(MONDAY + 4 * HOUR, 5.0)
+    store = MemoryStore({"profile": profile.to_dict()})
+    scheduler = make_scheduler(client, store, idle_minutes=60, resume_lead_minutes=30)
+
+    # Idle since it was started, but users are expected from 4:00
+    client.advance(MONDAY + 3.75 * HOUR)
+    decision = scheduler.tick(client.now)
+    assert decision.reason == "idle but demand expected"
+    assert client.calls == []
+
+
+def test_resume_ahead_of_demand():
+    client = StubAppRunner(MONDAY, status=PAUSED)
+    profile = ActivityProfile()
+    profile.record_demand(MONDAY + 4 * HOUR, 5.0)
+    store = MemoryStore({"profile": profile.to_dict()})
+    scheduler = make_scheduler(client, store, resume_lead_minutes=30)
+
+    client.advance(MONDAY + 3 * HOUR)
+    assert scheduler.tick(client.now).reason == "no demand expected"
+    client.advance(MONDAY + 3.5 * HOUR)
+    assert scheduler.tick(client.now).action == "resume"
+    client.advance(MONDAY + 3.5 * HOUR + 60)
+    assert scheduler.tick(client.now).reason == "not settled"
+
+
+def test_activity_unavailable():
+    client = StubAppRunner(MONDAY, status=PAUSED)
+    client.status = RUNNING
+    scheduler = make_scheduler(client, idle_minutes=0)
+    decision = scheduler.tick(MONDAY + DAY)
+    assert decision.action == "none"
+    assert decision.reason.startswith("activity unavailable: ConnectionError")
+
+
+def test_learn_across_restarts():
+    client = StubAppRunner(MONDAY)
+    store = MemoryStore()
+    scheduler = make_scheduler(client, store, idle_minutes=600)
+    backend = client.backend
+    assert backend is not None
+    for minute in range(0, 30, 5):
+        backend.record(MONDAY + minute * 60)
+        client.advance(MONDAY + (minute + 5) * 60)
+        scheduler.tick(client.now)
+    learned = ActivityProfile.from_dict(store.load()["profile"]).rates[0]
+    assert learned > 0
+
+    # A new process whose counter is lower than before
+    client.backend = StubBackend(MONDAY + 40 * 60)
+    client.backend.record(MONDAY + 41 * 60)
+    client.advance(MONDAY + 45 * 60)
+    scheduler.tick(client.now)
+    cursor = store.load()["cursor"]
+    assert cursor == {"started_at": MONDAY + 40 * 60, "events": 1, "at": client.now}
+    assert ActivityProfile.from_dict(store.load()["profile"]).rates[0] > learned
+
+
+def test_wake_on_demand():
+    client = StubAppRunner(MONDAY + 12 * HOUR, status=PAUSED)
+    store = MemoryStore()
+    scheduler = make_scheduler(client, store, demand_threshold=0.5)
+    assert scheduler.wake(client.now).action == "resume"
+    assert ActivityProfile.from_dict(store.load()["profile"]).rates[12] == 0.5
+    # Already resuming
+    assert scheduler.wake(client.now + 60).action == "none"
+    assert client.calls == [("resume", MONDAY + 12 * HOUR)]
+
+
+def test_office_hours_trace():
+    weeks = 3
+    trace = office_hours_trace(weeks)
+    client = StubAppRunner(MONDAY)
+    scheduler = make_scheduler(client)
+    first = simulate(scheduler, client, trace, end=MONDAY + (weeks - 1) * WEEK)
+    # Users wake the service up in the morning while it has yet to learn the week
+    assert first["missed"]
+
+    last = simulate(scheduler, client, trace, end=MONDAY + weeks * WEEK)
+    assert last["missed"] == []
+    # Up for the office hours only, and paused over the weekend
+    assert last["uptime"] < 0.4
+    saturday = MONDAY + (weeks - 1) * WEEK + 5 * DAY
+    assert [
+        t for _, t in client.calls if saturday <= t < saturday + DAY + 20 * HOUR
+    ] == []
+    # and resumed ahead of Monday morning
+    assert client.calls[-1][0] == "resume"
+
+
+def test_after_hours_request_wakes_the_service():
+    trace = office_hours_trace(2)
+    # Someone asks on Saturday of the second week
+    saturday = MONDAY + WEEK + 5 * DAY + 3 * HOUR
+    client = StubAppRunner(MONDAY)
+    scheduler = make_scheduler(client, idle_minutes=30)
+    result = simulate(scheduler, client, sorted(trace + [saturday]), MONDAY + 2 * WEEK)
+    assert saturday in result["missed"]
+    woken = [t for name, t in client.calls if name == "resume" and t >= saturday]
+    assert woken[0] == saturday
+    # and it is paused again afterwards
+    paused = [t for name, t in client.calls if name == "pause" and t > saturday]
+    assert paused[0] < saturday + 2 * HOUR
+
+
+def test_policy_allows_the_calls_made():
+    path = Path(__file__).parent.parent / ".chalice" / "policy.template.json"
+    policy = json.loads(path.read_text().replace("{{ ", "").replace(" }}", ""))
+    actions = {a for s in policy["Statement"] for a in s["Action"]}
+    # The methods of the boto3 clients that the scheduler calls
+    called = {"DescribeService", "PauseService", "ResumeService"}
+    assert {f"apprunner:{name}" for name in called} <= actions
+    assert {"ssm:GetParameter", "ssm:PutParameter"} <= actions
@@ -0,0 +1,26 @@
+import hashlib
+import hmac
+
+from chalicelib.slack import verify_signature
+
+SECRET = "test-secret"
+
+
+def sign(body: bytes, timestamp: int) -> dict[str, str]:
+    base = f"v0:{timestamp}:".encode() + body
+    digest = hmac.new(SECRET.encode(), base, hashlib.sha256).hexdigest()
+    return {
+        "X-Slack-Request-Timestamp": str(timestamp),
+        "X-Slack-Signature": f"v0={digest}",
+    }
+
+
+def test_verify_signature():
+    body = b"command=%2Fwake&user_id=U1"
+    headers = sign(body, 1700000000)
+    assert verify_signature(SECRET, body, headers, now=1700000010)
+    assert not verify_signature("other", body, headers, now=1700000010)
+    assert not verify_signature(SECRET, body + b"x", headers, now=1700000010)
+    # Replayed later
+    assert not verify_signature(SECRET, body, headers, now=1700001000)
+    assert not verify_signature(SECRET, body, {}, now=1700000010)
@@ -9,6 +9,18 @@ poetry export -f requirements.txt --output requirements.txt --only main
 jinja2 .chalice/config.template.json \
     -D APPRUNNER_ARN="${APPRUNNER_ARN}" \
     -D APPRUNNER_ARN_DEV="${APPRUNNER_ARN_DEV}" \
+    -D SLACK_SIGNING_SECRET="${SLACK_SIGNING_SECRET}" \
+    -D SLACK_SIGNING_SECRET_DEV="${SLACK_SIGNING_SECRET_DEV}" \
     > .chalice/config.json
+# The role is not generated by chalice, as the AWS calls are made in chalicelib
+if [ "${stage}" = "prod" ]; then
+    apprunner_arn="${APPRUNNER_ARN}"
+else
+    apprunner_arn="${APPRUNNER_ARN_DEV}"
+fi
+jinja2 .chalice/policy.template.json \
+    -D APPRUNNER_ARN="${apprunner_arn}" \
+    -D STATE_PARAMETER="/openai-bot-scheduler/${stage}/state" \
+    > .chalice/policy-${stage}.json
 
 chalice deploy --stage ${stage}